@@ -22,48 +22,157 @@ Dirk Bergstrom, krid@otisbean.com
 @author: krid
 """
 
+import datetime
+
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR, \
+    ORDER_TYPE_VAR, SEARCH_VAR, IS_POPUP_VAR, TO_FIELD_VAR
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.db.models.query import QuerySet
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import escape
+from django.utils.text import truncate_words
 
 from journal.diary.models import BikeRide, SocialEvent, DiningOut, Entry, \
-    Person, Video, Book, Music, Activity, Media, MedicalObservation, Consumable, \
-    Period, Event
-
-class ConsumableInline(admin.TabularInline):
+    Person, Video, Book, Music, MedicalObservation, Consumable, \
+    Period, Event, Rollup, Tag, Band
+
+
+class LabelledRawIdWidget(ForeignKeyRawIdWidget):
+    """ Takes the label beside the id from labels, filled in for every row
+    at once by LabellingFormSet, rather than looking up each row's object.
+    """
+
+    labels = None
+
+    def label_for_value(self, value):
+        if self.labels is None:
+            return super(LabelledRawIdWidget, self).label_for_value(value)
+        return self.labels.get(unicode(value), '')
+
+
+class LabellingFormSet(BaseInlineFormSet):
+    """ Looks up the objects named in all the rows' raw id fields with one
+    query per field, and hands their labels to the rows' widgets.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LabellingFormSet, self).__init__(*args, **kwargs)
+        if not self.forms:
+            return
+        for name, field in self.forms[0].fields.items():
+            widget = field.widget
+            if not isinstance(widget, LabelledRawIdWidget):
+                continue
+            values = set()
+            for form in self.forms:
+                value = form.is_bound and form[name].data or \
+                    form.initial.get(name)
+                if value:
+                    values.add(unicode(value))
+            key = widget.rel.get_related_field().name
+            labels = {}
+            try:
+                for obj in widget.rel.to._default_manager.using(widget.db).\
+                        filter(**{'{0}__in'.format(key): values}):
+                    labels[unicode(getattr(obj, key))] = \
+                        '&nbsp;<strong>{0}</strong>'.format(
+                            escape(truncate_words(obj, 14)))
+            except ValueError:
+                # Something typed in isn't an id; let the rows fend for
+                # themselves.
+                continue
+            for form in self.forms:
+                form.fields[name].widget.labels = labels
+
+
+class LabellingInline(admin.TabularInline):
+    """ An inline whose raw id fields get their labels from one query,
+    rather than one per row.
+    """
+
+    formset = LabellingFormSet
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        formfield = super(LabellingInline, self).formfield_for_foreignkey(
+            db_field, request, **kwargs)
+        if db_field.name in self.raw_id_fields:
+            formfield.widget = LabelledRawIdWidget(db_field.rel,
+                                                   using=kwargs.get('using'))
+        return formfield
+
+
+class ConsumableInline(LabellingInline):
     model = Entry.consumables.through
+    # A select box would list every consumable, once per row.
+    raw_id_fields = ('consumable',)
     extra = 1
 
 
-class MediaInline(admin.TabularInline):
+class MediaInline(LabellingInline):
     model = Entry.media.through
+    raw_id_fields = ('media',)
     extra = 1
 
 
-class BikeRideInline(admin.TabularInline):
-    model = BikeRide
-    #fields = ('summary', 'reality', 'distance', 'average_speed', 'climbing', 'solo')
-    extra = 1
-
-
-class SocialEventInline(admin.TabularInline):
-    model = SocialEvent
-    #fields = ('summary', 'reality', 'private',)
-    extra = 1
-
-
-class DiningOutInline(admin.TabularInline):
-    model = DiningOut
-    #fields = ('summary', 'reality', 'restaurant',)
-    extra = 1
-
-
-class ActivityInline(admin.TabularInline):
-    model = Activity
-    extra = 1
-
-
-class MedicalObservationInline(admin.TabularInline):
-    model = MedicalObservation
-    extra = 1
+class RollupDatesQuerySet(QuerySet):
+    """ Answers the date hierarchy's dates() from the mood rollups, which
+    already have a row for every day, month & year with an entry, rather
+    than with a SELECT DISTINCT over the entries.
+    """
+
+    # (first, last) day of the drill-down, set by EntryChangeList.
+    window = (None, None)
+
+    def dates(self, field_name, kind, order='ASC'):
+        rollups = Rollup.objects.filter(series__startswith='mood.',
+                                        period=kind)
+        first, last = self.window
+        if first:
+            rollups = rollups.filter(start__range=(first, last))
+        days = rollups.order_by(order == 'DESC' and '-start' or 'start').\
+            values_list('start', flat=True).distinct()
+        return [datetime.datetime.combine(day, datetime.time())
+                for day in days]
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        clone = super(RollupDatesQuerySet, self)._clone(klass, setup, **kwargs)
+        clone.window = self.window
+        return clone
+
+
+class EntryChangeList(ChangeList):
+    """ Uses the rollups for the date hierarchy when the list is filtered
+    by nothing but the hierarchy itself.
+    """
+
+    NOT_LOOKUPS = (ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, SEARCH_VAR,
+                   IS_POPUP_VAR, TO_FIELD_VAR)
+
+    def get_query_set(self):
+        queryset = super(EntryChangeList, self).get_query_set()
+        lookups = dict((key, value) for key, value in self.params.items()
+                       if key not in self.NOT_LOOKUPS)
+        field = self.date_hierarchy
+        drill_down = ('{0}__year'.format(field), '{0}__month'.format(field),
+                      '{0}__day'.format(field))
+        if self.query or [key for key in lookups if key not in drill_down]:
+            return queryset
+        queryset = queryset._clone(klass=RollupDatesQuerySet)
+        try:
+            year = int(lookups.get(drill_down[0], 0))
+            month = int(lookups.get(drill_down[1], 0))
+        except ValueError:
+            return queryset
+        if year and month:
+            first = datetime.date(year, month, 1)
+            last = (first + datetime.timedelta(days=31)).replace(day=1) - \
+                datetime.timedelta(days=1)
+            queryset.window = (first, last)
+        elif year:
+            queryset.window = (datetime.date(year, 1, 1),
+                               datetime.date(year, 12, 31))
+        return queryset
 
 
 class EntryAdmin(admin.ModelAdmin):
@@ -76,13 +185,13 @@ class EntryAdmin(admin.ModelAdmin):
     date_hierarchy = 'date'
     search_fields = ('summary',)
     list_filter = ('mood',)
-    inlines = [ActivityInline,
-               BikeRideInline,
-               SocialEventInline,
-               DiningOutInline,
-               MediaInline,
-               ConsumableInline,
-               MedicalObservationInline, ]
+    # Activities & medical observations have their own dates now, rather
+    # than belonging to an entry, so they can't be inlines here.
+    inlines = [MediaInline,
+               ConsumableInline, ]
+
+    def get_changelist(self, request, **kwargs):
+        return EntryChangeList
 admin.site.register(Entry, EntryAdmin)
 
 
@@ -97,36 +206,53 @@ admin.site.register(Person, PersonAdmin)
 
 
 class SocialEventAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('company',)
 admin.site.register(SocialEvent, SocialEventAdmin)
 
 
 class DiningOutAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('company', 'consumables')
 admin.site.register(DiningOut, DiningOutAdmin)
 
 
 class VideoAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('referred_by',)
 admin.site.register(Video, VideoAdmin)
 
 
 class BookAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('referred_by',)
 admin.site.register(Book, BookAdmin)
 
 
 class MusicAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('referred_by',)
 admin.site.register(Music, MusicAdmin)
 
 class ConsumableAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ('referred_by',)
 admin.site.register(Consumable, ConsumableAdmin)
 
 class MedicalObservationAdmin(admin.ModelAdmin):
     pass
 admin.site.register(MedicalObservation, MedicalObservationAdmin)
 
-admin.site.register(Event)
-admin.site.register(Period)
+class EventAdmin(admin.ModelAdmin):
+    filter_horizontal = ('tags',)
+admin.site.register(Event, EventAdmin)
+
+
+class PeriodAdmin(admin.ModelAdmin):
+    filter_horizontal = ('tags',)
+admin.site.register(Period, PeriodAdmin)
+
+
+admin.site.register(Tag)
+
+
+class BandAdmin(admin.ModelAdmin):
+    list_display = ('name', 'line_type', 'user', 'position', 'classnames')
+    list_editable = ('position',)
+    list_filter = ('line_type', 'user')
+    filter_horizontal = ('tags',)
+admin.site.register(Band, BandAdmin)
@@ -0,0 +1,230 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Ad-hoc analysis with NumPy
+
+The rollups answer the questions we knew to ask.  For the rest (rolling
+distances, streaks, does mood follow rides) a Diary loads the interesting
+columns once, with values_list rather than model instances, into arrays
+with one slot per day.  Everything after that is array arithmetic:
+
+    >>> diary = Diary.load()
+    >>> rolling_sum(diary['ride.distance'], 30)
+    >>> longest_streak(diary['ride.count'] > 0)
+    >>> correlation(diary['mood'], diary['dining.count'], lag=1)
+
+Requires NumPy.
+"""
+
+import datetime
+
+import numpy as np
+
+from journal.diary.models import Entry, BikeRide, DiningOut, \
+    MedicalObservation
+
+# Moods as numbers, so they can be averaged & correlated.  Higher is better.
+MOOD_SCORES = {
+    'very-happy': 4,
+    'happy': 3,
+    'good': 2,
+    'ok': 1,
+    'down': -1,
+    'sick': -1,
+    'frustrated': -2,
+    'angry': -2,
+    'depressed': -3,
+}
+
+
+class Diary(object):
+    """ Per-day columns, from the first day to the last.  Counts and sums
+    are zero on empty days; 'mood' (the average score of the day's entries)
+    is NaN.
+    """
+
+    def __init__(self, first, columns):
+        self.first = first
+        self.columns = columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns['entry.count'])
+
+    def index(self, day):
+        """ The slot for a date. """
+        return day.toordinal() - self.first
+
+    def date(self, index):
+        """ The date in a slot. """
+        return datetime.date.fromordinal(self.first + int(index))
+
+    @classmethod
+    def load(cls, start=None, end=None):
+        """ Read the diary (or the part from start to end) from the database,
+        in one query per model.
+        """
+        def window(queryset):
+            if start:
+                queryset = queryset.filter(date__gte=start)
+            if end:
+                queryset = queryset.filter(date__lte=end)
+            return queryset
+        return cls.from_rows(
+            rides=window(BikeRide.objects.all()).
+                values_list('date', 'distance', 'climbing'),
+            entries=window(Entry.objects.all()).values_list('date', 'mood'),
+            dining=window(DiningOut.objects.all()).
+                values_list('date', flat=True),
+            medical=window(MedicalObservation.objects.all()).
+                values_list('date', flat=True),
+            start=start, end=end)
+
+    @classmethod
+    def from_rows(cls, rides=(), entries=(), dining=(), medical=(),
+                  start=None, end=None):
+        """ Build the columns from (date, distance, climbing) rides,
+        (date, mood) entries, and the dates of dinners out & medical
+        observations.
+        """
+        rides = _columns(rides, 3)
+        entries = _columns(entries, 2)
+        dining = _ordinals(dining)
+        medical = _ordinals(medical)
+        days = np.concatenate((rides[0], entries[0], dining, medical))
+        if start:
+            first = start.toordinal()
+        elif len(days):
+            first = int(days.min())
+        else:
+            first = datetime.date.today().toordinal()
+        if end:
+            last = end.toordinal()
+        elif len(days):
+            last = int(days.max())
+        else:
+            last = first
+        length = last - first + 1
+
+        def per_day(ordinals, weights=None):
+            inside = (ordinals >= first) & (ordinals <= last)
+            if weights is not None:
+                weights = weights[inside]
+            return np.bincount(ordinals[inside] - first, weights=weights,
+                               minlength=length).astype(float)
+
+        ride_days = rides[0]
+        mood_days = entries[0]
+        scores = np.array([MOOD_SCORES.get(mood, 0) for mood in entries[1]],
+                          dtype=float)
+        entry_count = per_day(mood_days)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mood = per_day(mood_days, scores) / entry_count
+        return cls(first, {
+            'ride.count': per_day(ride_days),
+            'ride.distance': per_day(ride_days, rides[1].astype(float)),
+            'ride.climbing': per_day(ride_days, rides[2].astype(float)),
+            'entry.count': entry_count,
+            'mood': mood,
+            'dining.count': per_day(dining),
+            'medical.count': per_day(medical),
+        })
+
+
+def _ordinals(dates):
+    return np.fromiter((day.toordinal() for day in dates), dtype=np.int64)
+
+
+def _columns(rows, width):
+    """ Split rows into columns, with the first (dates) as day ordinals. """
+    columns = zip(*rows) or [()] * width
+    return [_ordinals(columns[0])] + [np.array(column) for column in
+                                      columns[1:]]
+
+
+def rolling_sum(values, window):
+    """ The sum of each day and the window - 1 days before it.  NaNs count
+    as zero.
+    """
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    lagged = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+    return sums[1:] - sums[lagged]
+
+
+def rolling_mean(values, window):
+    """ The mean of the non-NaN values in each day's window, or NaN if there
+    aren't any.
+    """
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return rolling_sum(np.where(present, values, 0), window) / \
+            rolling_sum(present, window)
+
+
+def streaks(mask):
+    """ Return (starts, lengths) arrays for the runs of True in mask. """
+    padded = np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0]))
+    edges = np.diff(padded)
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+
+def longest_streak(mask):
+    """ Return (start, length) of the longest run of True, or (None, 0). """
+    starts, lengths = streaks(mask)
+    if not len(lengths):
+        return None, 0
+    best = lengths.argmax()
+    return int(starts[best]), int(lengths[best])
+
+
+def current_streak(mask):
+    """ The length of the run of True ending on the last day. """
+    starts, lengths = streaks(mask)
+    if not len(lengths) or starts[-1] + lengths[-1] != len(mask):
+        return 0
+    return int(lengths[-1])
+
+
+def correlation(a, b, lag=0):
+    """ Pearson correlation of a with b, lag days later, over the days both
+    have values.  NaN if there are fewer than three such days or either
+    side is constant.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if lag > 0:
+        a, b = a[:-lag], b[lag:]
+    elif lag < 0:
+        a, b = a[-lag:], b[:lag]
+    both = ~(np.isnan(a) | np.isnan(b))
+    a, b = a[both], b[both]
+    if len(a) < 3 or a.std() == 0 or b.std() == 0:
+        return float('nan')
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def mood_correlations(diary, lag=0):
+    """ How mood goes with riding, eating out & getting sick, lag days
+    later.
+    """
+    return dict((name, correlation(diary[name], diary['mood'], lag))
+                for name in ('ride.count', 'ride.distance', 'dining.count',
+                             'medical.count'))
@@ -0,0 +1,273 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Export & restore
+
+A backup is newline-delimited JSON, one record per line, independent of the
+database it came from:
+
+    {"backup": "journal", "version": 1, "since": null,
+     "taken": "2010-10-01 12:00:00"}
+    {"model": "Activity", "pk": 7, "fields": {"date": "2010-10-01", ...}}
+    {"model": "BikeRide", "pk": 7, "fields": {"distance": 30, ...}}
+    {"link": "DiningOut.company", "pk": 9, "targets": [1, 2, 3]}
+
+Each table gets its own records, keyed by column, so a BikeRide is an
+Activity row plus a BikeRide row, in that order, and restoring one is a
+plain insert per table.  Tables are read a chunk of primary keys at a time
+with values_list(), so memory use doesn't grow with the journal.
+
+An incremental export (since a modified time) holds the rows modified
+since then, and the links of the objects modified since then, which
+covers link changes as those touch their owner's modified time.  Deletions
+aren't recorded; restore a full export to get rid of deleted rows.  The
+"taken" time of one export is the "since" for the next.
+
+Users aren't exported; the users the entries and bands belong to must
+exist before a restore.  The timeline, search index & rollups are derived, so they aren't
+exported either, and are rebuilt after a restore.
+"""
+
+import json
+import zlib
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+from journal.diary.models import Entry, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Consumable, Media, Book, Music, Video, \
+    MedicalObservation, Event, Period, Tag, Band
+from journal.diary import timeline
+from journal.diary import search
+from journal.diary import rollups
+from journal.diary import intervals
+
+VERSION = 1
+
+# Parents before children, and anything referred to before what refers to
+# it.
+MODELS = (Person, Consumable, Media, Book, Music, Video, Tag, Entry, Activity,
+          BikeRide, SocialEvent, DiningOut, MedicalObservation, Event, Period,
+          Band)
+
+_BY_NAME = dict((model.__name__, model) for model in MODELS)
+
+# (owner, field name) of the links to export.
+LINKS = tuple((model, field.name) for model in MODELS
+              for field in model._meta.local_many_to_many)
+
+CHUNK_SIZE = 500
+
+
+class BackupEncoder(DjangoJSONEncoder):
+    """ Keeps the microseconds DjangoJSONEncoder drops from datetimes. """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return str(o)
+        return super(BackupEncoder, self).default(o)
+
+
+def _chunks(queryset, fields, chunk_size=CHUNK_SIZE):
+    """ Iterate over values_list rows of the queryset, primary key first, a
+    chunk of keys at a time.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.values_list('pk', *fields)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+def _changed(model, since):
+    queryset = model.objects.all()
+    if since:
+        queryset = queryset.filter(modified__gte=since)
+    return queryset
+
+
+def records(since=None):
+    """ Iterate over the backup records (as dicts), starting with the
+    header.
+    """
+    yield dict(backup='journal', version=VERSION, since=since,
+               taken=datetime.datetime.now().replace(microsecond=0))
+    for model in MODELS:
+        fields = [field.attname for field in model._meta.local_fields
+                  if not field.primary_key]
+        for row in _chunks(_changed(model, since), fields):
+            yield dict(model=model.__name__, pk=row[0],
+                       fields=dict(zip(fields, row[1:])))
+    for model, field_name in LINKS:
+        field = model._meta.get_field(field_name)
+        through = field.rel.through
+        # The link model's foreign keys, which give ids in values_list().
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        name = '{0}.{1}'.format(model.__name__, field_name)
+        owners = []
+        for row in _chunks(_changed(model, since), ()):
+            owners.append(row[0])
+            if len(owners) == CHUNK_SIZE:
+                for record in _links(name, through, source, target, owners):
+                    yield record
+                owners = []
+        for record in _links(name, through, source, target, owners):
+            yield record
+
+
+def _links(name, through, source, target, owners):
+    """ One record per owner, even those without links, so that a restore
+    can clear links that have been removed.
+    """
+    targets = dict((owner, []) for owner in owners)
+    if owners:
+        for owner, other in through.objects.\
+                filter(**{'{0}__in'.format(source): owners}).\
+                values_list(source, target):
+            targets[owner].append(other)
+    for owner in owners:
+        yield dict(link=name, pk=owner, targets=sorted(targets[owner]))
+
+
+def iter_lines(since=None):
+    """ The backup as lines of JSON. """
+    for record in records(since):
+        yield json.dumps(record, cls=BackupEncoder) + '\n'
+
+
+def iter_gzip(lines):
+    """ Gzip an iterable of strings as it goes. """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Restorer(object):
+    """ Writes backup records back to the database: rows that exist are
+    updated, the rest inserted, a chunk per table at a time.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.counts = {}
+        self._model = None
+        self._pending = []
+
+    def restore(self, lines):
+        """ Restore from an iterable of JSON lines.  Returns {model or link
+        name: records restored}.
+        """
+        lines = iter(lines)
+        header = json.loads(lines.next())
+        if header.get('backup') != 'journal' or \
+                header.get('version') != VERSION:
+            raise ValueError("Not a journal backup, or an unknown version")
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.get('model') or record['link']
+            if kind != self._model or len(self._pending) >= self.chunk_size:
+                self._flush()
+                self._model = kind
+            self._pending.append(record)
+        self._flush()
+        return self.counts
+
+    def _flush(self):
+        if self._pending:
+            if 'link' in self._pending[0]:
+                self._write_links(self._model, self._pending)
+            else:
+                self._write_rows(_BY_NAME[self._model], self._pending)
+            self.counts[self._model] = self.counts.get(self._model, 0) + \
+                len(self._pending)
+        self._pending = []
+
+    @transaction.commit_on_success
+    def _write_rows(self, model, records):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        pk = model._meta.pk
+        fields = [field for field in model._meta.local_fields
+                  if not field.primary_key]
+        existing = set(model._default_manager.filter(
+            pk__in=[record['pk'] for record in records]).
+            values_list('pk', flat=True))
+
+        def values(record):
+            return [field.get_db_prep_save(
+                field.to_python(record['fields'].get(field.attname)),
+                connection=connection) for field in fields]
+
+        updates = [values(record) + [record['pk']] for record in records
+                   if record['pk'] in existing]
+        inserts = [[record['pk']] + values(record) for record in records
+                   if record['pk'] not in existing]
+        table = qn(model._meta.db_table)
+        if updates:
+            cursor.executemany('UPDATE {0} SET {1} WHERE {2} = %s'.format(
+                table, ', '.join('{0} = %s'.format(qn(field.column))
+                                 for field in fields), qn(pk.column)),
+                updates)
+        if inserts:
+            cursor.executemany('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                table, ', '.join(qn(field.column) for field in [pk] + fields),
+                ', '.join(['%s'] * (len(fields) + 1))), inserts)
+        transaction.set_dirty()
+
+    @transaction.commit_on_success
+    def _write_links(self, name, records):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        model_name, field_name = name.split('.')
+        field = _BY_NAME[model_name]._meta.get_field(field_name)
+        table = qn(field.m2m_db_table())
+        source = qn(field.m2m_column_name())
+        target = qn(field.m2m_reverse_name())
+        cursor.executemany('DELETE FROM {0} WHERE {1} = %s'.format(
+            table, source), [[record['pk']] for record in records])
+        links = [[record['pk'], other] for record in records
+                 for other in record['targets']]
+        if links:
+            cursor.executemany('INSERT INTO {0} ({1}, {2}) VALUES (%s, %s)'.
+                               format(table, source, target), links)
+        transaction.set_dirty()
+
+
+def rebuild_derived():
+    """ Rebuild the period tree, timeline, search index & rollups after a
+    restore.
+    """
+    # The restore's inserts & updates skipped the signals that keep the
+    # tree current.
+    intervals.reset()
+    for line_type in timeline.LINE_TYPES:
+        timeline.rebuild(line_type)
+    search.rebuild()
+    rollups.rebuild()
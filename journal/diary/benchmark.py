@@ -0,0 +1,240 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks
+
+Times the hot paths against whatever is in the database (see
+diary.generator for building a big journal to run them on):
+
+    timeline_json <line type>           The whole feed, both line types
+    timeline_json <line type> year      The last year's window
+    timeline_json <line type> columnar  The whole feed, columnar
+    model_details <model>               A bubble, a different object each
+                                        time, with the bubble cache off
+    admin <model>                       The admin changelist
+    as_timeline_dict <model>            Encoding a batch of objects that
+                                        are already loaded
+
+Each case is run a number of times; the results give the latency
+percentiles, the queries per run and the process' peak RSS after the case
+(which only ever grows, so a jump marks the case responsible).  They're
+plain JSON, for compare() to hold one run up against another.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import resource
+import datetime
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test.client import Client
+
+from journal.diary.models import Entry, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, MedicalObservation, Event, Period
+from journal.diary import bubblecache
+from journal.diary import timeline
+from journal.middleware import tally
+
+# The models with bubbles, and with events on the timelines.
+DETAIL_MODELS = (Entry, Person, Activity, BikeRide, SocialEvent, DiningOut,
+                 MedicalObservation, Event, Period)
+TIMELINE_MODELS = (Entry, Person, Activity, MedicalObservation, Event,
+                   Period)
+
+# Objects per as_timeline_dict run.
+BATCH = 500
+
+# The staff user the views are requested as.
+USERNAME = 'benchmark'
+
+
+def benchmark_user():
+    """ The staff user the views are requested as, made if need be.  Only
+    what it may see (see diary.timeline.visible) is measured, so journals
+    generated for benchmarking belong to it.
+    """
+    user, created = User.objects.get_or_create(username=USERNAME)
+    if not (user.is_staff and user.is_superuser):
+        user.is_staff = user.is_superuser = True
+        user.save()
+    return user
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a sorted list. """
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[max(0, min(len(values) - 1, index))]
+
+
+def _queries():
+    return sum(tally(connection).total_queries
+               for connection in connections.all())
+
+
+def _peak_rss():
+    """ Peak resident set size so far, in KB (on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Benchmark(object):
+
+    def __init__(self, iterations=20, seed=1):
+        self.iterations = iterations
+        self.rand = random.Random(seed)
+        self.user = user = benchmark_user()
+        password = os.urandom(8).encode('hex')
+        user.set_password(password)
+        user.save()
+        # RemoteUserMiddleware in production, a session in development.
+        self.client = Client(REMOTE_USER=USERNAME)
+        self.client.login(username=USERNAME, password=password)
+
+    def cases(self):
+        """ Return [(name, function of the run number)], each function
+        making one request or doing one batch.
+        """
+        cases = []
+        year = (datetime.date.today() - datetime.timedelta(days=365)).\
+            strftime('%Y-%m-%d')
+        for line_type in ('diary', 'life'):
+            url = '/timeline_json/{0}/'.format(line_type)
+            cases.append(('timeline_json {0}'.format(line_type),
+                          self.getter(url)))
+            cases.append(('timeline_json {0} year'.format(line_type),
+                          self.getter(url, start=year)))
+            cases.append(('timeline_json {0} columnar'.format(line_type),
+                          self.getter(url, format='columnar')))
+        for model in DETAIL_MODELS:
+            # The bubbles of what the user may not see are 404s.
+            pks = list(timeline.visible_pks(
+                model, model.objects.values_list('pk', flat=True).
+                order_by('?')[:self.iterations], self.user))
+            if pks:
+                cases.append(('model_details {0}'.format(model.__name__),
+                              self.details_getter(model, pks)))
+        # The registry fills when urls.py is loaded, which may not have
+        # happened yet.
+        admin.autodiscover()
+        for model in sorted(admin.site._registry,
+                            key=lambda model: model.__name__):
+            if model._meta.app_label == 'diary':
+                cases.append(('admin {0}'.format(model.__name__),
+                              self.getter('/admin/diary/{0}/'.format(
+                                  model._meta.module_name))))
+        for model in TIMELINE_MODELS:
+            objects = list(model.objects.all()[:BATCH])
+            if objects:
+                cases.append(('as_timeline_dict {0}'.format(model.__name__),
+                              self.encoder(objects)))
+        return cases
+
+    def getter(self, url, **params):
+        def get(run):
+            response = self.client.get(url, params)
+            if response.status_code != 200:
+                raise ValueError("{0} answered {1}".format(
+                    url, response.status_code))
+            # Streamed responses do their work here.
+            response.content
+        return get
+
+    def details_getter(self, model, pks):
+        urls = ['/details/{0}/{1}/'.format(model.__name__, pk) for pk in pks]
+        gets = [self.getter(url) for url in urls]
+        return lambda run: gets[run % len(gets)](run)
+
+    def encoder(self, objects):
+        def encode(run):
+            for obj in objects:
+                json.dumps(obj.as_timeline_dict())
+        encode.batch = len(objects)
+        return encode
+
+    def run(self, only=None, progress=None):
+        """ Run the cases (those whose names start with one of only, if
+        given) and return the results.  progress, if given, is called with
+        each case's name and results as it finishes.
+        """
+        cache, bubblecache.backend = bubblecache.backend, None
+        try:
+            results = {}
+            for name, function in self.cases():
+                if only and not any(name.startswith(prefix)
+                                    for prefix in only):
+                    continue
+                results[name] = self.measure(function)
+                if progress:
+                    progress(name, results[name])
+        finally:
+            bubblecache.backend = cache
+        return dict(meta=self.meta(), cases=results)
+
+    def measure(self, function):
+        # One run to warm caches, imports & the like.
+        function(-1)
+        times = []
+        queries = _queries()
+        for run in range(self.iterations):
+            started = time.time()
+            function(run)
+            times.append(time.time() - started)
+        queries = _queries() - queries
+        times.sort()
+        result = dict(runs=len(times),
+                      queries=float(queries) / len(times),
+                      mean_ms=1000 * sum(times) / len(times),
+                      p50_ms=1000 * percentile(times, 0.5),
+                      p90_ms=1000 * percentile(times, 0.9),
+                      p99_ms=1000 * percentile(times, 0.99),
+                      max_ms=1000 * times[-1],
+                      peak_rss_kb=_peak_rss())
+        batch = getattr(function, 'batch', None)
+        if batch:
+            result['per_second'] = batch / (sum(times) / len(times))
+        return result
+
+    def meta(self):
+        counts = dict((model.__name__, model.objects.count()) for model in
+                      DETAIL_MODELS)
+        return dict(taken=datetime.datetime.now().strftime(
+                        '%Y-%m-%d %H:%M:%S'),
+                    iterations=self.iterations,
+                    python=sys.version.split()[0],
+                    database=connections['default'].settings_dict['ENGINE'],
+                    rows=counts)
+
+
+def compare(old, new, tolerance=0.2):
+    """ Hold one run's results against another's.  Returns [(case, old
+    p50, new p50, ratio, regressed)] for the cases in both, where regressed
+    means the median got more than tolerance slower, or the case started
+    making more queries.
+    """
+    rows = []
+    for name in sorted(set(old['cases']) & set(new['cases'])):
+        before, after = old['cases'][name], new['cases'][name]
+        ratio = after['p50_ms'] / max(before['p50_ms'], 0.001)
+        regressed = ratio > 1 + tolerance or \
+            after['queries'] > before['queries']
+        rows.append((name, before['p50_ms'], after['p50_ms'], ratio,
+                     regressed))
+    return rows
@@ -0,0 +1,295 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of rendered info bubbles
+
+Bubbles are stored under "<model>:<pk>" along with the modified time of the
+object they were rendered from; a lookup with any other modified time is a
+miss.  Saving an object changes its modified time, and changes to the
+relations a bubble shows (company, consumables, media) delete the entries
+that show them.
+
+The backend is chosen by settings.BUBBLE_CACHE_BACKEND, in the style of
+CACHE_BACKEND:
+
+    lru://500                  500 bubbles in local memory, least recently
+                               used thrown out first
+    file:///var/tmp/bubbles    One file per bubble
+    (empty)                    No caching
+"""
+
+import os
+import hashlib
+import collections
+import tempfile
+import datetime
+import threading
+import cPickle as pickle
+
+from django.conf import settings
+from django.db.models import signals
+
+from journal.diary.models import Event, Period, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Entry, MedicalObservation, Media, Book, Music, \
+    Video, Consumable
+from journal.diary.details import PLANS, render
+
+# The relations shown in bubbles, by the model whose bubble shows them.
+RELATIONS = dict((model, plan.relations) for model, plan in PLANS.items()
+                 if plan.relations)
+
+
+class LRUBackend(object):
+    """ Bounded in-memory cache, per process.
+
+    Recency is a queue of (tick, key), newest last.  Using an entry queues
+    it again with a new tick; the place it leaves behind goes stale, and is
+    skipped when evicting, or dropped when the queue is compacted.
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        # {key: (tick, value)}
+        self._entries = {}
+        self._queue = collections.deque()
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def _use(self, key, value):
+        self._tick += 1
+        self._entries[key] = (self._tick, value)
+        self._queue.append((self._tick, key))
+        if len(self._queue) > 2 * self.max_entries + 10:
+            self._queue = collections.deque(sorted(
+                (tick, key) for key, (tick, value) in self._entries.items()))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._use(key, entry[1])
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._use(key, value)
+            while len(self._entries) > self.max_entries:
+                tick, oldest = self._queue.popleft()
+                entry = self._entries.get(oldest)
+                if entry is not None and entry[0] == tick:
+                    del self._entries[oldest]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileBackend(object):
+    """ One pickle per bubble in a directory, shared between processes. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        # Write to a temp file and rename, so readers never see half a bubble.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(os.listdir(self.directory))
+
+
+def get_backend(uri):
+    """ Build a backend from a "scheme://argument" string, or return None
+    if the string is empty.
+    """
+    if not uri:
+        return None
+    scheme, _, argument = uri.partition('://')
+    if scheme == 'lru':
+        return LRUBackend(int(argument or 500))
+    if scheme == 'file':
+        return FileBackend(argument)
+    raise ValueError("Unknown bubble cache backend '{0}'".format(uri))
+
+
+backend = get_backend(getattr(settings, 'BUBBLE_CACHE_BACKEND', ''))
+
+stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(stat):
+    with _stats_lock:
+        stats[stat] += 1
+
+
+def _key(model_type, pk):
+    return '{0}:{1}'.format(model_type, pk)
+
+
+def lookup(model_type, pk, modified):
+    """ Return the cached bubble for the object if it was rendered at the
+    given modified time, otherwise None.
+    """
+    if backend is None:
+        return None
+    value = backend.get(_key(model_type, pk))
+    if value is not None and value[0] == modified:
+        _count('hits')
+        return value[1]
+    _count('misses')
+    return None
+
+
+def store(model_type, pk, modified, html):
+    if backend is not None:
+        backend.set(_key(model_type, pk), (modified, html))
+
+
+def render_many(model_class, pks):
+    """ Return {pk: bubble} for the objects of model_class with the given
+    pks.  Bubbles in the cache at the objects' modified times are used;
+    the rest are rendered together, with the model's DetailPlan, and
+    stored.  So a batch costs one query for the modified times, plus the
+    plan's queries if anything missed.  Missing objects are left out.
+    """
+    model_type = model_class.__name__
+    modified = dict(model_class.objects.filter(pk__in=list(pks)).
+                    values_list('pk', 'modified'))
+    bubbles = {}
+    for pk, when in modified.items():
+        html = lookup(model_type, pk, when)
+        if html:
+            bubbles[pk] = html
+    missed = [pk for pk in modified if pk not in bubbles]
+    if missed:
+        for pk, html in render(model_class, missed).items():
+            store(model_type, pk, modified[pk], html)
+            bubbles[pk] = html
+    return bubbles
+
+
+def invalidate(model_class, pks):
+    """ Drop the bubbles for the given objects, under every name they can be
+    requested by (a BikeRide is also an Activity).
+    """
+    if backend is None:
+        return
+    names = [cls.__name__ for cls in model_class.__mro__
+             if hasattr(cls, 'as_timeline_dict') and hasattr(cls, '_meta')]
+    for pk in pks:
+        for name in names:
+            backend.delete(_key(name, pk))
+        _count('invalidations')
+
+
+def metrics():
+    """ Return the counters in Prometheus text format. """
+    lines = []
+    for stat in sorted(stats):
+        name = 'journal_bubble_cache_{0}_total'.format(stat)
+        lines.append('# TYPE {0} counter'.format(name))
+        lines.append('{0} {1}'.format(name, stats[stat]))
+    lines.append('# TYPE journal_bubble_cache_entries gauge')
+    lines.append('journal_bubble_cache_entries {0}'.format(
+        backend is not None and len(backend) or 0))
+    return '\n'.join(lines) + '\n'
+
+
+def _touch(model_class, pks):
+    """ A change to an object's relations is a change to the object; bump
+    its modified time so the ETag moves too, and drop its bubble.
+    """
+    pks = list(pks)
+    model_class.objects.filter(pk__in=pks).update(
+        modified=datetime.datetime.now())
+    invalidate(model_class, pks)
+
+
+def _changed(sender, instance, **kwargs):
+    invalidate(sender, [instance.pk])
+
+
+def _related_changed(sender, instance, **kwargs):
+    """ A Person, Media or Consumable changed; drop the bubbles showing it.
+    Hooked to pre_delete as well, while the links still exist.
+    """
+    for owner, fields in RELATIONS.items():
+        for field_name in fields:
+            field = owner._meta.get_field(field_name)
+            if isinstance(instance, field.rel.to):
+                pks = owner.objects.filter(**{field_name: instance.pk}).\
+                    values_list('pk', flat=True)
+                invalidate(owner, pks)
+
+
+def _m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        _touch(instance.__class__, [instance.pk])
+    elif pk_set:
+        _touch(model, pk_set)
+    else:
+        # Reverse clear: find the owners through the field that uses sender.
+        for field in model._meta.many_to_many:
+            if field.rel.through is sender:
+                _touch(model, model.objects.filter(**{field.name: instance.pk}).
+                       values_list('pk', flat=True))
+
+
+for _sender in (Event, Period, Person, Activity, BikeRide, SocialEvent,
+                DiningOut, Entry, MedicalObservation):
+    signals.post_save.connect(_changed, sender=_sender,
+        dispatch_uid='bubblecache-save-{0}'.format(_sender.__name__))
+    signals.post_delete.connect(_changed, sender=_sender,
+        dispatch_uid='bubblecache-delete-{0}'.format(_sender.__name__))
+for _owner, _fields in RELATIONS.items():
+    for _field_name in _fields:
+        _through = getattr(_owner, _field_name).through
+        signals.m2m_changed.connect(_m2m_changed, sender=_through,
+            dispatch_uid='bubblecache-m2m-{0}-{1}'.format(_owner.__name__,
+                                                          _field_name))
+for _sender in (Person, Media, Book, Music, Video, Consumable):
+    signals.post_save.connect(_related_changed, sender=_sender,
+        dispatch_uid='bubblecache-related-save-{0}'.format(_sender.__name__))
+    signals.pre_delete.connect(_related_changed, sender=_sender,
+        dispatch_uid='bubblecache-related-delete-{0}'.format(_sender.__name__))
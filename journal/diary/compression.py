@@ -0,0 +1,173 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compressed responses
+
+Feed bodies that are streamed (see timeline.iter_feed) are compressed as
+they go, a piece at a time, so memory use doesn't grow with the feed.
+Smaller bodies are compressed once per validator and kept in the cache, so
+they're never compressed twice.  Static files are
+compressed ahead of time by the precompress_static command, which also
+writes content-hashed copies that can be cached forever; the manifest it
+leaves behind maps each file to its hashed name.
+
+Brotli is used when the brotli module is installed and the client asks for
+it, otherwise gzip.
+"""
+
+import os
+import json
+import zlib
+import mimetypes
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views.static import serve
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Best first.
+ENCODINGS = brotli and ('br', 'gzip') or ('gzip',)
+
+# What precompressed copies of files are called.
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Extensions (the only ones) worth compressing.
+COMPRESSIBLE = ('.js', '.css', '.html', '.txt', '.json')
+
+# Where precompress_static records the hashed name of each file.
+MANIFEST = os.path.join(settings.MEDIA_ROOT, 'manifest.json')
+
+# How long clients may keep content-hashed static files.
+FAR_FUTURE = 365 * 24 * 60 * 60
+
+# How long to keep compressed feeds in the cache.  Keys include the
+# validator, so they never go stale, they just stop being asked for.
+FEED_TIMEOUT = 24 * 60 * 60
+
+
+def negotiate(request):
+    """ Return the best encoding the client accepts, or None. """
+    accepted = [value.split(';')[0].strip() for value in
+                request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def variant_etag(request, etag):
+    """ Return the ETag of the copy of a response the client will get: the
+    compressed copies' are suffixed with their encoding, so a cache holding
+    one can't hand it to a client that asked for another.
+    """
+    encoding = negotiate(request)
+    if etag and encoding:
+        return '{0}-{1}'.format(etag, encoding)
+    return etag
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data)
+    # zlib leaves the gzip header's mtime zero, which keeps the output (and
+    # so the file hashes) stable.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compress(chunks, encoding):
+    """ Compress an iterable of strings as it goes. """
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress_chunk, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compressed_response(request, etag, content, mimetype, whole=False):
+    """ Return a response for content (a string or iterable of strings),
+    compressed if the client accepts it.
+
+    An iterable is streamed, compressed a piece at a time, unless whole is
+    set to say it's small enough to hold in memory.  Strings, and iterables
+    marked whole, are cached compressed under the etag (if there is one),
+    so the iterable is only consumed on a cache miss.
+    """
+    encoding = negotiate(request)
+    if encoding is None:
+        response = HttpResponse(content, mimetype=mimetype)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    if isinstance(content, basestring) or whole:
+        key = 'compressed:{0}:{1}'.format(encoding, etag)
+        body = etag and cache.get(key)
+        if body is None:
+            body = compress(''.join(content), encoding)
+            if etag:
+                cache.set(key, body, FEED_TIMEOUT)
+    else:
+        body = iter_compress(content, encoding)
+    response = HttpResponse(body, mimetype=mimetype)
+    response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+_manifest = None
+
+def manifest():
+    """ Return the {path: hashed path} map written by precompress_static,
+    read once per process.
+    """
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST) as f:
+                _manifest = json.load(f)
+        except IOError:
+            _manifest = {}
+    return _manifest
+
+
+def serve_static(request, path, document_root=None, show_indexes=False):
+    """ Like django.views.static.serve, but sends the precompressed copy of
+    a file when there is one, and lets clients keep hashed files forever.
+    """
+    encoding = negotiate(request)
+    suffix = SUFFIXES.get(encoding)
+    if suffix and os.path.exists(os.path.join(document_root, path + suffix)):
+        response = serve(request, path + suffix, document_root)
+        response['Content-Type'] = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        response['Content-Encoding'] = encoding
+    else:
+        response = serve(request, path, document_root, show_indexes)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if path in manifest().values():
+        response['Cache-Control'] = 'public, max-age={0}'.format(FAR_FUTURE)
+    return response
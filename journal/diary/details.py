@@ -0,0 +1,92 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Query plans for rendering info bubbles
+
+The detail templates show each object's company, consumables and media.
+Letting the templates walk obj.company.all and friends costs a query per
+relation per object, so instead each model has a DetailPlan that loads a
+batch of objects in one query and each relation for the whole batch in one
+more, handing the results to the template as context.
+"""
+
+from django.template.loader import render_to_string
+
+from journal.diary.models import Entry, SocialEvent, DiningOut
+
+
+class DetailPlan(object):
+    """ How to load a model's bubbles in a fixed number of queries: one for
+    the objects, plus one per relation the bubble shows.
+    """
+
+    def __init__(self, model, relations=()):
+        self.model = model
+        self.relations = relations
+
+    def load(self, pks):
+        """ Return {pk: template context} for the objects with the given
+        pks.  Missing objects are left out.
+        """
+        objs = self.model.objects.in_bulk(list(pks))
+        contexts = dict((pk, dict(obj=obj)) for pk, obj in objs.items())
+        for field_name in self.relations:
+            related = self._load_relation(field_name, objs.keys())
+            for pk, context in contexts.items():
+                context[field_name] = related.get(pk, [])
+        return contexts
+
+    def _load_relation(self, field_name, pks):
+        """ Return {pk: [related objects]} for an M2M relation, read from
+        the through table in a single query.
+        """
+        related = {}
+        if not pks:
+            return related
+        field = self.model._meta.get_field(field_name)
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        # Keep the related model's own ordering.
+        ordering = []
+        for order in field.rel.to._meta.ordering:
+            direction = order.startswith('-') and '-' or ''
+            ordering.append('{0}{1}__{2}'.format(direction, target,
+                                                 order.lstrip('-')))
+        links = field.rel.through.objects.\
+            filter(**{'{0}__in'.format(source): pks}).\
+            select_related(target).order_by(*ordering)
+        for link in links:
+            related.setdefault(getattr(link, '{0}_id'.format(source)), []).\
+                append(getattr(link, target))
+        return related
+
+
+PLANS = dict((plan.model, plan) for plan in (
+    DetailPlan(Entry, ('media', 'consumables')),
+    DetailPlan(SocialEvent, ('company',)),
+    DetailPlan(DiningOut, ('company', 'consumables')),
+))
+
+
+def plan_for(model_class):
+    return PLANS.get(model_class) or DetailPlan(model_class)
+
+
+def render(model_class, pks):
+    """ Return {pk: rendered bubble} for the objects with the given pks. """
+    template = 'details/{0}.html'.format(model_class.__name__)
+    return dict((pk, render_to_string(template, context)) for pk, context in
+                plan_for(model_class).load(pks).items())
@@ -0,0 +1,251 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Synthetic journals
+
+Builds a journal of any size for benchmarking: people, consumables, books,
+music & video, diary entries, rides, social events, dinners, other
+activities, medical observations, events and periods, spread over the
+years before today, with the company, consumables and media links between
+them.  The mix is roughly that of a real journal (mostly entries and
+rides), and a seed makes it repeatable.
+
+Rows are written with the import pipeline (diary.importer), so a million
+of them take minutes rather than hours, and the timeline, search index and
+rollups are brought up to date for them afterwards.
+"""
+
+import random
+import decimal
+import datetime
+
+from django.contrib.auth.models import User
+
+from journal.diary.models import Entry, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Consumable, Book, Music, Video, \
+    MedicalObservation, Event, Period
+from journal.diary import importer
+
+# (model, share of the rows), in the order they're written; things that are
+# linked to come before the things linking to them.
+MIX = ((Person, 3), (Consumable, 3), (Book, 2), (Music, 2), (Video, 1),
+       (Entry, 35), (BikeRide, 20), (SocialEvent, 8), (DiningOut, 8),
+       (Activity, 6), (MedicalObservation, 6), (Event, 5), (Period, 1))
+
+WORDS = ('morning', 'coffee', 'ride', 'hills', 'rain', 'friends', 'dinner',
+         'work', 'project', 'garden', 'book', 'movie', 'headache', 'tired',
+         'beach', 'coast', 'fog', 'sunny', 'tacos', 'beer', 'wine', 'trail',
+         'city', 'music', 'show', 'late', 'early', 'family', 'call', 'walk',
+         'climb', 'wind', 'market', 'bread', 'cat', 'dog', 'party', 'quiet',
+         'long', 'short', 'flat', 'fast', 'slow', 'new', 'old', 'home')
+FIRST_NAMES = ('Alex', 'Sam', 'Jo', 'Chris', 'Pat', 'Lee', 'Robin', 'Kim',
+               'Dana', 'Casey', 'Morgan', 'Jamie', 'Terry', 'Jess')
+LAST_NAMES = ('Smith', 'Lee', 'Garcia', 'Nguyen', 'Cohen', 'Okafor',
+              'Novak', 'Silva', 'Kowalski', 'Brown', 'Ito', 'Larsen')
+
+
+def plan(rows):
+    """ Return [(model, count)] adding up to about rows, at least one of
+    each.
+    """
+    shares = sum(share for model, share in MIX)
+    return [(model, max(1, rows * share // shares)) for model, share in MIX]
+
+
+def journal_user(username=None):
+    """ The named user, or else the first superuser, or else a new user
+    "journal".
+    """
+    if username:
+        return User.objects.get(username=username)
+    users = User.objects.filter(is_superuser=True).order_by('pk')[:1]
+    return users and users[0] or \
+        User.objects.get_or_create(username='journal')[0]
+
+
+class Generator(object):
+    """ Writes a synthetic journal for user over the given number of
+    years.
+    """
+
+    def __init__(self, user, years=20, seed=1,
+                 chunk_size=importer.CHUNK_SIZE):
+        self.user = user
+        self.rand = random.Random(seed)
+        self.last = datetime.date.today()
+        self.days = years * 365
+        self.chunk_size = chunk_size
+        # Primary keys written so far, for linking.
+        self.people = []
+        self.consumables = []
+        self.media = []
+
+    def run(self, rows, progress=None, derived=True):
+        """ Write about rows objects.  progress, if given, is called with
+        (model, count written) as each model finishes.  Returns
+        {model: count}.
+        """
+        counts = {}
+        for model, count in plan(rows):
+            loader = importer.Importer(model, chunk_size=self.chunk_size)
+            build = getattr(self, '_' + model.__name__.lower())
+            pks = []
+            for start in range(0, count, self.chunk_size):
+                pks.extend(loader.write([
+                    build(model) for i in
+                    range(min(self.chunk_size, count - start))]))
+            if model is Person:
+                self.people.extend(pks)
+            elif model is Consumable:
+                self.consumables.extend(pks)
+            elif model in (Book, Music, Video):
+                self.media.extend(pks)
+            if derived and pks:
+                loader.update_derived(pks[0])
+            counts[model] = len(pks)
+            if progress:
+                progress(model, len(pks))
+        return counts
+
+    # Pieces
+
+    def day(self):
+        return self.last - datetime.timedelta(
+            days=self.rand.randint(0, self.days))
+
+    def words(self, low, high):
+        return ' '.join(self.rand.choice(WORDS)
+                        for i in range(self.rand.randint(low, high)))
+
+    def summary(self):
+        return self.words(2, 6).capitalize()
+
+    def notes(self):
+        if self.rand.random() < 0.3:
+            return ''
+        return self.words(10, 60).capitalize() + '.'
+
+    def some(self, pks, most):
+        if not pks:
+            return []
+        return self.rand.sample(pks, min(len(pks),
+                                         self.rand.randint(0, most)))
+
+    def rating(self):
+        return dict(reality=self.rand.randint(0, 5),
+                    expectation=self.rand.choice((None, 1, 2, 3, 4, 5)))
+
+    def referrer(self):
+        if self.people and self.rand.random() < 0.3:
+            return self.rand.choice(self.people)
+        return None
+
+    # One object of each model, with its links: (object, {field: [pk]})
+
+    def _links(self, model, **links):
+        return dict((model._meta.get_field(name), pks)
+                    for name, pks in links.items())
+
+    def _person(self, model):
+        name = '{0} {1}'.format(self.rand.choice(FIRST_NAMES),
+                                self.rand.choice(LAST_NAMES))
+        return model(name=name, summary=name, notes=self.notes(),
+                     relation=self.rand.choice(Person.RELATIONS)[0],
+                     met=self.day()), {}
+
+    def _consumable(self, model):
+        return model(name=self.summary(), summary=self.summary(),
+                     notes=self.notes(), where=self.words(1, 3),
+                     consumable_type=self.rand.choice(
+                         Consumable.CONSUMABLE_TYPES)[0],
+                     referred_by_id=self.referrer(), **self.rating()), {}
+
+    def _media(self, model, **fields):
+        return model(title=self.summary(), summary=self.summary(),
+                     notes=self.notes(), year=self.rand.randint(1950, 2010),
+                     referred_by_id=self.referrer(),
+                     media_type=model.__name__, **dict(fields, **self.rating()))
+
+    def _book(self, model):
+        return self._media(model, author=self.rand.choice(LAST_NAMES),
+                           book_type=self.rand.choice(Book.BOOK_TYPES)[0],
+                           genre=self.rand.choice(Book.GENRES)[0]), {}
+
+    def _music(self, model):
+        return self._media(model, artist=self.summary(),
+                           source=self.words(1, 2),
+                           genre=self.rand.choice(Music.GENRES)[0]), {}
+
+    def _video(self, model):
+        return self._media(model, video_type=self.rand.choice(
+            Video.VIDEO_TYPES)[0]), {}
+
+    def _entry(self, model):
+        return model(date=self.day(), summary=self.summary(),
+                     notes=self.notes(), user_id=self.user.pk,
+                     mood=self.rand.choice(Entry.MOODS)[0]), \
+            self._links(model, media=self.some(self.media, 2),
+                        consumables=self.some(self.consumables, 2))
+
+    def _new_activity(self, model, **fields):
+        return model(date=self.day(), summary=self.summary(),
+                     notes=self.notes(), private=self.rand.random() < 0.1,
+                     duration=self.rand.choice((None, 1, 2, 3, 5)),
+                     activity_type=model.__name__,
+                     **dict(fields, **self.rating()))
+
+    def _activity(self, model):
+        return self._new_activity(model), {}
+
+    def _bikeride(self, model):
+        distance = self.rand.randint(5, 120)
+        return self._new_activity(
+            model, distance=distance, solo=self.rand.random() < 0.5,
+            climbing=distance * self.rand.randint(0, 150),
+            average_speed=decimal.Decimal('{0:.1f}'.format(
+                self.rand.uniform(9, 22)))), {}
+
+    def _socialevent(self, model):
+        return self._new_activity(model), \
+            self._links(model, company=self.some(self.people, 4))
+
+    def _diningout(self, model):
+        return self._new_activity(model, restaurant=self.summary(),
+                              where=self.words(1, 3)), \
+            self._links(model, company=self.some(self.people, 4),
+                        consumables=self.some(self.consumables, 3))
+
+    def _medicalobservation(self, model):
+        return model(date=self.day(), summary=self.summary(),
+                     notes=self.notes()), {}
+
+    def _event(self, model):
+        time = None
+        if self.rand.random() < 0.5:
+            time = datetime.time(self.rand.randint(0, 23),
+                                 self.rand.choice((0, 15, 30, 45)))
+        return model(date=self.day(), time=time, summary=self.summary(),
+                     notes=self.notes()), {}
+
+    def _period(self, model):
+        start = self.day()
+        end = start + datetime.timedelta(days=self.rand.randint(1, 1000))
+        if self.rand.random() < 0.1:
+            start = None
+        elif self.rand.random() < 0.1 or end > self.last:
+            end = None
+        return model(start_date=start, end_date=end, summary=self.summary(),
+                     notes=self.notes()), {}
@@ -0,0 +1,261 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bulk import
+
+Saving back-filled rows one at a time is slow: every save is an INSERT per
+table (two for Activity & Media subtypes), plus the signal handlers.  The
+Importer validates each row with the model's ModelForm, then writes a chunk
+of rows with one executemany() per table, in one transaction.  Primary
+keys are handed out from the current maximum, so that the parent & child
+rows of a subtype can be written without reading ids back; nothing else
+should be adding rows of the same model while an import runs.
+
+The signal handlers don't see these writes, so once the rows are in, the
+timeline, search index and rollups are brought up to date for them in
+bulk.
+
+After each chunk commits, the number of input rows consumed is written to
+a checkpoint file; an import that dies can be run again and will carry on
+from there.
+"""
+
+import os
+import csv
+import json
+import gzip
+import tempfile
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from journal.diary.models import EntryForm, PersonForm, ActivityForm, \
+    BikeRideForm, SocialEventForm, DiningOutForm, ConsumableForm, MediaForm, \
+    BookForm, MusicForm, VideoForm, MedicalObservationForm, EventForm, \
+    PeriodForm, Period
+from journal.diary import timeline
+from journal.diary import intervals
+from journal.diary import search
+from journal.diary import rollups
+
+FORMS = dict((form._meta.model, form) for form in (
+    EntryForm, PersonForm, ActivityForm, BikeRideForm, SocialEventForm,
+    DiningOutForm, ConsumableForm, MediaForm, BookForm, MusicForm, VideoForm,
+    MedicalObservationForm, EventForm, PeriodForm))
+
+MODELS = dict((model.__name__, model) for model in FORMS)
+
+CHUNK_SIZE = 500
+
+
+def read_rows(path, format=None):
+    """ Iterate over the rows of a CSV file (with a header line) or a file
+    of JSON objects, one per line, as dicts.  Files ending in .gz are
+    decompressed on the fly.  The format is guessed from the name unless
+    given.
+    """
+    name = path
+    opener = open
+    if name.endswith('.gz'):
+        name = name[:-3]
+        opener = gzip.open
+    format = format or (name.endswith('.csv') and 'csv' or 'json')
+    f = opener(path, 'rb')
+    try:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield dict((key, value.decode('utf-8'))
+                           for key, value in row.items() if value is not None)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        f.close()
+
+
+def _tables(model):
+    """ The concrete models whose tables hold a model's rows, root first. """
+    tables = [model]
+    while tables[0]._meta.parents:
+        tables.insert(0, tables[0]._meta.parents.keys()[0])
+    return tables
+
+
+class Importer(object):
+    """ Validates and writes rows of one model. """
+
+    def __init__(self, model, defaults=None, chunk_size=CHUNK_SIZE):
+        self.model = model
+        self.form_class = FORMS[model]
+        self.defaults = defaults or {}
+        self.chunk_size = chunk_size
+        self.tables = _tables(model)
+        self.m2m_fields = model._meta.many_to_many
+        # [(row number, form errors)]
+        self.invalid = []
+
+    def form(self, row):
+        """ Return a bound form for a row.  Relations are optional here,
+        even where the admin insists on them; old data often has none.
+        """
+        data = dict(self.defaults)
+        for key, value in row.items():
+            if value is not None:
+                data[key] = value
+        if hasattr(self.model, 'subtype_field'):
+            data[self.model.subtype_field] = self.model.__name__
+        for field in self.m2m_fields:
+            value = data.get(field.name)
+            if isinstance(value, basestring):
+                data[field.name] = value.replace(',', ' ').split()
+        form = self.form_class(data)
+        for field in self.m2m_fields:
+            form.fields[field.name].required = False
+        return form
+
+    def validate(self, numbered_rows):
+        """ Return [(instance, {m2m field: [related]})] for the valid rows,
+        noting the invalid ones in self.invalid.
+        """
+        valid = []
+        for number, row in numbered_rows:
+            form = self.form(row)
+            if form.is_valid():
+                related = dict((field, form.cleaned_data.get(field.name) or [])
+                               for field in self.m2m_fields)
+                valid.append((form.save(commit=False), related))
+            else:
+                self.invalid.append((number, form.errors))
+        return valid
+
+    @transaction.commit_on_success
+    def write(self, valid):
+        """ Insert the validated objects and their relations (related
+        objects, or their primary keys, by field; fields left out have no
+        links), one executemany() per table.  Returns the objects' primary
+        keys.
+        """
+        if not valid:
+            return []
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        root = self.tables[0]
+        next_pk = (root.objects.aggregate(top=Max('pk'))['top'] or 0) + 1
+        pks = range(next_pk, next_pk + len(valid))
+        for pk, (obj, related) in zip(pks, valid):
+            for model in self.tables:
+                setattr(obj, model._meta.pk.attname, pk)
+
+        for model in self.tables:
+            fields = model._meta.local_fields
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                qn(model._meta.db_table),
+                ', '.join(qn(field.column) for field in fields),
+                ', '.join(['%s'] * len(fields)))
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(field.pre_save(obj, True),
+                                        connection=connection)
+                 for field in fields]
+                for obj, related in valid])
+
+        for field in self.m2m_fields:
+            sql = 'INSERT INTO {0} ({1}, {2}) VALUES (%s, %s)'.format(
+                qn(field.m2m_db_table()), qn(field.m2m_column_name()),
+                qn(field.m2m_reverse_name()))
+            links = [(obj.pk, getattr(other, 'pk', other))
+                     for obj, related in valid
+                     for other in related.get(field, ())]
+            if links:
+                cursor.executemany(sql, links)
+        transaction.set_dirty()
+        return pks
+
+    def run(self, rows, checkpoint=None, progress=None):
+        """ Import an iterable of row dicts, a chunk per transaction.
+
+        If a Checkpoint is given, rows it records as done are skipped, and
+        it's updated after each chunk commits.  progress, if given, is
+        called with the number of rows handled so far after each chunk.
+        Returns the number of rows written.
+        """
+        skip = checkpoint and checkpoint.rows or 0
+        written = 0
+        chunk = []
+        for number, row in enumerate(rows):
+            if number < skip:
+                continue
+            chunk.append((number + 1, row))
+            if len(chunk) == self.chunk_size:
+                written += self._chunk(chunk, checkpoint, progress)
+                chunk = []
+        if chunk:
+            written += self._chunk(chunk, checkpoint, progress)
+        return written
+
+    def _chunk(self, chunk, checkpoint, progress):
+        pks = self.write(self.validate(chunk))
+        done = chunk[-1][0]
+        if checkpoint:
+            if pks and checkpoint.first_pk is None:
+                checkpoint.first_pk = pks[0]
+            checkpoint.rows = done
+            checkpoint.save()
+        if progress:
+            progress(done)
+        return len(pks)
+
+    def update_derived(self, first_pk):
+        """ Bring the timeline, search index and rollups up to date for the
+        imported objects: everything from first_pk on.
+        """
+        pks = list(self.model.objects.filter(pk__gte=first_pk).
+                   values_list('pk', flat=True))
+        if self.model is Period:
+            # The inserts skipped the signals that keep the tree current.
+            intervals.reset()
+        timeline.store_events(self.model, pks)
+        search.index_many(self.model, pks)
+        rollups.refresh_objects(self.model, pks)
+        return len(pks)
+
+
+class Checkpoint(object):
+    """ How far an import got: the number of input rows done, and the first
+    primary key it wrote.  Saved as JSON, by writing a temp file and
+    renaming it over the old one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.first_pk = None
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.rows = state['rows']
+            self.first_pk = state['first_pk']
+
+    def save(self):
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(rows=self.rows, first_pk=self.first_pk), f)
+        os.rename(temp_path, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
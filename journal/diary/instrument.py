@@ -0,0 +1,268 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Instrumentation
+
+Off unless settings.INSTRUMENTATION is "1", "true", "yes" or "on".  While
+it's off nothing is measured: timed() hands back the function it was given,
+timer() a context manager that does nothing, and InstrumentationMiddleware
+takes itself out of the middleware chain.
+
+When it's on, these histograms are kept per process and added to /metrics/
+in Prometheus' text format:
+
+    journal_view_seconds{view}          Time in each view, up to the
+                                        response (not streaming it out)
+    journal_view_queries{view}          Queries per request
+    journal_template_seconds{template}  Time rendering each template
+    journal_serialise_seconds{what}     Building & encoding timeline events
+                                        and JSON responses
+
+Staff can profile a request by adding profile=1 to its query string or
+sending an "X-Profile: 1" header: the view runs under cProfile and the
+response is the profile, heaviest cumulative time first (or sorted by
+profile_sort, e.g. profile_sort=time), instead of the page.
+"""
+
+import time
+import bisect
+import cProfile
+import pstats
+import functools
+import threading
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse
+
+ENABLED = str(getattr(settings, 'INSTRUMENTATION', '')).lower() in \
+    ('1', 'true', 'yes', 'on')
+
+# Upper bounds of the buckets, in seconds or queries.
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10)
+QUERIES = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Lines of profile to show.
+PROFILE_LINES = 60
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+
+class Histogram(object):
+    """ Counts of observations by bucket, per set of labels. """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # {sorted label items: [count per bucket (the last for +Inf), sum]}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def timer(self, **labels):
+        """ A context manager adding the time spent in it. """
+        if not ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """ A decorator adding the time spent in each call. """
+        def decorate(function):
+            if not ENABLED:
+                return function
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with _Timer(self, labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def lines(self):
+        """ The histogram in Prometheus text format, as a list of lines. """
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((key, list(counts))
+                            for key, counts in self._series.items())
+        for key, counts in series:
+            labels = ['{0}="{1}"'.format(name, _escape(value))
+                      for name, value in key]
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('{0}_bucket{{{1}}} {2}'.format(
+                    self.name, ','.join(labels + ['le="{0}"'.format(bound)]),
+                    total))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                self.name, ','.join(labels), counts[-1]))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                self.name, ','.join(labels), total))
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+        replace('\n', '\\n')
+
+
+VIEW_SECONDS = Histogram('journal_view_seconds',
+                         'Seconds in each view.', SECONDS)
+VIEW_QUERIES = Histogram('journal_view_queries',
+                         'Database queries per request.', QUERIES)
+TEMPLATE_SECONDS = Histogram('journal_template_seconds',
+                             'Seconds rendering each template.', SECONDS)
+SERIALISE_SECONDS = Histogram('journal_serialise_seconds',
+                              'Seconds building & encoding events and JSON.',
+                              SECONDS)
+HISTOGRAMS = (VIEW_SECONDS, VIEW_QUERIES, TEMPLATE_SECONDS, SERIALISE_SECONDS)
+
+
+def metrics():
+    """ Return the histograms in Prometheus text format, or '' when
+    instrumentation is off.
+    """
+    if not ENABLED:
+        return ''
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.lines())
+    return '\n'.join(lines) + '\n'
+
+
+def _queries():
+    """ Queries made by this thread so far, over all the databases. """
+    from journal.middleware import tally
+    return sum(tally(connection).total_queries
+               for connection in connections.all())
+
+
+_templates_timed = False
+
+
+def _time_templates():
+    """ Wrap Template.render, once, to time every template. """
+    global _templates_timed
+    if _templates_timed:
+        return
+    from django.template import Template
+    render = Template.render
+
+    def timed_render(self, context):
+        with _Timer(TEMPLATE_SECONDS, {'template': self.name}):
+            return render(self, context)
+    Template.render = timed_render
+    _templates_timed = True
+
+
+class InstrumentationMiddleware(object):
+    """ Times views, counts their queries, and profiles on request.  Should
+    come after AuthenticationMiddleware, which profiling needs.
+    """
+
+    def __init__(self):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+        _time_templates()
+
+    def process_request(self, request):
+        request.instrument = (time.time(), _queries(), 'unresolved')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not hasattr(request, 'instrument'):
+            return None
+        started, queries, view = request.instrument
+        view = '{0}.{1}'.format(view_func.__module__,
+                                getattr(view_func, '__name__', 'view'))
+        request.instrument = (started, queries, view)
+        if (request.GET.get('profile') or
+                request.META.get('HTTP_X_PROFILE')) and \
+                request.user.is_staff:
+            # Not counted in the histograms.
+            del request.instrument
+            return self.profile(request, view, view_func, view_args,
+                                view_kwargs)
+        return None
+
+    def profile(self, request, view, view_func, view_args, view_kwargs):
+        def run():
+            response = view_func(request, *view_args, **view_kwargs)
+            # Streamed responses do their work here.
+            return response.content
+        queries = _queries()
+        profiler = cProfile.Profile()
+        started = time.time()
+        profiler.runcall(run)
+        elapsed = time.time() - started
+        out = StringIO()
+        out.write('{0} {1}: {2:.3f}s, {3} queries\n\n'.format(
+            view, request.get_full_path(), elapsed, _queries() - queries))
+        stats = pstats.Stats(profiler, stream=out)
+        try:
+            stats.sort_stats(request.GET.get('profile_sort', 'cumulative'))
+        except KeyError:
+            stats.sort_stats('cumulative')
+        stats.print_stats(PROFILE_LINES)
+        response = HttpResponse(out.getvalue(), mimetype='text/plain')
+        response['Cache-Control'] = 'no-cache, private'
+        return response
+
+    def process_response(self, request, response):
+        if hasattr(request, 'instrument'):
+            started, queries, view = request.instrument
+            del request.instrument
+            VIEW_SECONDS.observe(time.time() - started, view=view)
+            VIEW_QUERIES.observe(_queries() - queries, view=view)
+        return response
@@ -0,0 +1,176 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Interval tree for Periods
+
+"Which periods overlap this window" is a two-sided test (starts before the
+window ends, ends after it starts) that no single index answers well; the
+database ends up reading every period on one side of the window.  Everything
+else on the timeline is a single day, which an index on the date handles.
+So the periods are kept here, in a centered interval tree answering overlap
+queries in O(log n + matches), built from the Period table with open ends
+bookended by YEAR_ZERO & YEAR_INFINITY.
+
+The tree is rebuilt when the periods' validator moves on: the number of
+periods and the newest modified time, which catch changes made by other
+processes and by writes that skip the signals (bulk inserts, restores),
+plus a generation token kept in Django's cache, which saving or deleting a
+Period changes, so that edits landing within the same second still count.
+Checking costs one aggregate query.
+"""
+
+import bisect
+import datetime
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Max, Count
+from django.db.models import signals
+
+from journal.diary.models import Period, YEAR_ZERO, YEAR_INFINITY
+
+BEGINNING = datetime.datetime.strptime(YEAR_ZERO, '%Y-%m-%d').date()
+END = datetime.datetime.strptime(YEAR_INFINITY, '%Y-%m-%d').date()
+
+
+class _Node(object):
+
+    def __init__(self, center, here, left, right):
+        self.center = center
+        by_start = sorted(here, key=lambda interval: interval[0])
+        self.starts = [start for start, end, key in by_start]
+        self.start_keys = [key for start, end, key in by_start]
+        by_end = sorted(here, key=lambda interval: interval[1])
+        self.ends = [end for start, end, key in by_end]
+        self.end_keys = [key for start, end, key in by_end]
+        self.left = left
+        self.right = right
+
+
+class IntervalTree(object):
+    """ Immutable set of (start, end, key) intervals, ends inclusive. """
+
+    def __init__(self, intervals):
+        intervals = list(intervals)
+        self.size = len(intervals)
+        self._root = self._build(intervals)
+
+    def __len__(self):
+        return self.size
+
+    def _build(self, intervals):
+        """ Split the intervals around the median endpoint: those entirely
+        to the left and right go to subtrees, the rest stay in this node.
+        """
+        if not intervals:
+            return None
+        points = sorted(point for start, end, key in intervals
+                        for point in (start, end))
+        center = points[len(points) // 2]
+        left, here, right = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        return _Node(center, here, self._build(left), self._build(right))
+
+    def overlapping(self, start=None, end=None):
+        """ Return the keys of the intervals overlapping start..end.  Either
+        bound may be None, meaning open-ended.
+        """
+        keys = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            if end is not None and end < node.center:
+                # Everything here ends after the window starts; take those
+                # starting before it ends.  Nothing to the right can match.
+                keys.extend(node.start_keys[:bisect.bisect_right(node.starts,
+                                                                  end)])
+                nodes.append(node.left)
+            elif start is not None and start > node.center:
+                keys.extend(node.end_keys[bisect.bisect_left(node.ends,
+                                                             start):])
+                nodes.append(node.right)
+            else:
+                keys.extend(node.start_keys)
+                nodes.append(node.left)
+                nodes.append(node.right)
+        return keys
+
+    def covering(self, day):
+        """ Return the keys of the intervals containing day. """
+        return self.overlapping(day, day)
+
+
+# Past this many keys, an "in" list of them could overrun SQLite's limit of
+# 999 variables in a query; test the overlap in SQL instead.
+MAX_KEYS = 500
+
+# Where the periods' generation is cached, and for how long.
+GENERATION_KEY = 'intervals:generation'
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+# (validator, tree) for the periods, or None until first needed.
+_periods = None
+
+
+def _generation():
+    """ Return the periods' current generation, starting a new one if the
+    cache has lost it.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Another process may get in first; then theirs stands.
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, GENERATION_TIMEOUT)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def periods():
+    """ Return the IntervalTree of Period pks, rebuilt if the periods have
+    changed since it was built.
+    """
+    global _periods
+    stats = Period.objects.aggregate(latest=Max('modified'), count=Count('id'))
+    validator = (_generation(), stats['latest'], stats['count'])
+    current = _periods
+    if current is None or validator[0] is None or current[0] != validator:
+        rows = Period.objects.values_list('pk', 'start_date', 'end_date')
+        current = (validator, IntervalTree(
+            (start or BEGINNING, end or END, pk) for pk, start, end in rows))
+        _periods = current
+    return current[1]
+
+
+def reset(**kwargs):
+    """ Move the periods on to a new generation, so every process's next
+    periods() call rebuilds its tree.
+    """
+    global _periods
+    _periods = None
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, GENERATION_TIMEOUT)
+
+
+signals.post_save.connect(reset, sender=Period,
+                          dispatch_uid='intervals-save-Period')
+signals.post_delete.connect(reset, sender=Period,
+                            dispatch_uid='intervals-delete-Period')
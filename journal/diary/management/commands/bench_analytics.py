@@ -0,0 +1,156 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time the NumPy analytics against the obvious loop over objects.
+
+Builds synthetic rides, entries, dinners & observations in memory (no
+database), then computes the rolling ride distance, the longest riding
+streak and the correlation of mood with distance ridden, both ways.  Checks
+that the answers agree and prints the timings; the NumPy side is timed
+separately for building the arrays and for the analysis itself.
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import time
+import random
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary import analytics
+
+
+class Row(object):
+    """ Stands in for a model instance. """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def synthesize(count, seed):
+    """ Return count rows spread over ten years, a quarter of each kind. """
+    rand = random.Random(seed)
+    first = datetime.date(2000, 1, 1)
+    moods = sorted(analytics.MOOD_SCORES)
+    rows = dict(rides=[], entries=[], dining=[], medical=[])
+    for i in range(count):
+        day = first + datetime.timedelta(days=rand.randint(0, 3650))
+        kind = i % 4
+        if kind == 0:
+            rows['rides'].append(Row(date=day, distance=rand.randint(5, 100),
+                                     climbing=rand.randint(0, 5000)))
+        elif kind == 1:
+            rows['entries'].append(Row(date=day, mood=rand.choice(moods)))
+        elif kind == 2:
+            rows['dining'].append(Row(date=day))
+        else:
+            rows['medical'].append(Row(date=day))
+    return rows
+
+
+def naive(rows, window):
+    """ The analysis done one object at a time. """
+    distance = {}
+    for ride in rows['rides']:
+        distance[ride.date] = distance.get(ride.date, 0) + ride.distance
+    moods = {}
+    for entry in rows['entries']:
+        moods.setdefault(entry.date, []).append(
+            analytics.MOOD_SCORES[entry.mood])
+    every = [row.date for kind in rows.values() for row in kind]
+    first, last = min(every), max(every)
+    days = [first + datetime.timedelta(days=i)
+            for i in range((last - first).days + 1)]
+
+    rolling = []
+    for day in days:
+        total = 0
+        for back in range(window):
+            total += distance.get(day - datetime.timedelta(days=back), 0)
+        rolling.append(total)
+
+    longest = run = 0
+    for day in days:
+        run = day in distance and run + 1 or 0
+        longest = max(longest, run)
+
+    pairs = [(distance.get(day, 0), sum(moods[day]) / float(len(moods[day])))
+             for day in days if day in moods]
+    n = float(len(pairs))
+    mean_x = sum(x for x, y in pairs) / n
+    mean_y = sum(y for x, y in pairs) / n
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in pairs)
+    var_x = sum((x - mean_x) ** 2 for x, y in pairs)
+    var_y = sum((y - mean_y) ** 2 for x, y in pairs)
+    return rolling, longest, cov / (var_x * var_y) ** 0.5
+
+
+def load(rows):
+    """ Build a Diary from values_list style tuples. """
+    return analytics.Diary.from_rows(
+        rides=[(r.date, r.distance, r.climbing) for r in rows['rides']],
+        entries=[(r.date, r.mood) for r in rows['entries']],
+        dining=[r.date for r in rows['dining']],
+        medical=[r.date for r in rows['medical']])
+
+
+def vectorised(diary, window):
+    """ The same analysis with arrays. """
+    rolling = analytics.rolling_sum(diary['ride.distance'], window)
+    start, longest = analytics.longest_streak(diary['ride.count'] > 0)
+    return list(rolling), longest, analytics.correlation(
+        diary['ride.distance'], diary['mood'])
+
+
+class Command(BaseCommand):
+    help = ("Compare the NumPy analytics with a loop over objects, on "
+            "synthetic data.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', dest='rows', default=100000,
+                    help='How many synthetic rows to build (default 100000).'),
+        make_option('--window', type='int', dest='window', default=30,
+                    help='Rolling window in days (default 30).'),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Random seed.'),
+    )
+
+    def handle(self, *args, **options):
+        rows = synthesize(options['rows'], options['seed'])
+        window = options['window']
+        timings = []
+
+        def timed(name, function, *args):
+            began = time.time()
+            result = function(*args)
+            timings.append(time.time() - began)
+            print "{0:>15}: {1:.3f}s".format(name, timings[-1])
+            return result
+
+        slow = timed('naive', naive, rows, window)
+        diary = timed('numpy load', load, rows)
+        fast = timed('numpy analysis', vectorised, diary, window)
+        if fast[0] != slow[0] or fast[1] != slow[1] or \
+                abs(fast[2] - slow[2]) > 1e-9:
+            raise CommandError("The answers differ: naive {0!r}, numpy "
+                               "{1!r}".format(slow[1:], fast[1:]))
+        print "Speedup over {0} rows: {1:.1f}x including the load, " \
+            "{2:.1f}x for the analysis alone".format(
+                options['rows'], timings[0] / (timings[1] + timings[2]),
+                timings[0] / timings[2])
@@ -0,0 +1,119 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark the timeline feeds, bubbles, admin & event encoding.
+
+    ./manage.py bench_journal --rows 100000 --output after.json
+    ./manage.py bench_journal --rows 100000 --compare before.json
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import sys
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from journal.diary import benchmark
+from journal.diary import generator
+
+
+class Command(BaseCommand):
+    help = ("Build a synthetic journal of --rows rows in a scratch test "
+            "database (or use the real one, with --existing), time the hot "
+            "paths on it, and write the results as JSON.  With --compare, "
+            "fail if any case got slower than an earlier run.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', dest='rows', default=10000,
+                    help='Size of the synthetic journal (default 10000).'),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Random seed.'),
+        make_option('--existing', action='store_true', dest='existing',
+                    default=False,
+                    help="Run on the configured database as it is."),
+        make_option('--iterations', type='int', dest='iterations',
+                    default=20, help='Runs per case (default 20).'),
+        make_option('--only', action='append', dest='only', default=[],
+                    metavar='PREFIX',
+                    help='Only the cases starting with PREFIX, e.g. '
+                    '"admin"; may be repeated.'),
+        make_option('--output', dest='output',
+                    help='Write the results here rather than to stdout.'),
+        make_option('--compare', dest='compare', metavar='FILE',
+                    help='Results of an earlier run to compare with.'),
+        make_option('--tolerance', type='float', dest='tolerance',
+                    default=0.2,
+                    help='How much slower a median may get before --compare '
+                    'fails (default 0.2, i.e. 20%).'),
+    )
+
+    def handle(self, *args, **options):
+        old = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                old = json.load(f)
+
+        if options['existing']:
+            results = self.bench(options)
+        else:
+            name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0,
+                                               autoclobber=True)
+            try:
+                started = time.time()
+                generator.Generator(benchmark.benchmark_user(), 20,
+                                    options['seed']).run(options['rows'])
+                sys.stderr.write("Generated {0} rows in {1:.0f}s\n".format(
+                    options['rows'], time.time() - started))
+                results = self.bench(options)
+            finally:
+                connection.creation.destroy_test_db(name, verbosity=0)
+
+        text = json.dumps(results, indent=1, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+        else:
+            print text
+
+        if old is not None:
+            rows = benchmark.compare(old, results, options['tolerance'])
+            for case, before, after, ratio, regressed in rows:
+                sys.stderr.write("{0:<40} {1:9.1f}ms {2:9.1f}ms {3:6.2f}x"
+                                 "{4}\n".format(case, before, after, ratio,
+                                                regressed and ' SLOWER' or
+                                                ''))
+            slower = [row[0] for row in rows if row[4]]
+            if slower:
+                raise CommandError("{0} cases got slower: {1}".format(
+                    len(slower), ', '.join(slower)))
+
+    def bench(self, options):
+        def progress(name, result):
+            sys.stderr.write("{0:<40} p50 {1:8.1f}ms  p99 {2:8.1f}ms  "
+                             "{3:5.1f} queries\n".format(
+                                 name, result['p50_ms'], result['p99_ms'],
+                                 result['queries']))
+        results = benchmark.Benchmark(options['iterations'],
+                                      options['seed']).run(options['only'],
+                                                           progress)
+        results['meta']['seed'] = options['seed']
+        return results
@@ -0,0 +1,71 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Write a backup of the journal, whole or incremental.
+
+    ./manage.py export_journal journal.ndjson.gz
+    ./manage.py export_journal --since '2010-10-01 02:00:00' nightly.ndjson.gz
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import sys
+import json
+import datetime
+import itertools
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary import backup
+
+
+class Command(BaseCommand):
+    help = ("Write every row of the journal, or those modified since a "
+            "given time, as newline-delimited JSON.  Gzipped if the file "
+            "name ends in .gz; to stdout if there's no file name.")
+    args = '[file]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', metavar='"YYYY-MM-DD HH:MM:SS"',
+                    help='Only rows modified since then, e.g. the time the '
+                    'last backup was taken.'),
+    )
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since:
+            try:
+                since = datetime.datetime.strptime(since, '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise CommandError("--since must be formatted "
+                                   "'YYYY-MM-DD HH:MM:SS'")
+        lines = backup.iter_lines(since)
+        header = lines.next()
+        taken = json.loads(header)['taken']
+        lines = itertools.chain([header], lines)
+        if args and args[0].endswith('.gz'):
+            lines = backup.iter_gzip(lines)
+        out = args and open(args[0], 'wb') or sys.stdout
+        try:
+            for data in lines:
+                out.write(data)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write("Backup taken at {0}; use that as --since next "
+                         "time.\n".format(taken))
@@ -0,0 +1,85 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fill the database with a synthetic journal, for benchmarking.
+
+    ./manage.py generate_journal 100000
+    ./manage.py generate_journal --seed 2 --years 30 1000000
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary.models import Entry
+from journal.diary import generator
+from journal.diary import importer
+
+
+class Command(BaseCommand):
+    help = ("Write about the given number of synthetic rows: people, media, "
+            "consumables, entries, activities, events & periods, linked to "
+            "each other.  Not for a database holding a real journal.")
+    args = 'rows'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='user',
+                    help='Whose entries they are (default: the first '
+                    'superuser, or a new user "journal").'),
+        make_option('--years', type='int', dest='years', default=20,
+                    help='Spread them over this many years (default 20).'),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Random seed.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=importer.CHUNK_SIZE,
+                    help='Rows per transaction (default {0}).'.format(
+                        importer.CHUNK_SIZE)),
+        make_option('--no-derived', action='store_false', dest='derived',
+                    default=True,
+                    help="Don't update the timeline, search index & "
+                    "statistics; rebuild them later."),
+        make_option('--append', action='store_true', dest='append',
+                    default=False,
+                    help='Add to a journal that already has entries.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            rows = int(args[0])
+        except (IndexError, ValueError):
+            raise CommandError("Give the number of rows to write.")
+        if Entry.objects.exists() and not options['append']:
+            raise CommandError("There are entries already; use --append to "
+                               "add to them.")
+        try:
+            user = generator.journal_user(options['user'])
+        except User.DoesNotExist:
+            raise CommandError("No user '{0}'".format(options['user']))
+        started = time.time()
+
+        def progress(model, count):
+            print "{0}: {1} rows, {2:.0f}s".format(model.__name__, count,
+                                                   time.time() - started)
+        counts = generator.Generator(user, options['years'], options['seed'],
+                                     options['chunk_size']).\
+            run(rows, progress, options['derived'])
+        print "Wrote {0} rows in {1:.0f}s".format(sum(counts.values()),
+                                                  time.time() - started)
@@ -0,0 +1,109 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bulk import rows of one model from CSV or JSON-lines files.
+
+    ./manage.py import_journal BikeRide rides-2008.csv rides-2009.csv
+    ./manage.py import_journal Entry --default user=1 old-diary.json.gz
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary import importer
+
+
+class Command(BaseCommand):
+    help = ("Validate rows with the model's form and insert them in bulk, "
+            "a chunk per transaction.  Run it again after a failure to carry "
+            "on from the last chunk written.")
+    args = 'model file [file ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('csv', 'json'),
+                    help='Input format, if the file names don\'t say.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=importer.CHUNK_SIZE,
+                    help='Rows per transaction (default {0}).'.format(
+                        importer.CHUNK_SIZE)),
+        make_option('--default', action='append', dest='defaults',
+                    default=[], metavar='FIELD=VALUE',
+                    help='A value for rows that lack the field; may be '
+                    'repeated.'),
+        make_option('--restart', action='store_true', dest='restart',
+                    default=False,
+                    help='Ignore any checkpoint and start from the top.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("Give a model and at least one file.")
+        model = importer.MODELS.get(args[0])
+        if model is None:
+            raise CommandError("Unknown model '{0}', expected one of {1}".
+                               format(args[0],
+                                      ', '.join(sorted(importer.MODELS))))
+        try:
+            defaults = dict(default.split('=', 1)
+                            for default in options['defaults'])
+        except ValueError:
+            raise CommandError("Defaults must look like field=value")
+
+        for path in args[1:]:
+            self.import_file(model, path, defaults, options)
+
+    def import_file(self, model, path, defaults, options):
+        checkpoint = importer.Checkpoint(path + '.checkpoint')
+        if options['restart']:
+            checkpoint.delete()
+            checkpoint = importer.Checkpoint(checkpoint.path)
+        elif checkpoint.rows:
+            print "{0}: resuming after row {1}".format(path, checkpoint.rows)
+        loader = importer.Importer(model, defaults, options['chunk_size'])
+        started = time.time()
+        skipped = checkpoint.rows
+
+        def progress(done):
+            elapsed = time.time() - started
+            print "{0}: {1} rows, {2:.0f} rows/sec".format(
+                path, done, (done - skipped) / max(elapsed, 0.001))
+
+        try:
+            written = loader.run(importer.read_rows(path, options['format']),
+                                 checkpoint, progress)
+        except Exception, e:
+            raise CommandError("{0}: {1}\nRows up to {2} are in; run the "
+                               "same command again to carry on.".format(
+                                   path, e, checkpoint.rows))
+        elapsed = time.time() - started
+        for number, errors in loader.invalid:
+            for field, messages in errors.items():
+                print "{0}: row {1}: {2}: {3}".format(path, number, field,
+                                                     ' '.join(messages))
+        print "{0}: wrote {1} rows, skipped {2} invalid, {3:.0f} rows/sec".\
+            format(path, written, len(loader.invalid),
+                   written / max(elapsed, 0.001))
+
+        if checkpoint.first_pk is not None:
+            count = loader.update_derived(checkpoint.first_pk)
+            print "{0}: updated the timeline, search index & statistics for " \
+                "{1} objects".format(path, count)
+        checkpoint.delete()
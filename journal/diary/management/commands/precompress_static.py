@@ -0,0 +1,73 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Write content-hashed, precompressed copies of the static files.
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import os
+import re
+import json
+import hashlib
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from journal.diary import compression
+
+# The names of the copies written by earlier runs, "<name>.<hash>.<ext>".
+HASHED = re.compile(r'\.[0-9a-f]{12}$')
+
+
+class Command(NoArgsCommand):
+    help = ("Copy each static text file to <name>.<hash>.<ext>, write "
+            ".gz (and .br) versions of both, and record the hashed names in "
+            "the manifest used by the static_asset tag.")
+
+    def handle_noargs(self, **options):
+        root = settings.MEDIA_ROOT
+        manifest = {}
+        saved = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                base, ext = os.path.splitext(filename)
+                path = os.path.relpath(os.path.join(dirpath, filename), root)
+                if ext not in compression.COMPRESSIBLE or \
+                        HASHED.search(base) or \
+                        os.path.join(root, path) == compression.MANIFEST:
+                    continue
+                with open(os.path.join(root, path), 'rb') as f:
+                    data = f.read()
+                digest = hashlib.md5(data).hexdigest()[:12]
+                hashed = os.path.join(os.path.dirname(path),
+                                      '{0}.{1}{2}'.format(base, digest, ext))
+                with open(os.path.join(root, hashed), 'wb') as f:
+                    f.write(data)
+                for encoding in compression.ENCODINGS:
+                    packed = compression.compress(data, encoding)
+                    suffix = compression.SUFFIXES[encoding]
+                    for name in (path, hashed):
+                        with open(os.path.join(root, name + suffix), 'wb') as f:
+                            f.write(packed)
+                    if encoding == 'gzip':
+                        saved += len(data) - len(packed)
+                manifest[path] = hashed
+        with open(compression.MANIFEST, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        print "Precompressed {0} files, gzip saves {1} bytes.".format(
+            len(manifest), saved)
@@ -0,0 +1,32 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rebuild the search index from scratch.
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+from django.core.management.base import NoArgsCommand
+
+from journal.diary import search
+
+
+class Command(NoArgsCommand):
+    help = "Throw away the search index and index everything again."
+
+    def handle_noargs(self, **options):
+        print "Indexed {0} objects.".format(search.rebuild())
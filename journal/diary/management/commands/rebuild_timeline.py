@@ -0,0 +1,60 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rebuild (or check) the pre-encoded timeline events.
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary import timeline
+
+
+class Command(BaseCommand):
+    help = ("Re-encode the stored timeline events from the live rows, or "
+            "with --check, report where the store and the rows disagree.")
+    args = '[line_type ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+                    default=False,
+                    help='Only check the store against the live rows.'),
+    )
+
+    def handle(self, *line_types, **options):
+        line_types = line_types or sorted(timeline.LINE_TYPES)
+        for line_type in line_types:
+            if line_type not in timeline.LINE_TYPES:
+                raise CommandError("Unknown line type '{0}'".format(line_type))
+
+        problems = []
+        for line_type in line_types:
+            if options['check']:
+                found = timeline.check(line_type)
+                print "{0}: {1} problems".format(line_type, len(found))
+                problems.extend(found)
+            else:
+                count = timeline.rebuild(line_type)
+                print "{0}: stored {1} events".format(line_type, count)
+        for problem in problems:
+            print problem
+        if problems:
+            raise CommandError("The timeline store is inconsistent, "
+                               "run rebuild_timeline to fix it.")
@@ -0,0 +1,60 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Restore backups written by export_journal.
+
+    ./manage.py restore_journal full.ndjson.gz nightly-1.ndjson.gz ...
+
+Dirk Bergstrom, krid@otisbean.com
+
+@author: krid
+"""
+import gzip
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.diary import backup
+
+
+class Command(BaseCommand):
+    help = ("Restore one or more backups, in the order given, then rebuild "
+            "the timeline, search index & statistics.")
+    args = 'file [file ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--no-rebuild', action='store_false', dest='rebuild',
+                    default=True,
+                    help="Don't rebuild the derived tables afterwards."),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("Give at least one backup file.")
+        for path in paths:
+            opener = path.endswith('.gz') and gzip.open or open
+            f = opener(path, 'rb')
+            try:
+                counts = backup.Restorer().restore(f)
+            except ValueError, e:
+                raise CommandError("{0}: {1}".format(path, e))
+            finally:
+                f.close()
+            for name in sorted(counts):
+                print "{0}: {1} {2}".format(path, counts[name], name)
+        if options['rebuild']:
+            backup.rebuild_derived()
+            print "Rebuilt the timeline, search index & statistics."
@@ -23,6 +23,103 @@ YEAR_ZERO = '1900-01-01'
 YEAR_INFINITY = '2100-01-01'
 INDETERMINATE_TIME = "~"
 
+def date_time_string(dateval, timeval):
+    """ Emit date or date + time depending on which are present. """
+    retval = dateval and dateval.strftime('%Y-%m-%d') or ''
+    if timeval:
+        retval = '{0}{1}{2}'.format(retval, retval and ' ' or '',
+                                    timeval.strftime('%H:%M'))
+        # FIXME Think about timezones...
+    return retval
+
+
+def downcast(base_model, pks):
+    """ Return {pk: instance} for the given pks of a multi-table inheritance
+    base (Activity or Media), each instance being of its most specific type.
+
+    Costs one query to read the type column, then one per subtype present,
+    rather than one per row.  pks may be a queryset, which becomes a
+    subquery rather than a query of its own.
+    """
+    by_type = {}
+    for pk, type_name in base_model.objects.filter(pk__in=pks).\
+            values_list('pk', base_model.subtype_field):
+        by_type.setdefault(type_name, []).append(pk)
+    subtypes = dict((subtype.__name__, subtype)
+                    for subtype in base_model.__subclasses__())
+    objs = {}
+    for type_name, type_pks in by_type.items():
+        model_class = subtypes.get(type_name, base_model)
+        objs.update(model_class.objects.in_bulk(type_pks))
+    return objs
+
+
+class TimelineWindowMixin(object):
+    """ Provides the timeline rendering of a model, and a method to select
+    the instances that fall within a window on the timeline.
+
+    Subclasses name the (indexed) date field the window applies to; models
+    with a date range, like Period, override in_window() and timeline_span().
+
+    The rendering works from a dict of just the timeline_fields, so the feed
+    can be built from values() rows without instantiating any models.
+    """
+
+    timeline_date_field = 'date'
+
+    timeline_fields = ('id', 'date', 'summary')
+
+    # Fields (among timeline_fields) holding the user an event belongs to,
+    # and whether it's private; see diary.timeline.visible().
+    timeline_owner_field = None
+    timeline_private_field = None
+
+    # The many-to-many field holding its Tags, which Bands sort events by.
+    timeline_tags_field = None
+
+    @classmethod
+    def timeline_dict(cls, values):
+        """ Render a dict of timeline_fields for Timeline. """
+        return dict(start=values[cls.timeline_date_field].strftime('%Y-%m-%d'),
+                    durationEvent=False,
+                    title=values['summary'],
+                    classname=cls.__name__,
+                    id=str(values['id']),
+                    )
+
+    @classmethod
+    def timeline_span(cls, values):
+        """ Return the (start, end) dates occupied on the timeline, with open
+        ends bookended by YEAR_ZERO & YEAR_INFINITY.
+        """
+        date = values[cls.timeline_date_field]
+        return date, date
+
+    def timeline_values(self):
+        """ The timeline_fields as values() would give them: foreign keys
+        as ids.
+        """
+        return dict((field, getattr(self, self._meta.get_field(field).attname))
+                    for field in self.timeline_fields)
+
+    def as_timeline_dict(self):
+        return self.timeline_dict(self.timeline_values())
+
+    @classmethod
+    def in_window(cls, start=None, end=None):
+        """ Return a queryset of instances dated between start and end
+        (inclusive).  Either bound may be None, meaning open-ended.
+        """
+        queryset = cls.objects.all()
+        if start:
+            queryset = queryset.filter(
+                **{'{0}__gte'.format(cls.timeline_date_field): start})
+        if end:
+            queryset = queryset.filter(
+                **{'{0}__lte'.format(cls.timeline_date_field): end})
+        return queryset
+
+
 class Timestamped(models.Model):
     """ Abstract mixin for models that have created & modified times. """
 
@@ -71,7 +168,7 @@ class SummaryAndNotes(models.Model):
     notes = models.TextField(blank=True)
 
 
-class Entry(SummaryAndNotes, Timestamped):
+class Entry(SummaryAndNotes, Timestamped, TimelineWindowMixin):
     """ Basic diary entry. """
 
     class Meta:
@@ -110,16 +207,12 @@ class Entry(SummaryAndNotes, Timestamped):
 
     consumables = models.ManyToManyField('Consumable')
 
-    def as_timeline_dict(self):
-        return dict(start=self.date.strftime('%Y-%m-%d'),
-                    durationEvent=False,
-                    title=self.summary,
-                    classname=self.__class__.__name__,
-                    id=str(self.pk),
-                    )
+    timeline_fields = ('id', 'date', 'summary', 'user')
 
+    timeline_owner_field = 'user'
 
-class Person(SummaryAndNotes, Timestamped):
+
+class Person(SummaryAndNotes, Timestamped, TimelineWindowMixin):
     """ A person or group of people. """
 
     class Meta:
@@ -146,16 +239,21 @@ class Person(SummaryAndNotes, Timestamped):
 
     met = models.DateField(db_index=True)
 
-    def as_timeline_dict(self):
-        return dict(start=self.met.strftime('%Y-%m-%d'),
+    timeline_date_field = 'met'
+
+    timeline_fields = ('id', 'met', 'name')
+
+    @classmethod
+    def timeline_dict(cls, values):
+        return dict(start=values['met'].strftime('%Y-%m-%d'),
                     durationEvent=False,
-                    title=self.name,
-                    classname=self.__class__.__name__,
-                    id=str(self.pk),
+                    title=values['name'],
+                    classname=cls.__name__,
+                    id=str(values['id']),
                     )
 
 
-class Activity(Rateable, SummaryAndNotes, Timestamped):
+class Activity(Rateable, SummaryAndNotes, Timestamped, TimelineWindowMixin):
     """ Base class for an activity you took part in. """
 
     ACTIVITY_TYPES = (('BikeRide', 'BikeRide'),
@@ -190,13 +288,23 @@ class Activity(Rateable, SummaryAndNotes, Timestamped):
         self.activity_type = self.__class__.__name__
         super(Activity, self).save(*args, **kwargs)
 
-    def as_timeline_dict(self):
-        return dict(start=self.date.strftime('%Y-%m-%d'),
+    # Everything the timeline needs is in the base table, so the feed never
+    # has to join the subtype tables.
+    timeline_fields = ('id', 'date', 'summary', 'activity_type', 'private')
+
+    timeline_private_field = 'private'
+
+    subtype_field = 'activity_type'
+
+    @classmethod
+    def timeline_dict(cls, values):
+        return dict(start=values['date'].strftime('%Y-%m-%d'),
                     durationEvent=False,
-                    title='{type}: {summary}'.format(type=self.activity_type,
-                                                     summary=self.summary),
-                    classname=self.activity_type,
-                    id=str(self.pk),
+                    title='{type}: {summary}'.format(
+                        type=values['activity_type'],
+                        summary=values['summary']),
+                    classname=values['activity_type'],
+                    id=str(values['id']),
                     )
 
 
@@ -313,6 +421,8 @@ class Media(SummaryAndNotes, Rateable, Timestamped):
 
     media_type = models.CharField(max_length=10, choices=MEDIA_TYPES)
 
+    subtype_field = 'media_type'
+
     def save(self, *args, **kwargs):
         self.media_type = self.__class__.__name__
         super(Media, self).save(*args, **kwargs)
@@ -394,7 +504,7 @@ class Video(Media):
                                   blank=False)
 
 
-class MedicalObservation(SummaryAndNotes, Timestamped):
+class MedicalObservation(SummaryAndNotes, Timestamped, TimelineWindowMixin):
     """ What's going on with your body or mind. """
 
     def __str__(self):
@@ -406,14 +516,6 @@ class MedicalObservation(SummaryAndNotes, Timestamped):
     date = models.DateField(blank=False,
                             db_index=True)
 
-    def as_timeline_dict(self):
-        return dict(start=self.date.strftime('%Y-%m-%d'),
-                    durationEvent=False,
-                    title=self.summary,
-                    classname=self.__class__.__name__,
-                    id=str(self.pk),
-                    )
-
 
 class DateWithOptionalTimeMixin(object):
     """ Provides a method to emit date or date + time depending on the fields
@@ -423,17 +525,28 @@ class DateWithOptionalTimeMixin(object):
     def get_date_time_string(self, field=None):
         # If no field given do "date" and "time", otherwise "<field>_date"...
         field_name = field and '{0}_'.format(field) or ''
-        timeval = getattr(self, '{0}time'.format(field_name))
-        dateval = getattr(self, '{0}date'.format(field_name))
-        retval = dateval and dateval.strftime('%Y-%m-%d') or ''
-        if timeval:
-            retval = '{0}{1}{2}'.format(retval, retval and ' ' or '',
-                                        timeval.strftime('%H:%M'))
-            # FIXME Think about timezones...
-        return retval
+        return date_time_string(getattr(self, '{0}date'.format(field_name)),
+                                getattr(self, '{0}time'.format(field_name)))
+
+
+class Tag(Timestamped):
+    """ A label for Events & Periods ("jobs", "housing", "concerts"), which
+    Bands pick their events by.
+    """
 
+    class Meta:
+        ordering = ('name',)
 
-class Event(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin):
+    def __str__(self):
+        return str(unicode(self))
+    def __unicode__(self):
+        return self.name
+
+    name = models.CharField(max_length=40, unique=True)
+
+
+class Event(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin,
+            TimelineWindowMixin):
     """ A significant life event.
     
     TODO Might be nice to have an optional type attribute, but concert is the
@@ -453,16 +566,24 @@ class Event(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin):
                             null=True,
                             db_index=False)
 
-    def as_timeline_dict(self):
-        return dict(id=str(self.pk),
-                    start=self.get_date_time_string(),
+    tags = models.ManyToManyField(Tag, blank=True)
+
+    timeline_fields = ('id', 'date', 'time', 'summary')
+
+    timeline_tags_field = 'tags'
+
+    @classmethod
+    def timeline_dict(cls, values):
+        return dict(id=str(values['id']),
+                    start=date_time_string(values['date'], values['time']),
                     durationEvent=False,
-                    title=self.summary,
+                    title=values['summary'],
                     classname='Event',
                     )
 
 
-class Period(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin):
+class Period(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin,
+             TimelineWindowMixin):
     """ A period of time. """
 
     def __str__(self):
@@ -484,25 +605,221 @@ class Period(SummaryAndNotes, Timestamped, DateWithOptionalTimeMixin):
     end_date = models.DateField(blank=True, null=True, db_index=True)
     end_time = models.TimeField(null=True, blank=True)
 
-    def as_timeline_dict(self):
-        caption = u"{0}: {1} \u21D2 {2}".format(self.summary,
-                                     self.start_date or INDETERMINATE_TIME,
-                                     self.end_date or INDETERMINATE_TIME)
-        retval = dict(id=str(self.pk),
-                      start=self.get_date_time_string('start') or YEAR_ZERO,
-                      end=self.get_date_time_string('end') or YEAR_INFINITY,
+    tags = models.ManyToManyField(Tag, blank=True)
+
+    timeline_tags_field = 'tags'
+
+    @classmethod
+    def in_window(cls, start=None, end=None):
+        """ Periods overlap the window if they start before it ends and end
+        after it starts.  A missing start or end date means the period is
+        open-ended in that direction, so it overlaps everything on that side.
+        The overlap test is answered by the interval tree.
+        """
+        if not start and not end:
+            return cls.objects.all()
+        pks = intervals.periods().overlapping(start, end)
+        if len(pks) <= intervals.MAX_KEYS:
+            return cls.objects.filter(pk__in=pks)
+        # Too many to list; fall back to testing the overlap in SQL.
+        queryset = cls.objects.all()
+        if end:
+            queryset = queryset.filter(models.Q(start_date__lte=end) |
+                                       models.Q(start_date__isnull=True))
+        if start:
+            queryset = queryset.filter(models.Q(end_date__gte=start) |
+                                       models.Q(end_date__isnull=True))
+        return queryset
+
+    timeline_fields = ('id', 'summary',
+                       'start_date', 'start_time',
+                       'latest_start_date', 'latest_start_time',
+                       'earliest_end_date', 'earliest_end_time',
+                       'end_date', 'end_time')
+
+    @classmethod
+    def timeline_span(cls, values):
+        return (values['start_date'] or YEAR_ZERO,
+                values['end_date'] or YEAR_INFINITY)
+
+    @classmethod
+    def timeline_dict(cls, values):
+        def date_and_time(field):
+            return date_time_string(values['{0}_date'.format(field)],
+                                    values['{0}_time'.format(field)])
+        caption = u"{0}: {1} \u21D2 {2}".format(values['summary'],
+                                     values['start_date'] or INDETERMINATE_TIME,
+                                     values['end_date'] or INDETERMINATE_TIME)
+        retval = dict(id=str(values['id']),
+                      start=date_and_time('start') or YEAR_ZERO,
+                      end=date_and_time('end') or YEAR_INFINITY,
                       durationEvent=True,
-                      title=self.summary,
+                      title=values['summary'],
                       caption=caption, # TODO replace with tooltip?
-                      classname=self.__class__.__name__,
+                      classname=cls.__name__,
                       )
-        if self.latest_start_date or self.latest_start_time:
-            retval['latestStart'] = self.get_date_time_string('latest_start')
-        if self.earliest_end_date or self.earliest_end_time:
-            retval['earliestEnd'] = self.get_date_time_string('earliest_end')
+        if values['latest_start_date'] or values['latest_start_time']:
+            retval['latestStart'] = date_and_time('latest_start')
+        if values['earliest_end_date'] or values['earliest_end_time']:
+            retval['earliestEnd'] = date_and_time('earliest_end')
         return retval
 
 
+class TimelineEvent(models.Model):
+    """ A pre-encoded timeline event.
+
+    One row per Event, Period, Person, Activity, Entry and
+    MedicalObservation, holding the JSON from its as_timeline_dict().  The
+    rows are kept in step with their sources by diary.timeline, so the feed
+    only has to stitch the fragments together.  Open-ended Periods are
+    bookended with YEAR_ZERO & YEAR_INFINITY, so a window is always a simple
+    overlap test on start_date & end_date.
+
+    user & private are copied from the source, so that what a user may see
+    can be picked out in the query.  So are the ids of its Tags, as
+    ",3,17,", so that a Band's events can be picked out the same way.
+    """
+
+    class Meta:
+        unique_together = (('model', 'object_id'),)
+
+    def __str__(self):
+        return str(unicode(self))
+    def __unicode__(self):
+        return '{model} {pk}: {start} -> {end}'.format(model=self.model,
+                                                       pk=self.object_id,
+                                                       start=self.start_date,
+                                                       end=self.end_date)
+
+    line_type = models.CharField(max_length=10)
+
+    model = models.CharField(max_length=30)
+
+    object_id = models.PositiveIntegerField()
+
+    start_date = models.DateField(db_index=True)
+
+    end_date = models.DateField(db_index=True)
+
+    modified = models.DateTimeField()
+
+    fragment = models.TextField()
+
+    # The event again, split up for the columnar feed.
+    classname = models.CharField(max_length=30)
+
+    title = models.CharField(max_length=200)
+
+    extra = models.TextField(blank=True)
+
+    # Whose it is (Entries), or null for everyone's.
+    user = models.ForeignKey(User, null=True, blank=True)
+
+    private = models.BooleanField(default=False)
+
+    tags = models.TextField(blank=True)
+
+
+class Band(Timestamped):
+    """ One band of a timeline, holding the events of the given classes
+    (Event, Period...) and/or with any of the given tags; either may be
+    left empty to mean "any".  An event can be in several bands.  Events
+    in none of them go in an "other" band after the rest; see
+    diary.timeline.bands().
+
+    Bands without a user are the defaults, for anyone who hasn't set up
+    their own.
+    """
+
+    class Meta:
+        ordering = ('line_type', 'position', 'id')
+
+    def __str__(self):
+        return str(unicode(self))
+    def __unicode__(self):
+        return '{line_type}: {name}'.format(line_type=self.line_type,
+                                            name=self.name)
+
+    LINE_TYPES = (('life', 'Life'),
+                  ('diary', 'Diary'),
+                  )
+
+    user = models.ForeignKey(User, null=True, blank=True)
+
+    line_type = models.CharField(max_length=10, choices=LINE_TYPES)
+
+    name = models.CharField(max_length=40)
+
+    position = models.PositiveIntegerField(default=0)
+
+    # Space separated.
+    classnames = models.CharField(max_length=200, blank=True)
+
+    tags = models.ManyToManyField(Tag, blank=True)
+
+
+class SearchPosting(models.Model):
+    """ One word of one object, in the search index maintained by
+    diary.search.
+
+    Weight is how often the word appears, with titles, names and summaries
+    counting extra.  The date is the object's place on the timeline (or its
+    creation date, for things like Media that have none) for date filtering.
+    """
+
+    class Meta:
+        unique_together = (('term', 'model', 'object_id'),)
+
+    def __str__(self):
+        return str(unicode(self))
+    def __unicode__(self):
+        return '{term}: {model} {pk}'.format(term=self.term, model=self.model,
+                                             pk=self.object_id)
+
+    term = models.CharField(max_length=40)
+
+    model = models.CharField(max_length=30)
+
+    object_id = models.PositiveIntegerField()
+
+    date = models.DateField()
+
+    weight = models.PositiveIntegerField()
+
+
+class Rollup(models.Model):
+    """ Count & total of a statistics series over a day, week, month or
+    year, maintained by diary.rollups.
+    """
+
+    PERIODS = (('day', 'Day'),
+               ('week', 'Week'),
+               ('month', 'Month'),
+               ('year', 'Year'),
+               )
+
+    class Meta:
+        unique_together = (('series', 'period', 'start'),)
+        ordering = ['series', 'period', 'start']
+
+    def __str__(self):
+        return str(unicode(self))
+    def __unicode__(self):
+        return '{series} {period} of {start}: {count} / {total}'.format(
+            series=self.series, period=self.period, start=self.start,
+            count=self.count, total=self.total)
+
+    series = models.CharField(max_length=30)
+
+    period = models.CharField(max_length=5, choices=PERIODS)
+
+    start = models.DateField()
+
+    count = models.PositiveIntegerField()
+
+    total = models.FloatField()
+
+
 class EntryForm(ModelForm):
     class Meta:
         model = Entry
@@ -571,3 +888,15 @@ class EventForm(ModelForm):
 class PeriodForm(ModelForm):
     class Meta:
         model = Period
+
+
+# Keep the pre-encoded timeline, cached bubbles, search index, statistics
+# and period intervals up to date.  Each of these connects its signal
+# handlers when it's imported, which can only happen once the models above
+# exist; nothing here calls them otherwise.
+from journal.diary import timeline
+from journal.diary import bubblecache
+from journal.diary import search
+from journal.diary import rollups
+from journal.diary import intervals
+_SIGNAL_MODULES = (timeline, bubblecache, search, rollups, intervals)
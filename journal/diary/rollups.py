@@ -0,0 +1,269 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pre-aggregated statistics
+
+Each series (ride distance, climbing & speed, mood counts, how things
+measured up to expectations) is kept as a count & total per day, week,
+month and year in the Rollup table.  Saving or deleting an object
+recomputes its day from the source rows, then the week, month & year
+containing that day from the day rows, so an update costs the same however
+long the history is, and reading a chart is one indexed range scan.
+"""
+
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models import signals
+
+from journal.diary.models import Entry, Activity, BikeRide, SocialEvent, \
+    DiningOut, Consumable, Media, Book, Music, Video, Rollup
+
+PERIODS = [period for period, name in Rollup.PERIODS]
+
+
+def bucket_start(period, day):
+    """ Return the first day of the period containing day.  Weeks start on
+    Monday.  Decades (for the timeline overview; there are no decade
+    rollups) start in years ending in 0.
+    """
+    if period == 'decade':
+        return day.replace(year=day.year // 10 * 10, month=1, day=1)
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    if period == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def bucket_end(period, start):
+    """ Return the last day of the period starting on start. """
+    if period == 'week':
+        return start + datetime.timedelta(days=6)
+    if period == 'month':
+        return (start + datetime.timedelta(days=31)).replace(day=1) - \
+            datetime.timedelta(days=1)
+    if period == 'year':
+        return start.replace(month=12, day=31)
+    if period == 'decade':
+        return start.replace(year=start.year + 9, month=12, day=31)
+    return start
+
+
+class Source(object):
+    """ Where some series come from: a model, the field dating its rows,
+    and the objects whose saves & deletes change it.
+    """
+
+    def __init__(self, model, date_field, senders):
+        self.model = model
+        self.date_field = date_field
+        self.senders = senders
+        self._is_datetime = model._meta.get_field(date_field).\
+            get_internal_type() == 'DateTimeField'
+
+    def day(self, value):
+        """ The day of a date_field value. """
+        return self._is_datetime and value.date() or value
+
+    def day_of(self, obj):
+        return self.day(getattr(obj, self.date_field))
+
+    def rows(self, day):
+        """ The source rows dated on day. """
+        if self._is_datetime:
+            start = datetime.datetime.combine(day, datetime.time())
+            return self.model.objects.filter(**{
+                '{0}__gte'.format(self.date_field): start,
+                '{0}__lt'.format(self.date_field):
+                    start + datetime.timedelta(days=1)})
+        return self.model.objects.filter(**{self.date_field: day})
+
+    def days(self):
+        """ Every day with source rows. """
+        return [value.date() if isinstance(value, datetime.datetime) else value
+                for value in self.model.objects.dates(self.date_field, 'day')]
+
+
+class RideSource(Source):
+    series = ('ride.distance', 'ride.climbing', 'ride.average_speed')
+
+    def __init__(self):
+        super(RideSource, self).__init__(BikeRide, 'date', (BikeRide,))
+
+    def day_values(self, day):
+        stats = self.rows(day).aggregate(n=Count('pk'),
+                                         distance=Sum('distance'),
+                                         climbing=Sum('climbing'),
+                                         speed=Sum('average_speed'))
+        return {
+            'ride.distance': (stats['n'], float(stats['distance'] or 0)),
+            'ride.climbing': (stats['n'], float(stats['climbing'] or 0)),
+            'ride.average_speed': (stats['n'], float(stats['speed'] or 0)),
+        }
+
+
+class MoodSource(Source):
+    series = tuple('mood.{0}'.format(mood) for mood, name in Entry.MOODS)
+
+    def __init__(self):
+        super(MoodSource, self).__init__(Entry, 'date', (Entry,))
+
+    def day_values(self, day):
+        values = dict((series, (0, 0.0)) for series in self.series)
+        # order_by() keeps Meta.ordering out of the GROUP BY.
+        for row in self.rows(day).order_by().values('mood').\
+                annotate(n=Count('pk')):
+            values['mood.{0}'.format(row['mood'])] = (row['n'],
+                                                      float(row['n']))
+        return values
+
+
+class RatingSource(Source):
+    """ Reality minus expectation, for Rateable things that had an
+    expectation.
+    """
+
+    def __init__(self, model, date_field, senders):
+        super(RatingSource, self).__init__(model, date_field, senders)
+        self.series = ('rating.{0}'.format(model.__name__),)
+
+    def day_values(self, day):
+        stats = self.rows(day).filter(expectation__isnull=False).\
+            aggregate(n=Count('pk'), reality=Sum('reality'),
+                      expectation=Sum('expectation'))
+        delta = (stats['reality'] or 0) - (stats['expectation'] or 0)
+        return {self.series[0]: (stats['n'], float(delta))}
+
+
+SOURCES = (
+    RideSource(),
+    MoodSource(),
+    RatingSource(Activity, 'date', (Activity, BikeRide, SocialEvent,
+                                    DiningOut)),
+    RatingSource(Consumable, 'created', (Consumable,)),
+    RatingSource(Media, 'created', (Media, Book, Music, Video)),
+)
+
+SERIES = dict((series, source) for source in SOURCES
+              for series in source.series)
+
+
+def _write(period, start, values):
+    """ Store {series: (count, total)} for a bucket, dropping empty ones. """
+    for series, (count, total) in values.items():
+        if count:
+            updated = Rollup.objects.filter(series=series, period=period,
+                start=start).update(count=count, total=total)
+            if not updated:
+                Rollup.objects.create(series=series, period=period,
+                                      start=start, count=count, total=total)
+        else:
+            Rollup.objects.filter(series=series, period=period,
+                                  start=start).delete()
+
+
+def refresh(source, days):
+    """ Recompute source's series for the given days, and the weeks, months
+    and years containing them.
+    """
+    days = set(days)
+    for day in days:
+        _write('day', day, source.day_values(day))
+    for period in PERIODS[1:]:
+        for start in set(bucket_start(period, day) for day in days):
+            values = dict((series, (0, 0.0)) for series in source.series)
+            for row in Rollup.objects.filter(period='day',
+                    series__in=source.series,
+                    start__range=(start, bucket_end(period, start))).\
+                    order_by().values('series').\
+                    annotate(n=Sum('count'), sum=Sum('total')):
+                values[row['series']] = (row['n'], row['sum'])
+            _write(period, start, values)
+
+
+@transaction.commit_on_success
+def rebuild():
+    """ Throw the rollups away and recompute them from the source rows. """
+    Rollup.objects.all().delete()
+    for source in SOURCES:
+        refresh(source, source.days())
+    return Rollup.objects.count()
+
+
+def refresh_objects(model_class, pks, chunk_size=500):
+    """ Recompute the series fed by many objects at once.  For rows written
+    behind the signals' back, e.g. by import_journal.
+    """
+    pks = list(pks)
+    for source in SOURCES:
+        if model_class not in source.senders:
+            continue
+        days = set()
+        for i in range(0, len(pks), chunk_size):
+            values = source.model.objects.filter(
+                pk__in=pks[i:i + chunk_size]).values_list(source.date_field,
+                                                          flat=True)
+            days.update(source.day(value) for value in values)
+        refresh(source, days)
+
+
+def buckets(series, period, start=None, end=None):
+    """ Return [(bucket start, count, total)] for a series, oldest first. """
+    rollups = Rollup.objects.filter(series=series, period=period)
+    if start:
+        rollups = rollups.filter(start__gte=bucket_start(period, start))
+    if end:
+        rollups = rollups.filter(start__lte=end)
+    return list(rollups.order_by('start').values_list('start', 'count',
+                                                      'total'))
+
+
+def _remember_day(sender, instance, raw=False, **kwargs):
+    """ Note the day an object was on before it's saved, in case it moves. """
+    instance._rollup_old_days = {}
+    if raw or instance.pk is None:
+        return
+    for source in SOURCES:
+        if sender in source.senders:
+            old = source.model.objects.filter(pk=instance.pk).\
+                values_list(source.date_field, flat=True)
+            if old:
+                instance._rollup_old_days[source] = source.day(old[0])
+
+
+def _changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old_days = getattr(instance, '_rollup_old_days', {})
+    for source in SOURCES:
+        if sender in source.senders:
+            days = [source.day_of(instance)]
+            if source in old_days:
+                days.append(old_days[source])
+            refresh(source, days)
+
+
+for _sender in set(sender for source in SOURCES for sender in source.senders):
+    signals.pre_save.connect(_remember_day, sender=_sender,
+        dispatch_uid='rollups-pre-save-{0}'.format(_sender.__name__))
+    signals.post_save.connect(_changed, sender=_sender,
+        dispatch_uid='rollups-save-{0}'.format(_sender.__name__))
+    signals.post_delete.connect(_changed, sender=_sender,
+        dispatch_uid='rollups-delete-{0}'.format(_sender.__name__))
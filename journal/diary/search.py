@@ -0,0 +1,278 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Full-text search
+
+An inverted index in the SearchPosting table: one row per word per object,
+covering the summary & notes of everything, plus names, titles, authors,
+artists and restaurants.  Postings are rewritten from post_save and removed
+on post_delete.  A query is a single grouped lookup on the term index, so
+its cost depends on how common the words are, not how big the journal is.
+"""
+
+import re
+import json
+
+from django.db import connection, transaction
+from django.db.models import Sum, Count
+from django.db.models import signals
+
+from journal.diary.models import Entry, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Consumable, Media, Book, Music, Video, \
+    MedicalObservation, Event, Period, SearchPosting, TimelineEvent, downcast
+from journal.diary import timeline
+
+# (field, weight) to index, by model.  Subclasses get their parents' fields
+# as well as their own.
+FIELDS = {
+    Entry: (('summary', 3), ('notes', 1)),
+    Person: (('name', 3), ('summary', 3), ('notes', 1)),
+    Activity: (('summary', 3), ('notes', 1)),
+    DiningOut: (('restaurant', 3),),
+    Consumable: (('name', 3), ('summary', 3), ('notes', 1)),
+    Media: (('title', 3), ('summary', 3), ('notes', 1)),
+    Book: (('author', 3),),
+    Music: (('artist', 3),),
+    MedicalObservation: (('summary', 3), ('notes', 1)),
+    Event: (('summary', 3), ('notes', 1)),
+    Period: (('summary', 3), ('notes', 1)),
+}
+
+# The models postings are filed under; subclasses are filed under these.
+INDEXED = (Entry, Person, Activity, Consumable, Media, MedicalObservation,
+           Event, Period)
+
+_BY_NAME = dict((model_type.__name__, model_type) for model_type in INDEXED)
+
+# Too common to be worth indexing.
+STOPWORDS = frozenset('''a an and are as at be but by for from had has have
+    he her his i in is it its me my of on or our she so that the their them
+    then there they this to was we were with you'''.split())
+
+MAX_TERM_LENGTH = 40
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Return the indexable words in text, lower cased. """
+    return [word[:MAX_TERM_LENGTH] for word in _WORD.findall(text.lower())
+            if len(word) > 1 and word not in STOPWORDS]
+
+
+def indexed_model(model_class):
+    """ Return the model a class's postings are filed under, or None. """
+    for model_type in INDEXED:
+        if issubclass(model_class, model_type):
+            return model_type
+    return None
+
+
+def index_date(obj):
+    """ Where the object sits on the timeline, for date filtering. """
+    if isinstance(obj, Period):
+        return obj.start_date or obj.end_date or obj.created.date()
+    if hasattr(obj, 'timeline_date_field'):
+        return getattr(obj, obj.timeline_date_field)
+    return obj.created.date()
+
+
+def weights(obj):
+    """ Return {term: weight} for an object. """
+    terms = {}
+    for model_class, fields in FIELDS.items():
+        if not isinstance(obj, model_class):
+            continue
+        for field_name, weight in fields:
+            for term in tokenize(getattr(obj, field_name) or u''):
+                terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+# The SearchPosting columns _post writes.
+_POSTING_FIELDS = [SearchPosting._meta.get_field(name) for name in
+                   ('term', 'model', 'object_id', 'date', 'weight')]
+
+
+def _post(model_type, objs):
+    """ Write the postings for objs with a single executemany(), rather
+    than a query per word.
+    """
+    rows = []
+    for obj in objs:
+        date = index_date(obj)
+        for term, weight in weights(obj).items():
+            rows.append([field.get_db_prep_save(value, connection=connection)
+                         for field, value in zip(_POSTING_FIELDS, (
+                             term, model_type.__name__, obj.pk, date,
+                             weight))])
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+        qn(SearchPosting._meta.db_table),
+        ', '.join(qn(field.column) for field in _POSTING_FIELDS),
+        ', '.join(['%s'] * len(_POSTING_FIELDS)))
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
+def index(obj):
+    """ (Re)index an object. """
+    model_type = indexed_model(obj.__class__)
+    SearchPosting.objects.filter(model=model_type.__name__,
+                                 object_id=obj.pk).delete()
+    _post(model_type, [obj])
+
+
+def unindex(obj):
+    model_type = indexed_model(obj.__class__)
+    SearchPosting.objects.filter(model=model_type.__name__,
+                                 object_id=obj.pk).delete()
+
+
+def _load(model_type, pks):
+    # Media & Activity subtypes have fields of their own to index.
+    if hasattr(model_type, 'subtype_field'):
+        return downcast(model_type, pks).values()
+    return model_type.objects.in_bulk(pks).values()
+
+
+def index_many(model_class, pks, chunk_size=500):
+    """ (Re)index many objects, a chunk at a time.  For rows written behind
+    the signals' back, e.g. by import_journal.  Returns the number of
+    objects indexed.
+    """
+    model_type = indexed_model(model_class)
+    pks = list(pks)
+    count = 0
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        SearchPosting.objects.filter(model=model_type.__name__,
+                                     object_id__in=chunk).delete()
+        objs = _load(model_type, chunk)
+        _post(model_type, objs)
+        count += len(objs)
+    return count
+
+
+@transaction.commit_on_success
+def rebuild(chunk_size=500):
+    """ Throw the index away and index everything again.  Returns the
+    number of objects indexed.
+    """
+    SearchPosting.objects.all().delete()
+    count = 0
+    for model_type in INDEXED:
+        count += index_many(model_type,
+                            model_type.objects.values_list('pk', flat=True),
+                            chunk_size)
+    return count
+
+
+def _hidden(postings, user):
+    """ Leave out the postings of timeline objects user may not see (see
+    timeline.visible).
+    """
+    for model_type in INDEXED:
+        if not (getattr(model_type, 'timeline_owner_field', None) or
+                getattr(model_type, 'timeline_private_field', None)):
+            continue
+        events = TimelineEvent.objects.filter(model=model_type.__name__)
+        hidden = events.exclude(pk__in=timeline.visible(events, user).
+                                values('pk')).values('object_id')
+        postings = postings.exclude(model=model_type.__name__,
+                                    object_id__in=hidden)
+    return postings
+
+
+def search(query, start=None, end=None, limit=50, user=None):
+    """ Return [(model name, pk, score)] for the objects containing every
+    word of the query, best first, optionally limited to a date window.
+    Objects user may not see are left out before the limit is applied.
+    """
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return []
+    postings = SearchPosting.objects.filter(term__in=terms)
+    if user is not None:
+        postings = _hidden(postings, user)
+    if start:
+        postings = postings.filter(date__gte=start)
+    if end:
+        postings = postings.filter(date__lte=end)
+    hits = postings.values('model', 'object_id').\
+        annotate(score=Sum('weight'), matched=Count('term')).\
+        filter(matched=len(terms)).order_by('-score')[:limit]
+    return [(hit['model'], hit['object_id'], hit['score']) for hit in hits]
+
+
+def search_events(query, start=None, end=None, limit=50, user=None):
+    """ Return the search hits as timeline events, best first, each with a
+    score.  Things on a timeline come from its store, leaving out those
+    user may not see (see timeline.visible); the rest (Media, Consumables)
+    are rendered on their index date.
+    """
+    hits = search(query, start, end, limit, user)
+    by_model = {}
+    for model, pk, score in hits:
+        by_model.setdefault(model, []).append(pk)
+    events = {}
+    for model, pks in by_model.items():
+        for event in timeline.visible(TimelineEvent.objects.filter(
+                model=model, object_id__in=pks), user):
+            events[(model, event.object_id)] = json.loads(event.fragment)
+        if timeline.line_type_for(_BY_NAME[model])[0]:
+            # Hidden from this user.
+            continue
+        missing = [pk for pk in pks if (model, pk) not in events]
+        if missing:
+            dates = dict(SearchPosting.objects.
+                         filter(model=model, object_id__in=missing).
+                         values_list('object_id', 'date'))
+            for pk, obj in _BY_NAME[model].objects.in_bulk(missing).items():
+                events[(model, pk)] = dict(
+                    id=str(pk),
+                    start=dates[pk].strftime('%Y-%m-%d'),
+                    durationEvent=False,
+                    title=unicode(obj),
+                    classname=model,
+                    )
+    results = []
+    for model, pk, score in hits:
+        event = events.get((model, pk))
+        if event is not None:
+            event['score'] = score
+            results.append(event)
+    return results
+
+
+def _saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index(instance)
+
+
+def _deleted(sender, instance, **kwargs):
+    unindex(instance)
+
+
+for _sender in (Entry, Person, Activity, BikeRide, SocialEvent, DiningOut,
+                Consumable, Media, Book, Music, Video, MedicalObservation,
+                Event, Period):
+    signals.post_save.connect(_saved, sender=_sender,
+        dispatch_uid='search-save-{0}'.format(_sender.__name__))
+    signals.post_delete.connect(_deleted, sender=_sender,
+        dispatch_uid='search-delete-{0}'.format(_sender.__name__))
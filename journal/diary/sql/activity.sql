@@ -0,0 +1,21 @@
+-- Journal
+-- Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+--
+-- This program is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+--
+-- You should have received a copy of the GNU General Public License
+-- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+--
+-- Run by syncdb after the table is created.  For existing databases the
+-- same statements are in the TODO file.
+
+-- Activities of one type over a range of days.
+CREATE INDEX diary_activity_type_date ON diary_activity (activity_type, date);
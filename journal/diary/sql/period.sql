@@ -0,0 +1,24 @@
+-- Journal
+-- Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+--
+-- This program is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+--
+-- You should have received a copy of the GNU General Public License
+-- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+--
+-- Run by syncdb after the table is created.  For existing databases the
+-- same statements are in the TODO file.
+
+-- Periods overlapping a window: start_date <= end AND end_date >= start,
+-- with NULLs for open ends.  Either bound can lead, whichever is more
+-- selective for the window.
+CREATE INDEX diary_period_start_end ON diary_period (start_date, end_date);
+CREATE INDEX diary_period_end_start ON diary_period (end_date, start_date);
@@ -0,0 +1,29 @@
+-- Journal
+-- Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+--
+-- This program is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+--
+-- You should have received a copy of the GNU General Public License
+-- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+--
+-- Run by syncdb after the table is created.  For existing databases the
+-- same statements are in the TODO file.
+
+-- Events of one line overlapping a window.  Windows in the past are
+-- narrowed best by end_date, windows near today by start_date.
+CREATE INDEX diary_timelineevent_line_start ON diary_timelineevent
+    (line_type, start_date, end_date);
+CREATE INDEX diary_timelineevent_line_end ON diary_timelineevent
+    (line_type, end_date, start_date);
+
+-- One user's share of a line: their own events & everyone's.
+CREATE INDEX diary_timelineevent_line_user_start ON diary_timelineevent
+    (line_type, user_id, start_date);
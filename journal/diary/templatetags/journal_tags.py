@@ -22,8 +22,10 @@ Dirk Bergstrom, krid@otisbean.com
 @author: krid
 """
 from django import template
+from django.core.urlresolvers import reverse
 
 from journal.diary.models import INDETERMINATE_TIME
+from journal.diary import compression
 
 register = template.Library()
 
@@ -61,3 +63,11 @@ def period_dates(period):
     # FIXME Need a real arrow
     return """{0} &rArr; {1}""".format(start, end)
 
+
+@register.simple_tag
+def static_asset(path):
+    """ Render the URL of a static file, using its content-hashed name if
+    precompress_static has made one.
+    """
+    return '{0}/{1}'.format(reverse('static'),
+                            compression.manifest().get(path, path))
@@ -1,23 +1,1447 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-This file demonstrates two different styles of tests (one doctest and one
-unittest). These will both pass when you run "manage.py test".
-
-Replace these with more appropriate tests for your application.
+Tests for diary
 """
 
-from django.test import TestCase
+import os
+import re
+import json
+import random
+import zlib
+import shutil
+import datetime
+import tempfile
+import cStringIO
+
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
+from django.db import connection, reset_queries
+from django.http import HttpRequest, HttpResponse
+
+from journal.diary.models import Entry, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Consumable, Media, Book, MedicalObservation, \
+    Event, Period, TimelineEvent, SearchPosting, Rollup, Tag, Band, downcast
+from journal.diary import details
+from journal.diary import views
+from journal.diary import compression
+from journal.diary import bubblecache
+from journal.diary import timeline
+from journal.diary import search
+from journal.diary import rollups
+from journal.diary import importer
+from journal.diary import backup
+from journal.diary import intervals
+from journal.diary import instrument
+from journal.diary import generator
+from journal.diary import benchmark
+from journal.pool import Pool, PoolExhausted
+from journal.middleware import QueryBudgetMiddleware
+try:
+    from journal.diary import analytics
+except ImportError:
+    # NumPy isn't installed.
+    analytics = None
+
+
+def count_queries(func, *args, **kwargs):
+    """ Run func with query logging turned on, and return how many queries
+    it made.
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    reset_queries()
+    try:
+        func(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+
+
+class JournalTestCase(TestCase):
+    """ Builders for the fixtures the tests need.  Each test case's setUp
+    calls just the ones it uses; make_journal() builds a small journal
+    with a few of everything.
+    """
+
+    day = datetime.date(2010, 10, 1)
+
+    def make_user(self):
+        self.user = User.objects.create_user('krid', 'krid@example.com', 'pw')
+
+    def make_people(self):
+        self.people = [Person.objects.create(name='Person {0}'.format(i),
+                                             summary='Person {0}'.format(i),
+                                             relation='friend', met=self.day)
+                       for i in range(3)]
+
+    def make_consumables(self):
+        self.consumables = [Consumable.objects.create(
+            name='Beer {0}'.format(i), summary='Beer {0}'.format(i),
+            reality=3, consumable_type='Beer') for i in range(3)]
+
+    def make_books(self):
+        self.books = [Book.objects.create(
+            title='Book {0}'.format(i), summary='Book {0}'.format(i), year=2010,
+            reality=4, author='Author', book_type='novel', genre='sci-fi')
+            for i in range(3)]
+
+    def make_entry(self):
+        """ An entry for self.user. """
+        self.entry = Entry.objects.create(date=self.day, summary='Entry',
+                                          mood='good', user=self.user)
+
+    def make_activities(self):
+        """ One activity of each type, with nobody along. """
+        self.activity = Activity.objects.create(date=self.day, summary='Hike',
+                                                reality=3)
+        self.ride = BikeRide.objects.create(date=self.day, summary='Ride',
+                                            reality=4, distance=30,
+                                            average_speed='15.5',
+                                            climbing=1500)
+        self.social = SocialEvent.objects.create(date=self.day,
+                                                 summary='Party', reality=5)
+        self.dinner = DiningOut.objects.create(date=self.day, summary='Dinner',
+                                               reality=4, restaurant='Chez')
+
+    def make_event(self):
+        self.event = Event.objects.create(date=self.day, summary='Concert')
+
+    def make_period(self):
+        """ An open-ended period, starting self.day. """
+        self.period = Period.objects.create(start_date=self.day,
+                                            summary='Job')
+
+    def make_journal(self):
+        """ A few of everything, all related to each other. """
+        self.make_user()
+        self.make_people()
+        self.make_consumables()
+        self.make_books()
+        self.make_entry()
+        self.entry.media = self.books
+        self.entry.consumables = self.consumables
+        self.make_activities()
+        self.social.company = self.people
+        self.dinner.company = self.people
+        self.dinner.consumables = self.consumables
+        self.observation = MedicalObservation.objects.create(date=self.day,
+                                                             summary='Cold')
+        self.make_event()
+        self.make_period()
+
+
+class DetailQueryCountTest(JournalTestCase):
+    """ Rendering a bubble costs one query for the object plus one per
+    relation it shows, however many related objects there are.
+    """
+
+    def setUp(self):
+        self.make_journal()
+
+    EXPECTED = {
+        Entry: 3,
+        Activity: 1,
+        BikeRide: 1,
+        SocialEvent: 2,
+        DiningOut: 3,
+        MedicalObservation: 1,
+        Event: 1,
+        Period: 1,
+        Person: 1,
+    }
+
+    def assertQueryCounts(self):
+        for model, expected in self.EXPECTED.items():
+            pk = model.objects.values_list('pk', flat=True)[0]
+            self.assertEqual(count_queries(details.render, model, [pk]),
+                             expected, model.__name__)
+
+    def test_query_counts(self):
+        self.assertQueryCounts()
+
+    def test_query_counts_with_more_company(self):
+        for i in range(10):
+            person = Person.objects.create(name='Extra {0}'.format(i),
+                                           summary='Extra', relation='friend',
+                                           met=self.day)
+            self.social.company.add(person)
+            self.dinner.company.add(person)
+        self.assertQueryCounts()
+
+    def test_batch_query_count(self):
+        pks = [self.social.pk]
+        for i in range(5):
+            social = SocialEvent.objects.create(date=self.day, summary='More',
+                                                reality=3)
+            social.company = self.people
+            pks.append(social.pk)
+        self.assertEqual(count_queries(details.render, SocialEvent, pks), 2)
+
+    def test_render_shows_relations(self):
+        html = details.render(DiningOut, [self.dinner.pk])[self.dinner.pk]
+        for person in self.people:
+            self.assertTrue(person.name in html)
+        for consumable in self.consumables:
+            self.assertTrue(consumable.name in html)
+
+
+class LeanTimelineTest(JournalTestCase):
+    """ The values() path renders the same events as the model path. """
+
+    def setUp(self):
+        self.make_journal()
+
+    def test_values_match_instances(self):
+        for model in (Entry, Activity, MedicalObservation, Event, Period,
+                      Person):
+            for obj in model.objects.all():
+                values = model.objects.filter(pk=obj.pk).\
+                    values(*model.timeline_fields)[0]
+                self.assertEqual(model.timeline_dict(values),
+                                 obj.as_timeline_dict())
+
+    def test_downcast(self):
+        pks = Activity.objects.values_list('pk', flat=True)
+        # One query for the types, one per subtype (Activity, BikeRide,
+        # SocialEvent, DiningOut).
+        self.assertEqual(count_queries(downcast, Activity, pks), 5)
+        objs = downcast(Activity, pks)
+        self.assertTrue(isinstance(objs[self.ride.pk], BikeRide))
+        self.assertEqual(objs[self.ride.pk].distance, 30)
+        self.assertTrue(isinstance(objs[self.dinner.pk], DiningOut))
+        media = downcast(Media, [book.pk for book in self.books])
+        self.assertTrue(all(isinstance(obj, Book) for obj in media.values()))
+
+
+class TimelineFeedTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_journal()
+
+    def events(self, line_type, start=None, end=None):
+        return json.loads(timeline.feed(line_type, start, end))['events']
+
+    def test_feed(self):
+        self.assertEqual(len(self.events('diary')), 6)
+        self.assertEqual(len(self.events('life')), 5)
+        self.assertEqual(timeline.check('diary'), [])
+        self.assertEqual(timeline.check('life'), [])
+
+    def test_window(self):
+        later = self.day + datetime.timedelta(days=30)
+        self.assertEqual(self.events('diary', later, None), [])
+        # The period is open-ended, so it's still going on.
+        self.assertEqual([event['classname'] for event in
+                          self.events('life', later, None)], ['Period'])
+
+    def test_chunks(self):
+        chunks = list(timeline.iter_fragments('diary', chunk_size=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 2])
+
+    def test_delete(self):
+        self.event.delete()
+        self.assertEqual(len(self.events('life')), 4)
+
+    def test_columnar(self):
+        data = json.loads(timeline.columnar('life'))
+        events = dict(((event['classname'], event['id']), event)
+                      for event in self.events('life'))
+        self.assertEqual(len(data['id']), len(events))
+        for i, pk in enumerate(data['id']):
+            classname = data['classnames'][data['classname'][i]]
+            event = events[(classname, str(pk))]
+            self.assertEqual(data['classnames'][data['classname'][i]],
+                             event['classname'])
+            self.assertEqual(data['title'][i], event['title'])
+            start = timeline.EPOCH + datetime.timedelta(days=data['start'][i])
+            self.assertEqual(str(start), event['start'][:10])
+            self.assertEqual(data['end'][i] is not None,
+                             event['durationEvent'])
+
+    def test_columnar_durations(self):
+        # decodeColumnar makes a duration of anything with an end, so the
+        # period needs one, and nothing else may have one.
+        data = timeline.columnar_data('life')
+        ends = dict(((data['classnames'][data['classname'][i]],
+                      data['id'][i]), data['end'][i])
+                    for i in range(len(data['id'])))
+        self.assertNotEqual(ends.pop(('Period', self.period.pk)), None)
+        self.assertEqual(set(ends.values()), set([None]))
+        self.assertTrue([event['durationEvent'] for event in
+                         self.events('life')
+                         if event['classname'] == 'Period'][0])
+
+    def test_compressed(self):
+        response = self.client.get('/timeline_json/life/',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.content, 16 + zlib.MAX_WBITS),
+                         timeline.feed('life', user=AnonymousUser()))
+        # Streamed, a piece at a time.
+        pieces = list(compression.iter_compress(
+            timeline.iter_feed('life'), 'gzip'))
+        self.assertTrue(len(pieces) > 1)
+        # No timestamp in the header, so the same data packs the same.
+        self.assertEqual(compression.compress('x' * 100, 'gzip'),
+                         compression.compress('x' * 100, 'gzip'))
+
+    def test_compressed_etag(self):
+        url = '/timeline_json/life/'
+        gzipped = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        plain = self.client.get(url)
+        self.assertTrue(gzipped['ETag'].endswith('-gzip"'))
+        self.assertNotEqual(gzipped['ETag'], plain['ETag'])
+        for response in (gzipped, plain):
+            self.assertTrue('Accept-Encoding' in response['Vary'])
+        # Each copy revalidates against its own tag only.
+        self.assertEqual(self.client.get(
+            url, HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH=gzipped['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(
+            url, HTTP_IF_NONE_MATCH=gzipped['ETag']).status_code, 200)
+
+    def test_hashed_names(self):
+        from journal.diary.management.commands.precompress_static import \
+            HASHED
+        self.assertFalse(HASHED.search('journal'))
+        self.assertTrue(HASHED.search('journal.0123456789ab'))
+        self.assertTrue(HASHED.search('journal.0123456789ab.ba9876543210'))
+
+    def test_months(self):
+        url = '/timeline_months/diary/'
+        month = self.day.strftime('%Y-%m')
+        data = json.loads(self.client.get(url, {'months': month}).content)
+        # All but the entry, which is only for its owner.
+        self.assertEqual(len(data[month]['feed']['id']), 5)
+        etag = data[month]['etag']
+        data = json.loads(self.client.get(url, {
+            'months': '{0}:{1}'.format(month, etag)}).content)
+        self.assertEqual(data[month], {'etag': etag})
+        # The same etags as validator, and the same feeds as columnar_data.
+        start, end = timeline.month_window(month)
+        self.assertEqual(etag, timeline.validator('diary', start, end,
+                                                  'columnar',
+                                                  AnonymousUser())[0])
+        feeds = timeline.month_feeds('life', [month, '2010-09'], self.user)
+        self.assertEqual(feeds[month]['etag'], timeline.validator(
+            'life', start, end, 'columnar', self.user)[0])
+        self.assertEqual(feeds[month]['feed'], timeline.columnar_data(
+            'life', start, end, self.user))
+        self.assertEqual(feeds['2010-09']['feed']['id'], [])
+
+    def test_months_query_count(self):
+        url = '/timeline_months/life/'
+        months = ['{0}-{1:02}'.format(year, month)
+                  for year in range(2008, 2013) for month in range(1, 13)]
+        self.assertEqual(len(months), views.MAX_MONTHS)
+        # Let the first request build the period tree.
+        self.client.get(url, {'months': months[0]})
+        self.assertEqual(count_queries(self.client.get, url,
+                                       {'months': ','.join(months)}),
+                         count_queries(self.client.get, url,
+                                       {'months': months[0]}))
+        response = self.client.get(url, {'months': ','.join(months +
+                                                            ['2013-01'])})
+        self.assertEqual(response.status_code, 400)
+
+class SearchTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_consumables()
+        self.make_books()
+        self.make_activities()
+        self.make_event()
+
+    def test_search(self):
+        self.dinner.notes = 'Excellent mole, and the Beer was cold.'
+        self.dinner.save()
+        hits = search.search('mole')
+        self.assertEqual(hits[0][:2], ('Activity', self.dinner.pk))
+        # Every word has to match.
+        self.assertEqual(search.search('mole sushi'), [])
+        # Restaurant names are indexed, and count for more than notes.
+        self.assertEqual(search.search('chez')[0][1], self.dinner.pk)
+
+    def test_index_queries(self):
+        self.event.notes = 'Short'
+        short = count_queries(self.event.save)
+        self.event.notes = ' '.join('word{0}'.format(i) for i in range(200))
+        self.assertEqual(count_queries(self.event.save), short)
+        self.assertEqual(len(search.search('word199')), 1)
+
+    def test_subtype_fields(self):
+        hits = search.search('author')
+        self.assertEqual(sorted(pk for model, pk, score in hits),
+                         sorted(book.pk for book in self.books))
+
+    def test_dates_and_delete(self):
+        later = self.day + datetime.timedelta(days=1)
+        self.assertEqual(search.search('concert', start=later), [])
+        self.assertEqual(len(search.search('concert')), 1)
+        self.event.delete()
+        self.assertEqual(search.search('concert'), [])
+
+    def test_events(self):
+        events = search.search_events('beer')
+        self.assertEqual(sorted(event['classname'] for event in events),
+                         ['Consumable'] * 3)
+        events = search.search_events('party')
+        self.assertEqual(events[0]['classname'], 'SocialEvent')
+
+    def test_rebuild(self):
+        count = SearchPosting.objects.count()
+        search.rebuild()
+        self.assertEqual(SearchPosting.objects.count(), count)
+
+
+class RollupTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+        self.make_entry()
+        self.make_activities()
+
+    def test_rides(self):
+        BikeRide.objects.create(date=self.day + datetime.timedelta(days=1),
+                                summary='Another', reality=3, distance=20,
+                                average_speed='12.5', climbing=500)
+        self.assertEqual(rollups.buckets('ride.distance', 'day'),
+                         [(self.day, 1, 30.0),
+                          (self.day + datetime.timedelta(days=1), 1, 20.0)])
+        self.assertEqual(rollups.buckets('ride.distance', 'month'),
+                         [(self.day, 2, 50.0)])
+        self.assertEqual(rollups.buckets('ride.average_speed', 'year'),
+                         [(datetime.date(2010, 1, 1), 2, 28.0)])
+
+    def test_move_and_delete(self):
+        self.ride.date = datetime.date(2009, 6, 1)
+        self.ride.save()
+        self.assertEqual(rollups.buckets('ride.climbing', 'year'),
+                         [(datetime.date(2009, 1, 1), 1, 1500.0)])
+        self.ride.delete()
+        self.assertEqual(rollups.buckets('ride.climbing', 'year'), [])
+
+    def test_moods_and_ratings(self):
+        self.assertEqual(rollups.buckets('mood.good', 'week'),
+                         [(datetime.date(2010, 9, 27), 1, 1.0)])
+        self.social.expectation = 3
+        self.social.save()
+        self.assertEqual(rollups.buckets('rating.Activity', 'day'),
+                         [(self.day, 1, 2.0)])
+
+    def test_rebuild(self):
+        before = list(Rollup.objects.values_list('series', 'period', 'start',
+                                                 'count', 'total'))
+        rollups.rebuild()
+        after = list(Rollup.objects.values_list('series', 'period', 'start',
+                                                'count', 'total'))
+        self.assertEqual(before, after)
+
+
+if analytics is not None:
+
+    class AnalyticsTest(JournalTestCase):
+
+        def setUp(self):
+            self.make_user()
+            self.make_entry()
+            self.make_activities()
+
+        def test_load(self):
+            BikeRide.objects.create(date=self.day + datetime.timedelta(days=2),
+                                    summary='Later', reality=3, distance=20,
+                                    average_speed='12.5', climbing=0)
+            diary = analytics.Diary.load()
+            self.assertEqual(len(diary), 3)
+            self.assertEqual(diary.date(0), self.day)
+            self.assertEqual(list(diary['ride.distance']), [30.0, 0.0, 20.0])
+            self.assertEqual(diary['mood'][0], analytics.MOOD_SCORES['good'])
+            self.assertEqual(list(diary['dining.count']), [1.0, 0.0, 0.0])
+
+        def test_rolling(self):
+            values = [1, 2, float('nan'), 4]
+            self.assertEqual(list(analytics.rolling_sum(values, 2)),
+                             [1.0, 3.0, 2.0, 4.0])
+            self.assertEqual(list(analytics.rolling_mean(values, 2)),
+                             [1.0, 1.5, 2.0, 4.0])
+
+        def test_streaks(self):
+            mask = [True, False, True, True, True, False, True]
+            self.assertEqual(analytics.longest_streak(mask), (2, 3))
+            self.assertEqual(analytics.current_streak(mask), 1)
+            self.assertEqual(analytics.longest_streak([False]), (None, 0))
+
+        def test_correlation(self):
+            self.assertAlmostEqual(
+                analytics.correlation([1, 2, 3, 4], [2, 4, 6, 8]), 1.0)
+            self.assertAlmostEqual(
+                analytics.correlation([1, 2, 3, 4, 5], [0, 1, 2, 3, 4],
+                                      lag=1), 1.0)
+
+
+class ImportTest(JournalTestCase):
+
+    RIDES = (
+        'date,summary,reality,distance,average_speed,climbing\n'
+        '2009-05-01,Old Page Mill,4,40,14.2,3000\n'
+        'not a date,Broken,4,40,14.2,3000\n'
+        '2009-05-03,Skyline,5,60,15.0,4500\n'
+    )
+
+    def setUp(self):
+        self.make_user()
+        self.make_books()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_rides(self):
+        path = self.write('rides.csv', self.RIDES)
+        checkpoint = importer.Checkpoint(path + '.checkpoint')
+        loader = importer.Importer(BikeRide, chunk_size=2)
+        self.assertEqual(loader.run(importer.read_rows(path), checkpoint), 2)
+        self.assertEqual([number for number, errors in loader.invalid], [2])
+        self.assertEqual(checkpoint.rows, 3)
+
+        rides = BikeRide.objects.filter(date__year=2009).order_by('date')
+        self.assertEqual([ride.summary for ride in rides],
+                         ['Old Page Mill', 'Skyline'])
+        self.assertEqual(rides[0].activity_type, 'BikeRide')
+        self.assertEqual(Activity.objects.get(pk=rides[0].pk).activity_type,
+                         'BikeRide')
+
+        self.assertEqual(loader.update_derived(checkpoint.first_pk), 2)
+        self.assertEqual(TimelineEvent.objects.filter(
+            model='Activity', object_id__in=[ride.pk for ride in rides]).
+            count(), 2)
+        self.assertEqual(rollups.buckets('ride.distance', 'year',
+                                         datetime.date(2009, 1, 1),
+                                         datetime.date(2009, 12, 31)),
+                         [(datetime.date(2009, 1, 1), 2, 100.0)])
+        self.assertEqual(search.search('skyline'),
+                         [('Activity', rides[1].pk, 3)])
+
+    def test_resume(self):
+        path = self.write('rides.csv', self.RIDES)
+        checkpoint = importer.Checkpoint(path + '.checkpoint')
+        checkpoint.rows = 2
+        checkpoint.save()
+        loader = importer.Importer(BikeRide)
+        loader.run(importer.read_rows(path),
+                   importer.Checkpoint(path + '.checkpoint'))
+        self.assertEqual(list(BikeRide.objects.filter(date__year=2009).
+                              values_list('summary', flat=True)), ['Skyline'])
+
+    def test_periods(self):
+        intervals.periods()
+        path = self.write('periods.json', json.dumps(dict(
+            start_date='2009-01-01', end_date='2009-12-31',
+            summary='Contract')) + '\n')
+        checkpoint = importer.Checkpoint(path + '.checkpoint')
+        loader = importer.Importer(Period)
+        self.assertEqual(loader.run(importer.read_rows(path), checkpoint), 1)
+        loader.update_derived(checkpoint.first_pk)
+        period = Period.objects.get(summary='Contract')
+        self.assertEqual([event.object_id for event in timeline.window(
+            'life', datetime.date(2009, 6, 1), datetime.date(2009, 6, 30))],
+                         [period.pk])
+
+    def test_entries(self):
+        path = self.write('entries.json', json.dumps(dict(
+            date='2009-06-01', summary='Back-filled', mood='ok',
+            media=[book.pk for book in self.books[:2]])) + '\n')
+        loader = importer.Importer(Entry, defaults=dict(user=self.user.pk))
+        self.assertEqual(loader.run(importer.read_rows(path)), 1)
+        entry = Entry.objects.get(summary='Back-filled')
+        self.assertEqual(entry.user, self.user)
+        # Media & Book instances never compare equal; compare the pks.
+        self.assertEqual(set(entry.media.values_list('pk', flat=True)),
+                         set(book.pk for book in self.books[:2]))
+        self.assertEqual(list(entry.consumables.all()), [])
+
+
+class BackupTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_journal()
+
+    def snapshot(self):
+        rows = dict((model, list(model.objects.order_by('pk').values_list()))
+                    for model in backup.MODELS)
+        for model, field_name in backup.LINKS:
+            rows[field_name, model] = [
+                (obj.pk, list(getattr(obj, field_name).
+                              values_list('pk', flat=True).order_by('pk')))
+                for obj in model.objects.order_by('pk')]
+        return rows
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        lines = list(backup.iter_lines())
+        for model in (Entry, Activity, MedicalObservation, Event, Period,
+                      Consumable, Media, Person):
+            model.objects.all().delete()
+        counts = backup.Restorer(chunk_size=2).restore(lines)
+        self.assertEqual(counts['BikeRide'], 1)
+        self.assertEqual(counts['Activity'], 4)
+        self.assertEqual(self.snapshot(), before)
+
+        backup.rebuild_derived()
+        self.assertEqual(timeline.check('diary'), [])
+
+    def test_incremental(self):
+        since = datetime.datetime.now()
+        self.dinner.company = self.people[:1]
+        records = [json.loads(line) for line in backup.iter_lines(since)]
+        self.assertEqual(records[0]['backup'], 'journal')
+        self.assertEqual(sorted((record.get('model') or record['link'],
+                                 record['pk']) for record in records[1:]),
+                         [('Activity', self.dinner.pk),
+                          ('DiningOut', self.dinner.pk),
+                          ('DiningOut.company', self.dinner.pk),
+                          ('DiningOut.consumables', self.dinner.pk)])
+
+        # Restoring it over the old links replaces them.
+        self.dinner.company = self.people
+        backup.Restorer().restore(json.dumps(record) + '\n'
+                                  for record in records)
+        self.assertEqual(list(self.dinner.company.all()), self.people[:1])
+
+    def test_gzip(self):
+        lines = list(backup.iter_lines())
+        self.assertEqual(zlib.decompress(''.join(backup.iter_gzip(lines)),
+                                         16 + zlib.MAX_WBITS),
+                         ''.join(lines))
+
+    def test_staff_only(self):
+        response = self.client.get('/export/')
+        self.assertTemplateUsed(response, 'admin/login.html')
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='krid', password='pw')
+        response = self.client.get('/export/', {'format': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-gzip')
+
+
+class AdminQueryCountTest(JournalTestCase):
+    """ The entry admin pages cost the same number of queries however many
+    entries, media, consumables and people there are.
+    """
+
+    def setUp(self):
+        self.make_user()
+        self.make_books()
+        self.make_consumables()
+        self.make_entry()
+        self.entry.media = self.books
+        self.entry.consumables = self.consumables
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+
+    def get(self, url, *args):
+        response = self.client.get(url, *args)
+        self.assertEqual(response.status_code, 200)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+    def more(self, count):
+        for i in range(count):
+            entry = Entry.objects.create(
+                date=self.day - datetime.timedelta(days=200 * i),
+                summary='More {0}'.format(i), mood='ok', user=self.user)
+            entry.media = [Book.objects.create(
+                title='More {0}'.format(i), summary='More', year=2010,
+                reality=3, author='Author', book_type='novel',
+                genre='sci-fi')]
+            Consumable.objects.create(name='More {0}'.format(i),
+                                      summary='More', reality=3,
+                                      consumable_type='Beer')
+            Person.objects.create(name='More {0}'.format(i), summary='More',
+                                  relation='friend', met=self.day)
+
+    def more_rows(self, count):
+        """ more(), all of it on the entry's inlines. """
+        self.more(count)
+        self.entry.media = Book.objects.all()
+        self.entry.consumables = Consumable.objects.all()
+
+    def assertFlat(self, url, params=None, grow=None):
+        """ Check that url costs as many queries after grow(20) (more(20)
+        by default) as before.  The first request, which fills the caches,
+        doesn't count.
         """
-        Tests that 1 + 1 always equals 2.
+        params = params or {}
+        self.get(url, params)
+        before = count_queries(self.get, url, params)
+        (grow or self.more)(20)
+        self.assertEqual(count_queries(self.get, url, params), before)
+
+    def test_changelist(self):
+        self.assertFlat('/admin/diary/entry/')
+
+    def test_changelist_by_year(self):
+        self.assertFlat('/admin/diary/entry/', {'date__year': '2010'})
+
+    def test_change(self):
+        url = '/admin/diary/entry/{0}/'.format(self.entry.pk)
+        self.assertFlat(url, grow=self.more_rows)
+        response = self.client.get(url)
+        # Every row still gets its label.
+        self.assertContains(response,
+                            '<strong>Book: &quot;More 19&quot; 2010</strong>')
+        self.assertContains(response,
+                            '<strong>Beer: &quot;More 19&quot;</strong>')
+
+    def test_date_hierarchy(self):
+        self.more(3)
+        response = self.client.get('/admin/diary/entry/')
+        self.assertContains(response, '?date__year=2010')
+        self.assertContains(response, '?date__year=2009')
+        response = self.client.get('/admin/diary/entry/',
+                                   {'date__year': '2010'})
+        self.assertContains(response, 'date__month=10"')
+        self.assertContains(response, 'date__month=3"')
+        self.assertNotContains(response, 'date__month=9"')
+
+
+def explain(queryset):
+    """ Return the tables a queryset reads from start to finish, according
+    to the database's query plan.  Only SQLite & MySQL are understood;
+    others return None.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    engine = connection.settings_dict['ENGINE']
+    cursor = connection.cursor()
+    scanned = set()
+    if engine.endswith('sqlite3'):
+        tables = connection.introspection.table_names()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in cursor.fetchall():
+            # "SCAN x", or in older versions "TABLE x" with no index.
+            match = re.match(r'(SCAN|TABLE) (?:TABLE )?(\w+)(.*)', row[-1])
+            if not match or match.group(2) not in tables:
+                continue
+            how, table, rest = match.groups()
+            if how == 'SCAN' and 'COVERING INDEX' not in rest or \
+                    'INDEX' not in rest and 'PRIMARY KEY' not in rest:
+                scanned.add(table)
+    elif engine.endswith('mysql'):
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            if row['type'] == 'ALL':
+                scanned.add(row['table'])
+    else:
+        return None
+    return scanned
+
+
+class QueryPlanTest(TransactionTestCase):
+    """ The hot queries are answered from indexes, not full table scans.
+
+    Python's sqlite3 commits before anything but DML, EXPLAIN included,
+    which would end a TestCase's transaction early and leave its rows
+    behind for the next test.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('krid', 'krid@example.com', 'pw')
+        # Period windows come from the interval tree; with no periods there
+        # would be no query to explain.
+        Period.objects.create(start_date=datetime.date(2010, 6, 1),
+                              summary='Job')
+
+    def hot_queries(self):
+        start, end = datetime.date(2010, 1, 1), datetime.date(2010, 12, 31)
+        return (
+            Entry.objects.filter(user=self.user, date__range=(start, end)),
+            Entry.objects.filter(date__range=(start, end)),
+            Activity.objects.filter(activity_type='BikeRide',
+                                    date__range=(start, end)),
+            Activity.in_window(start, end),
+            Period.in_window(start, end),
+            timeline.window('life', start, end),
+            timeline.window('diary', start, end).filter(pk__gt=0).
+                order_by('pk')[:timeline.CHUNK_SIZE],
+            SearchPosting.objects.filter(term__in=['ride', 'party']),
+            Rollup.objects.filter(series='ride.distance', period='month',
+                                  start__range=(start, end)),
+        )
+
+    def test_hot_queries(self):
+        for queryset in self.hot_queries():
+            scanned = explain(queryset)
+            if scanned is None:
+                return
+            self.assertEqual(scanned, set(), "Full scan of {0} for {1}".format(
+                ', '.join(sorted(scanned)), queryset.query))
+
+    def test_spots_scans(self):
+        scanned = explain(Entry.objects.filter(summary='Entry'))
+        if scanned is not None:
+            self.assertEqual(scanned, set(['diary_entry']))
+
+
+class IntervalTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_people()
+        self.make_event()
+        self.make_period()
+
+    def test_tree(self):
+        rand = random.Random(1)
+        spans = []
+        for key in range(200):
+            start = rand.randint(0, 1000)
+            spans.append((start, start + rand.choice((0, 1, 10, 100, 1000)),
+                          key))
+        tree = intervals.IntervalTree(spans)
+        for i in range(200):
+            start = rand.choice((None, rand.randint(-10, 2100)))
+            end = rand.choice((None, rand.randint(start or 0, 2100)))
+            expected = sorted(key for first, last, key in spans
+                              if (end is None or first <= end) and
+                              (start is None or last >= start))
+            self.assertEqual(sorted(tree.overlapping(start, end)), expected)
+
+    def test_periods(self):
+        old = Period.objects.create(start_date=datetime.date(2009, 1, 1),
+                                    end_date=datetime.date(2009, 6, 30),
+                                    summary='Old job')
+        spring = (datetime.date(2009, 3, 1), datetime.date(2009, 3, 31))
+        self.assertEqual(list(Period.in_window(*spring)), [old])
+        self.assertEqual(list(Period.in_window(self.day, None)), [self.period])
+        old.end_date = None
+        old.save()
+        self.assertEqual(set(Period.in_window(self.day, self.day)),
+                         set([old, self.period]))
+
+    def test_validator(self):
+        intervals.periods()
+        # Just the check while the periods stand still.
+        self.assertEqual(count_queries(intervals.periods), 1)
+        # A write that skips the signals, as another process's would in
+        # its own cache, shows in the newest modified time.
+        Period.objects.filter(pk=self.period.pk).update(
+            end_date=datetime.date(2010, 10, 31),
+            modified=datetime.datetime.now() + datetime.timedelta(seconds=1))
+        self.assertEqual(intervals.periods().overlapping(
+            datetime.date(2010, 12, 1), None), [])
+        # Another process moving the generation on.
+        cache.set(intervals.GENERATION_KEY, 'elsewhere')
+        self.assertEqual(count_queries(intervals.periods), 2)
+        # As does losing the cache.
+        cache.delete(intervals.GENERATION_KEY)
+        self.assertEqual(count_queries(intervals.periods), 2)
+
+    def test_too_many_keys(self):
+        Period.objects.create(start_date=datetime.date(2009, 1, 1),
+                              end_date=datetime.date(2009, 6, 30),
+                              summary='Old job')
+        Period.objects.create(end_date=datetime.date(2009, 2, 1),
+                              summary='Older job')
+        windows = [(datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)),
+                   (None, datetime.date(2009, 1, 15)),
+                   (self.day, None)]
+        listed = [(set(Period.in_window(start, end)),
+                   set(timeline.window('life', start, end)))
+                  for start, end in windows]
+        max_keys = intervals.MAX_KEYS
+        intervals.MAX_KEYS = 0
+        try:
+            self.assertEqual([(set(Period.in_window(start, end)),
+                               set(timeline.window('life', start, end)))
+                              for start, end in windows], listed)
+        finally:
+            intervals.MAX_KEYS = max_keys
+
+    def test_window(self):
+        self.period.start_date = datetime.date(2009, 1, 1)
+        self.period.end_date = datetime.date(2009, 12, 31)
+        self.period.save()
+        events = timeline.window('life', datetime.date(2009, 6, 1),
+                                 datetime.date(2009, 6, 2))
+        self.assertEqual([event.object_id for event in events],
+                         [self.period.pk])
+        self.assertEqual(timeline.window('life', self.day, self.day).count(),
+                         4)
+
+    def test_on_this_day(self):
+        response = self.client.get('/on_this_day/', {'date': '2010-10-01'})
+        # The concert, the people met that day, and the period starting.
+        self.assertEqual(len(json.loads(response.content)['events']), 5)
+        response = self.client.get('/on_this_day/', {'date': '2011-01-01'})
+        self.assertEqual([event['classname'] for event in
+                          json.loads(response.content)['events']], ['Period'])
+        response = self.client.get('/on_this_day/', {'date': 'tuesday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise IOError("Gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class PoolTest(TestCase):
+
+    def pool(self, **kwargs):
+        return Pool(lambda connection: connection.ping(), **kwargs)
+
+    def test_reuse(self):
+        pool = self.pool(max_size=2)
+        self.assertEqual(pool.acquire(), None)
+        first = FakeConnection()
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+        self.assertEqual(len(pool), 1)
+
+    def test_health_check(self):
+        pool = self.pool(max_size=1)
+        pool.acquire()
+        dead = FakeConnection()
+        dead.alive = False
+        pool.release(dead)
+        # The dead one is thrown away, making room for a new one.
+        self.assertEqual(pool.acquire(), None)
+        self.assertTrue(dead.closed)
+        self.assertEqual(len(pool), 1)
+
+    def test_idle_timeout(self):
+        pool = self.pool(idle_timeout=-1)
+        pool.acquire()
+        stale = FakeConnection()
+        pool.release(stale)
+        self.assertEqual(pool.acquire(), None)
+        self.assertTrue(stale.closed)
+
+    def test_max_size(self):
+        pool = self.pool(max_size=1, wait=0.01)
+        pool.acquire()
+        self.assertRaises(PoolExhausted, pool.acquire)
+        # Giving up the room for a connection that failed to open frees it.
+        pool.release(None)
+        self.assertEqual(pool.acquire(), None)
+
+
+class LRUTest(TestCase):
+
+    def test_eviction(self):
+        lru = bubblecache.LRUBackend(3)
+        for key in 'abc':
+            lru.set(key, key.upper())
+        # Using a makes b the least recently used.
+        self.assertEqual(lru.get('a'), 'A')
+        lru.set('d', 'D')
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual([lru.get(key) for key in 'acd'], ['A', 'C', 'D'])
+        lru.delete('c')
+        lru.set('e', 'E')
+        self.assertEqual(len(lru), 3)
+        self.assertEqual(lru.get('a'), 'A')
+
+    def test_busy(self):
+        lru = bubblecache.LRUBackend(3)
+        for key in 'abc':
+            lru.set(key, key.upper())
+        for i in range(100):
+            lru.get('a')
+            lru.get('c')
+        # Used over and over, the queue still stays short.
+        self.assertTrue(len(lru._queue) < 20)
+        lru.set('d', 'D')
+        self.assertEqual([lru.get(key) for key in 'abcd'],
+                         ['A', None, 'C', 'D'])
+
+
+class QueryBudgetTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+        self.make_entry()
+        self.make_period()
+        self.saved = dict((name, getattr(settings, name)) for name in (
+            'MIDDLEWARE_CLASSES', 'QUERY_BUDGET_QUERIES',
+            'QUERY_BUDGET_SECONDS', 'QUERY_BUDGET_ACTION'))
+        settings.MIDDLEWARE_CLASSES = \
+            ('journal.middleware.QueryBudgetMiddleware',) + \
+            tuple(name for name in self.saved['MIDDLEWARE_CLASSES']
+                  if name != 'journal.middleware.QueryBudgetMiddleware')
+        settings.QUERY_BUDGET_QUERIES = '1'
+        settings.QUERY_BUDGET_SECONDS = '60'
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+        super(QueryBudgetTest, self).tearDown()
+
+    def test_log(self):
+        settings.QUERY_BUDGET_ACTION = 'log'
+        response = self.client.get('/on_this_day/', {'date': '2010-10-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Query budget: over budget GET /on_this_day/' in
+                        self.client.errors.getvalue())
+
+    def test_reject(self):
+        settings.QUERY_BUDGET_ACTION = 'reject'
+        response = self.client.get('/on_this_day/', {'date': '2010-10-01'})
+        self.assertEqual(response.status_code, 503)
+        # The limit only lasts for the request.
+        self.assertEqual(Entry.objects.count(), 1)
+
+    def test_within_budget(self):
+        settings.QUERY_BUDGET_QUERIES = '1000'
+        settings.QUERY_BUDGET_ACTION = 'reject'
+        response = self.client.get('/on_this_day/', {'date': '2010-10-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.errors.getvalue(), '')
+
+    def stream(self):
+        """ Send a streamed body that queries between its pieces through
+        the middleware, returning the body and what was logged.
         """
-        self.failUnlessEqual(1 + 1, 2)
+        def body():
+            yield 'a'
+            Entry.objects.count()
+            yield 'b'
+            Entry.objects.count()
+            yield 'c'
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META['wsgi.errors'] = errors = cStringIO.StringIO()
+        middleware = QueryBudgetMiddleware()
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse(body()))
+        # Nothing to check until the body has been sent.
+        self.assertEqual(errors.getvalue(), '')
+        content = response.content
+        return content, errors.getvalue()
+
+    def test_streamed_log(self):
+        settings.QUERY_BUDGET_ACTION = 'log'
+        content, errors = self.stream()
+        self.assertEqual(content, 'abc')
+        self.assertTrue('over budget GET : 2 queries' in errors)
+
+    def test_streamed_reject(self):
+        settings.QUERY_BUDGET_ACTION = 'reject'
+        content, errors = self.stream()
+        self.assertEqual(content, 'ab')
+        self.assertTrue('rejected GET : 1 queries' in errors)
+        # The limit is lifted once the body is done.
+        self.assertEqual(Entry.objects.count(), 1)
+        self.assertEqual(Entry.objects.count(), 1)
+
+
+class InstrumentTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+        self.enabled = instrument.ENABLED
+        instrument.ENABLED = True
+        for histogram in instrument.HISTOGRAMS:
+            histogram.reset()
+
+    def tearDown(self):
+        instrument.ENABLED = self.enabled
+        super(InstrumentTest, self).tearDown()
+
+    def test_histogram(self):
+        histogram = instrument.Histogram('test_seconds', 'Test.', (1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value, view='a')
+        self.assertEqual(histogram.lines()[2:], [
+            'test_seconds_bucket{view="a",le="1"} 2',
+            'test_seconds_bucket{view="a",le="10"} 3',
+            'test_seconds_bucket{view="a",le="+Inf"} 4',
+            'test_seconds_sum{view="a"} 56.5',
+            'test_seconds_count{view="a"} 4'])
+
+    def test_disabled(self):
+        instrument.ENABLED = False
+        function = lambda: 1
+        self.assertTrue(
+            instrument.VIEW_SECONDS.timed(view='x')(function) is function)
+        self.assertEqual(instrument.metrics(), '')
+
+    def test_metrics(self):
+        self.client.get('/on_this_day/', {'date': '2010-10-01'})
+        # Only for staff.
+        response = self.client.get('/metrics/')
+        self.assertTemplateUsed(response, 'admin/login.html')
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='krid', password='pw')
+        metrics = self.client.get('/metrics/').content
+        self.assertTrue('journal_view_seconds_count{view="journal.diary.'
+                        'views.on_this_day"} 1' in metrics)
+        self.assertTrue('journal_view_queries_bucket{view="journal.diary.'
+                        'views.on_this_day",le="+Inf"} 1' in metrics)
+
+    def test_profile(self):
+        url = '/timeline_json/life/'
+        # Only for staff.
+        response = self.client.get(url, {'profile': '1'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='krid', password='pw')
+        response = self.client.get(url, HTTP_X_PROFILE='1')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertTrue('function calls' in response.content)
+        self.assertTrue('iter_feed' in response.content)
+
+
+class GeneratorTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+
+    def test_generate(self):
+        counts = generator.Generator(self.user, years=2, chunk_size=7).\
+            run(200)
+        self.assertEqual(sum(counts.values()), 200)
+        self.assertEqual(Entry.objects.count(), counts[Entry])
+        self.assertEqual(BikeRide.objects.count(), counts[BikeRide])
+        self.assertTrue(DiningOut.company.through.objects.count() > 0)
+        self.assertEqual(timeline.check('diary'), [])
+        self.assertEqual(timeline.check('life'), [])
+        self.assertEqual(
+            TimelineEvent.objects.count(),
+            len(json.loads(timeline.feed('diary'))['events']) +
+            len(json.loads(timeline.feed('life'))['events']))
+
+
+class BenchmarkTest(JournalTestCase):
+
+    def setUp(self):
+        # Its own, so that the benchmark may see it.
+        self.user = benchmark.benchmark_user()
+        self.make_entry()
+
+    def test_run(self):
+        results = benchmark.Benchmark(iterations=3).run(
+            ['timeline_json diary', 'model_details Entry', 'admin Entry',
+             'as_timeline_dict Entry'])
+        self.assertEqual(sorted(results['cases']), [
+            'admin Entry', 'as_timeline_dict Entry', 'model_details Entry',
+            'timeline_json diary', 'timeline_json diary columnar',
+            'timeline_json diary year'])
+        for result in results['cases'].values():
+            self.assertEqual(result['runs'], 3)
+            self.assertTrue(result['p50_ms'] <= result['p99_ms'] <=
+                            result['max_ms'])
+        self.assertTrue(results['cases']['admin Entry']['queries'] > 0)
+        self.assertEqual(results['meta']['rows']['Entry'], 1)
+        self.assertEqual([row[4] for row in benchmark.compare(results,
+                                                              results)],
+                         [False] * 6)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchmark.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertEqual(benchmark.percentile([7], 0.9), 7)
+
+
+class VisibilityTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+        self.make_entry()
+        self.make_activities()
+        self.other = User.objects.create_user('other', 'o@example.com', 'pw')
+        self.other_entry = Entry.objects.create(date=self.day, summary='Entry',
+                                                mood='ok', user=self.other)
+        self.activity.private = True
+        self.activity.save()
+
+    def classes(self, user):
+        return sorted((event['classname'], event['id']) for event in
+                      json.loads(timeline.feed('diary', user=user))['events'])
+
+    def test_feeds(self):
+        everything = self.classes(None)
+        self.assertEqual(len(everything), 6)
+        mine = self.classes(self.user)
+        self.assertTrue(('Entry', str(self.entry.pk)) in mine)
+        self.assertFalse(('Entry', str(self.other_entry.pk)) in mine)
+        self.assertFalse(('Activity', str(self.activity.pk)) in mine)
+        self.user.is_staff = True
+        self.user.save()
+        mine = self.classes(self.user)
+        self.assertTrue(('Activity', str(self.activity.pk)) in mine)
+        self.assertFalse(('Entry', str(self.other_entry.pk)) in mine)
+        public = self.classes(AnonymousUser())
+        self.assertEqual([classname for classname, pk in public
+                          if classname in ('Entry', 'Activity')], [])
+        self.assertEqual(len(public), 3)
+        self.assertEqual(timeline.check('diary'), [])
+
+    def test_validators(self):
+        etags = set(timeline.validator('diary', user=user)[0] for user in
+                    (None, self.user, self.other, AnonymousUser()))
+        self.assertEqual(len(etags), 4)
+
+    def test_search(self):
+        hits = search.search_events('entry', user=self.user)
+        self.assertEqual([hit['id'] for hit in hits], [str(self.entry.pk)])
+        self.assertEqual(search.search_events('entry', user=AnonymousUser()),
+                         [])
+        self.assertEqual(len(search.search_events('entry')), 2)
+
+    def test_search_limit(self):
+        # The hidden entries score higher, but mustn't use up the limit.
+        for i in range(3):
+            Entry.objects.create(date=self.day, summary='Hike hike',
+                                 mood='ok', user=self.other)
+        self.activity.private = False
+        self.activity.save()
+        hits = search.search_events('hike', limit=1, user=self.user)
+        self.assertEqual([hit['id'] for hit in hits], [str(self.activity.pk)])
+
+    def test_details(self):
+        activity = '/details/Activity/{0}/'.format(self.activity.pk)
+        entry = '/details/Entry/{0}/'.format(self.entry.pk)
+        batch = dict(objects='Activity:{0},Entry:{1},DiningOut:{2}'.format(
+            self.activity.pk, self.entry.pk, self.dinner.pk))
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='krid', password='pw')
+        # Rendered, and cached, for the staff owner...
+        self.assertEqual(self.client.get(activity).status_code, 200)
+        self.assertEqual(self.client.get(entry).status_code, 200)
+        self.assertEqual(len(json.loads(self.client.get(
+            '/details_batch/', batch).content)), 3)
+        # ...but not handed to anyone else.
+        self.client.login(username='other', password='pw')
+        self.assertEqual(self.client.get(activity).status_code, 404)
+        self.assertEqual(self.client.get(entry).status_code, 404)
+        self.assertEqual(json.loads(self.client.get(
+            '/details_batch/', batch).content).keys(),
+                         ['DiningOut:{0}'.format(self.dinner.pk)])
+        self.client.logout()
+        self.assertEqual(self.client.get(activity).status_code, 404)
+
+    def test_view(self):
+        self.client.login(username='other', password='pw')
+        events = json.loads(self.client.get('/timeline_json/diary/').
+                            content)['events']
+        self.assertEqual(sorted(event['id'] for event in events
+                                if event['classname'] == 'Entry'),
+                         [str(self.other_entry.pk)])
+
+
+class DensityTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_people()
+        self.make_event()
+        self.make_period()
+
+    def test_years(self):
+        data = timeline.density('life', 'year')
+        self.assertEqual(data['classnames'], ['Event', 'Period', 'Person'])
+        self.assertEqual(data['buckets'][0],
+                         ['2010-01-01', '2010-12-31', [1, 1, 3]])
+        # The open-ended period counts in every year up to this one.
+        self.assertEqual(len(data['buckets']),
+                         datetime.date.today().year - 2009)
+        self.assertEqual(data['buckets'][-1][2], [0, 1, 0])
+
+    def test_decades(self):
+        self.period.end_date = datetime.date(2011, 6, 30)
+        self.period.save()
+        Event.objects.create(date=datetime.date(2001, 2, 3), summary='Move')
+        data = timeline.density('life', 'decade')
+        self.assertEqual(data['buckets'],
+                         [['2000-01-01', '2009-12-31', [1, 0, 0]],
+                          ['2010-01-01', '2019-12-31', [1, 1, 3]]])
+        window = timeline.density('life', 'month', datetime.date(2011, 1, 1),
+                                  datetime.date(2011, 2, 28))
+        self.assertEqual(window['buckets'],
+                         [['2011-01-01', '2011-01-31', [1]],
+                          ['2011-02-01', '2011-02-28', [1]]])
+
+    def test_view(self):
+        response = self.client.get('/timeline_density/life/',
+                                   {'resolution': 'century'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/timeline_density/life/',
+                                   {'resolution': 'year',
+                                    'start': '2010-01-01',
+                                    'end': '2010-12-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['buckets'],
+                         [['2010-01-01', '2010-12-31', [1, 1, 3]]])
+
+
+class BandTest(JournalTestCase):
+
+    def setUp(self):
+        self.make_user()
+        self.make_people()
+        self.make_event()
+        self.make_period()
+        self.jobs = Tag.objects.create(name='jobs')
+        self.concerts = Tag.objects.create(name='concerts')
+        self.period.tags = [self.jobs]
+        self.event.tags = [self.concerts]
+        for position, (name, tag, classnames) in enumerate((
+                ('Jobs', self.jobs, ''), ('Concerts', self.concerts, ''),
+                ('People', None, 'Person'))):
+            band = Band.objects.create(line_type='life', name=name,
+                                       position=position,
+                                       classnames=classnames)
+            if tag:
+                band.tags = [tag]
+
+    def contents(self, user=None):
+        return [(band.name, sorted(timeline.columnar_data(
+                     'life', user=user, band=band)['id']))
+                for band in timeline.bands('life', user)]
+
+    def test_bands(self):
+        self.assertEqual(self.contents(), [
+            ('Jobs', [self.period.pk]), ('Concerts', [self.event.pk]),
+            ('People', sorted(person.pk for person in self.people)),
+            ('Other', [])])
+        move = Event.objects.create(date=self.day, summary='Move')
+        self.assertEqual(self.contents()[-1], ('Other', [move.pk]))
+        Band.objects.create(line_type='life', name='Mine', user=self.user)
+        self.assertEqual([name for name, pks in self.contents(self.user)],
+                         ['Mine', 'Other'])
+        self.assertEqual(len(self.contents(AnonymousUser())), 4)
+
+    def test_tags(self):
+        def stored(obj):
+            return TimelineEvent.objects.get(model=obj.__class__.__name__,
+                                             object_id=obj.pk).tags
+        self.assertEqual(stored(self.period), ',{0},'.format(self.jobs.pk))
+        self.period.tags.add(self.concerts)
+        self.assertEqual(stored(self.period), ',{0},{1},'.format(
+            self.jobs.pk, self.concerts.pk))
+        self.concerts.event_set.clear()
+        self.assertEqual(stored(self.event), '')
+        self.jobs.delete()
+        self.assertEqual(stored(self.period), ',{0},'.format(self.concerts.pk))
+        self.assertEqual(timeline.check('life'), [])
+        timeline.rebuild('life')
+        self.assertEqual(stored(self.period), ',{0},'.format(self.concerts.pk))
+
+    def test_save_tagged(self):
+        self.event.summary = 'Encore'
+        self.event.save()
+        self.period.save()
+        stored = TimelineEvent.objects.get(model='Event',
+                                           object_id=self.event.pk)
+        self.assertEqual(stored.tags, ',{0},'.format(self.concerts.pk))
+        self.assertEqual(stored.title, 'Encore')
+        self.assertEqual(timeline.check('life'), [])
+
+    def etags(self):
+        return dict((band.name, timeline.validator('life', band=band)[0])
+                    for band in timeline.bands('life'))
+
+    def test_validators(self):
+        before = self.etags()
+        gig = Event.objects.create(date=self.day, summary='Gig')
+        gig.tags = [self.concerts]
+        after = self.etags()
+        self.assertNotEqual(after['Concerts'], before['Concerts'])
+        for name in ('Jobs', 'People', 'Other'):
+            self.assertEqual(after[name], before[name])
+
+    def test_view(self):
+        bands = json.loads(self.client.get('/timeline_bands/life/').
+                           content)['bands']
+        self.assertEqual([band['name'] for band in bands],
+                         ['Jobs', 'Concerts', 'People', 'Other'])
+        jobs, concerts = bands[0], bands[1]
+        self.assertEqual(jobs['feed']['id'], [self.period.pk])
+        bands = json.loads(self.client.get('/timeline_bands/life/', {
+            'have': '{0}:{1}'.format(jobs['id'], jobs['etag']),
+            'end.{0}'.format(concerts['id']): '2009-12-31'}).content)['bands']
+        self.assertEqual(bands[0]['etag'], jobs['etag'])
+        self.assertFalse('feed' in bands[0])
+        self.assertEqual(bands[1]['feed']['id'], [])
+        response = self.client.get('/timeline_bands/life/',
+                                   {'start': 'tuesday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class DetailsBatchTest(JournalTestCase):
 
-__test__ = {"doctest": """
-Another way to test that 1 + 1 is equal to 2.
+    def setUp(self):
+        self.make_user()
+        self.make_people()
+        self.make_entry()
+        self.make_activities()
+        self.dinner.company = self.people
+        self.make_event()
 
->>> 1 + 1 == 2
-True
-"""}
+    def test_queries(self):
+        socials = [SocialEvent.objects.create(date=self.day,
+                                              summary='Party {0}'.format(i),
+                                              reality=3) for i in range(5)]
+        for social in socials:
+            social.company = self.people
+        pks = [social.pk for social in socials]
+        bubblecache.invalidate(SocialEvent, pks)
+        one = count_queries(bubblecache.render_many, SocialEvent, pks[:1])
+        bubblecache.invalidate(SocialEvent, pks)
+        self.assertEqual(count_queries(bubblecache.render_many, SocialEvent,
+                                       pks), one)
+        self.assertEqual(sorted(bubblecache.render_many(SocialEvent, pks)),
+                         sorted(pks))
 
+    def test_view(self):
+        wanted = ['Entry:{0}'.format(self.entry.pk),
+                  'DiningOut:{0}'.format(self.dinner.pk),
+                  'Event:{0}'.format(self.event.pk), 'Event:999999']
+        # The entry is only for its owner.
+        self.client.login(username='krid', password='pw')
+        response = self.client.get('/details_batch/',
+                                   {'objects': ','.join(wanted)})
+        self.assertEqual(response.status_code, 200)
+        bubbles = json.loads(response.content)
+        self.assertEqual(sorted(bubbles), sorted(wanted[:3]))
+        self.assertEqual(bubbles[wanted[1]],
+                         details.render(DiningOut, [self.dinner.pk])
+                         [self.dinner.pk])
+        for objects in ('Nope:1', 'Entry:x'):
+            response = self.client.get('/details_batch/',
+                                       {'objects': objects})
+            self.assertEqual(response.status_code, 400)
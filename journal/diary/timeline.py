@@ -0,0 +1,725 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pre-encoded timeline events
+
+Each model that shows up on a timeline has a TimelineEvent row holding the
+JSON for its event.  Rows are rewritten when the source is saved and
+removed when it is deleted, so timeline_json never has to instantiate
+models or run json.dumps over the whole history.  Rebuilds work from
+values() rows, so they don't instantiate models either.
+
+Each event carries its owner (for Entries) and private flag, and the feeds
+take the user they're for, so that what a user may see is picked out in the
+query rather than after it; see visible().
+"""
+
+import json
+import hashlib
+import datetime
+import operator
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Max, Count
+from django.db.models import signals
+
+from journal.diary.models import Event, Period, Person, Activity, BikeRide, \
+    SocialEvent, DiningOut, Entry, MedicalObservation, TimelineEvent, Tag, \
+    Band
+from journal.diary import intervals
+from journal.diary import rollups
+from journal.diary.instrument import SERIALISE_SECONDS
+
+LINE_TYPES = {
+    'life': (Event, Period, Person),
+    'diary': (Activity, Entry, MedicalObservation),
+}
+
+# How many events to read from the database at a time.
+CHUNK_SIZE = 500
+
+# Columnar feeds give dates as days since this.
+EPOCH = datetime.date(1970, 1, 1)
+
+# How long to keep bands' feeds in the cache.  Keys include the band's
+# validator, so they never go stale, they just stop being asked for.
+BAND_TIMEOUT = 24 * 60 * 60
+
+# The event keys that get their own column in the columnar feed.
+COLUMNS = ('id', 'classname', 'title', 'start', 'end', 'durationEvent')
+
+# Everything in the feed except the events themselves.
+FEED_ENVELOPE = {
+    'wiki-url': "",
+    'wiki-section': "",
+    'dateTimeFormat': 'iso8601',
+}
+
+
+def line_type_for(model_class):
+    """ Return (line_type, timeline model) for a model class, walking up
+    from Activity subclasses to Activity itself.  Returns (None, None) for
+    models that aren't on a timeline.
+    """
+    for line_type, model_types in LINE_TYPES.items():
+        for model_type in model_types:
+            if issubclass(model_class, model_type):
+                return line_type, model_type
+    return None, None
+
+
+def _store(line_type, model_type, values, modified, event=None, tags=None):
+    """ Write the TimelineEvent for a row of model_type's timeline_fields.
+    tags is the row's tag ids, if they've already been read.
+    """
+    if event is None:
+        try:
+            event = TimelineEvent.objects.get(model=model_type.__name__,
+                                              object_id=values['id'])
+        except TimelineEvent.DoesNotExist:
+            event = TimelineEvent(model=model_type.__name__,
+                                  object_id=values['id'])
+    with SERIALISE_SECONDS.timer(what='timeline_dict'):
+        event_dict = model_type.timeline_dict(values)
+    event.line_type = line_type
+    event.start_date, event.end_date = model_type.timeline_span(values)
+    event.modified = modified
+    event.user_id, event.private = _audience(model_type, values)
+    if tags is None:
+        tags = _tag_ids(model_type, [values['id']]).get(values['id'], [])
+    event.tags = _encode_tags(tags)
+    with SERIALISE_SECONDS.timer(what='event json'):
+        event.fragment = json.dumps(event_dict)
+    event.classname = event_dict['classname']
+    event.title = event_dict['title']
+    event.extra = _extra(event_dict)
+    event.save()
+    return event
+
+
+def _audience(model_type, values):
+    """ Return (owner's id or None, private) for a row. """
+    owner = model_type.timeline_owner_field
+    private = model_type.timeline_private_field
+    return (owner and values[owner] or None,
+            bool(private and values[private]))
+
+
+def _tag_ids(model_type, pks=None):
+    """ Return {pk: [tag ids]} for the given instances of model_type, or all
+    of them, read from the link table in one query.
+    """
+    if not model_type.timeline_tags_field:
+        return {}
+    field = model_type._meta.get_field(model_type.timeline_tags_field)
+    # The link model's foreign keys, which give ids in values_list().
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    links = field.rel.through.objects.all()
+    if pks is not None:
+        links = links.filter(**{'{0}__in'.format(source): list(pks)})
+    tag_ids = {}
+    for pk, tag_id in links.values_list(source, target):
+        tag_ids.setdefault(pk, []).append(tag_id)
+    return tag_ids
+
+
+def _encode_tags(tag_ids):
+    """ Tag ids as stored in TimelineEvent.tags: ",3,17,", so that every id
+    is found by a contains lookup on ",<id>,".
+    """
+    if not tag_ids:
+        return ''
+    return ',{0},'.format(','.join(str(tag_id) for tag_id in sorted(tag_ids)))
+
+
+def _extra(event_dict):
+    """ Return the JSON for whatever in an event the columnar feed can't
+    carry in its columns, or '' if there's nothing.
+    """
+    extra = dict((key, value) for key, value in event_dict.items()
+                 if key not in COLUMNS)
+    if event_dict['durationEvent']:
+        extra['durationEvent'] = True
+    # The columns only hold days; keep the full value if there's a time.
+    for key in ('start', 'end'):
+        if ' ' in event_dict.get(key, ''):
+            extra[key] = event_dict[key]
+    return extra and json.dumps(extra) or ''
+
+
+def _rows(model_type):
+    """ Iterate over the timeline_fields (and modified time) of every
+    instance, as plain dicts from values(); no models are instantiated.
+    """
+    fields = model_type.timeline_fields + ('modified',)
+    return model_type.objects.values(*fields).iterator()
+
+
+def store_event(obj):
+    """ Create or refresh the TimelineEvent for obj. """
+    line_type, model_type = line_type_for(obj.__class__)
+    return _store(line_type, model_type, obj.timeline_values(), obj.modified)
+
+
+def store_events(model_class, pks):
+    """ Create or refresh the TimelineEvents for many objects at once,
+    reading their rows with values() a chunk at a time.  For rows written
+    behind the signals' back, e.g. by import_journal.  Returns the number
+    of events stored.
+    """
+    line_type, model_type = line_type_for(model_class)
+    if line_type is None:
+        return 0
+    fields = model_type.timeline_fields + ('modified',)
+    pks = list(pks)
+    count = 0
+    for i in range(0, len(pks), CHUNK_SIZE):
+        chunk = pks[i:i + CHUNK_SIZE]
+        events = dict((event.object_id, event) for event in
+                      TimelineEvent.objects.filter(model=model_type.__name__,
+                                                   object_id__in=chunk))
+        tag_ids = _tag_ids(model_type, chunk)
+        for values in model_type.objects.filter(pk__in=chunk).values(*fields):
+            event = events.get(values['id']) or \
+                TimelineEvent(model=model_type.__name__, object_id=values['id'])
+            _store(line_type, model_type, values, values['modified'], event,
+                   tag_ids.get(values['id'], []))
+            count += 1
+    return count
+
+
+def remove_event(obj):
+    line_type, model_type = line_type_for(obj.__class__)
+    TimelineEvent.objects.filter(model=model_type.__name__,
+                                 object_id=obj.pk).delete()
+
+
+def visible(queryset, user=None):
+    """ Limit a TimelineEvent queryset to what user may see: their own
+    events, and public ones that belong to nobody.  Private events with no
+    owner (Activities) are the journal keeper's, so only staff see them.
+    Anyone not signed in sees neither Entries nor private events.  A user of
+    None means everything, for the store's own use.
+    """
+    if user is None:
+        return queryset
+    if user.is_authenticated():
+        shared = Q(user__isnull=True)
+        if not user.is_staff:
+            shared &= Q(private=False)
+        return queryset.filter(shared | Q(user=user.pk))
+    return queryset.filter(user__isnull=True, private=False)
+
+
+def visible_pks(model_class, pks, user=None):
+    """ Return the set of pks (of model_class objects) whose events user
+    may see, as visible() decides.  Models off the timeline, or whose rows
+    are all public, keep every pk.
+    """
+    pks = set(pks)
+    line_type, model_type = line_type_for(model_class)
+    if user is None or model_type is None or \
+            not (model_type.timeline_owner_field or
+                 model_type.timeline_private_field):
+        return pks
+    return set(visible(TimelineEvent.objects.filter(
+        model=model_type.__name__, object_id__in=list(pks)), user).
+               values_list('object_id', flat=True))
+
+
+def partition(user=None):
+    """ The name of the slice of the store visible() gives user, for
+    telling apart their ETags & cached copies.
+    """
+    if user is None:
+        return 'all'
+    if user.is_authenticated():
+        return 'user-{0}{1}'.format(user.pk, user.is_staff and '-staff' or '')
+    return 'public'
+
+
+def window(line_type, start=None, end=None, user=None):
+    """ Return the TimelineEvents for line_type overlapping the window, that
+    user may see.  Either bound may be None, meaning open-ended.
+
+    Periods are the only events longer than a day; they come from the
+    interval tree.  Everything else is in the window if it starts there,
+    which is a range scan of the start_date index.
+    """
+    queryset = visible(TimelineEvent.objects.filter(line_type=line_type),
+                       user)
+    if not start and not end:
+        return queryset
+    days = Q()
+    if start:
+        days &= Q(start_date__gte=start)
+    if end:
+        days &= Q(start_date__lte=end)
+    if Period in LINE_TYPES[line_type]:
+        pks = intervals.periods().overlapping(start, end)
+        if len(pks) > intervals.MAX_KEYS:
+            # Too many to list; the stored spans have no open ends.
+            overlap = Q(model='Period')
+            if start:
+                overlap &= Q(end_date__gte=start)
+            if end:
+                overlap &= Q(start_date__lte=end)
+            days |= overlap
+        elif pks:
+            days |= Q(model='Period', object_id__in=pks)
+    return queryset.filter(days)
+
+
+def day_feed(day, user=None):
+    """ Return the JSON feed of what was going on on a day: the periods
+    spanning it, and everything else from either timeline dated that day.
+    """
+    head, tail = _envelope()
+    fragments = []
+    for line_type in sorted(LINE_TYPES):
+        for chunk in iter_fragments(line_type, day, day, user):
+            fragments.extend(chunk)
+    return head + ','.join(fragments) + tail
+
+
+def _envelope():
+    """ Return the JSON that goes (before, after) the list of events. """
+    envelope = json.dumps(FEED_ENVELOPE)
+    return '{0}, "events": ['.format(envelope[:-1]), ']}'
+
+
+def _iter_chunks(line_type, start, end, user, fields, chunk_size=CHUNK_SIZE,
+                 band=None):
+    """ Yield lists of (pk,) + fields tuples for the window's events (just
+    those in band, if given), chunk_size at a time.
+
+    Each chunk is a separate query picking up after the last pk seen, so
+    neither we nor the database driver ever hold the whole window.
+    """
+    queryset = window(line_type, start, end, user).order_by('pk')
+    if band is not None:
+        queryset = queryset.filter(band.q())
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).
+                     values_list('pk', *fields)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1][0]
+
+
+def iter_fragments(line_type, start=None, end=None, user=None,
+                   chunk_size=CHUNK_SIZE):
+    """ Yield lists of encoded events for the window, chunk_size at a time. """
+    for chunk in _iter_chunks(line_type, start, end, user, ('fragment',),
+                              chunk_size):
+        yield [fragment for pk, fragment in chunk]
+
+
+def iter_feed(line_type, start=None, end=None, user=None):
+    """ Yield the JSON feed for the window in pieces, for streaming. """
+    head, tail = _envelope()
+    yield head
+    separator = ''
+    for fragments in iter_fragments(line_type, start, end, user):
+        yield separator + ','.join(fragments)
+        separator = ','
+    yield tail
+
+
+def feed(line_type, start=None, end=None, user=None):
+    """ Return the JSON feed for the window as a single string. """
+    return ''.join(iter_feed(line_type, start, end, user))
+
+
+def columnar(line_type, start=None, end=None, user=None):
+    """ Return the window's feed in the compact columnar format, as JSON. """
+    data = columnar_data(line_type, start, end, user)
+    with SERIALISE_SECONDS.timer(what='columnar json'):
+        return json.dumps(data, separators=(',', ':'))
+
+
+# The TimelineEvent fields the columnar feed is built from.
+COLUMNAR_FIELDS = ('object_id', 'classname', 'title', 'start_date',
+                   'end_date', 'extra')
+
+
+@SERIALISE_SECONDS.timed(what='columnar data')
+def columnar_data(line_type, start=None, end=None, user=None, band=None):
+    """ Return the window's feed (or just band's share of it) in the compact
+    columnar format.
+
+    Instead of a list of event objects, each field gets a list of its own,
+    index i in each list belonging to the i'th event:
+
+        id          integer ids
+        classname   indexes into the "classnames" list
+        start       days since "epoch"
+        end         days since "epoch" for duration events, otherwise null
+        title       titles
+
+    Anything else (captions, fuzzy Period bounds, times of day) goes in
+    "extra", keyed by event index, and is merged over the rebuilt event.
+    journal.js (decodeColumnar) turns it back into the usual feed.
+    """
+    return _columnar(row for chunk in _iter_chunks(line_type, start, end,
+                                                   user, COLUMNAR_FIELDS,
+                                                   band=band)
+                     for row in chunk)
+
+
+def _columnar(rows):
+    """ Build the columnar feed from (pk,) + COLUMNAR_FIELDS rows. """
+    data = dict(FEED_ENVELOPE, format='columnar', epoch=str(EPOCH),
+                classnames=[], extra={})
+    for column in ('id', 'classname', 'start', 'end', 'title'):
+        data[column] = []
+    classnames = {}
+    for index, row in enumerate(rows):
+        pk, object_id, classname, title, start_date, end_date, extra = row
+        if classname not in classnames:
+            classnames[classname] = len(data['classnames'])
+            data['classnames'].append(classname)
+        extra = extra and json.loads(extra) or {}
+        end_day = None
+        if extra.pop('durationEvent', False):
+            end_day = (end_date - EPOCH).days
+        data['id'].append(object_id)
+        data['classname'].append(classnames[classname])
+        data['start'].append((start_date - EPOCH).days)
+        data['end'].append(end_day)
+        data['title'].append(title)
+        if extra:
+            data['extra'][index] = extra
+    return data
+
+
+# The key of the band for events in none of the others.
+OTHER = 'other'
+
+
+class BandFilter(object):
+    """ Which of a line's events go in one band: those of the classnames
+    with any of the tag ids (either empty meaning any), less those in the
+    bands it excludes.
+    """
+
+    def __init__(self, key, name, classnames=(), tag_ids=(), exclude=()):
+        self.key = key
+        self.name = name
+        self.classnames = sorted(classnames)
+        self.tag_ids = sorted(tag_ids)
+        self.exclude = list(exclude)
+
+    def everything(self):
+        return not self.classnames and not self.tag_ids and not self.exclude
+
+    def q(self):
+        """ Return the band as a filter on TimelineEvents. """
+        q = Q()
+        if self.classnames:
+            q &= Q(classname__in=self.classnames)
+        if self.tag_ids:
+            q &= reduce(operator.or_, [
+                Q(tags__contains=_encode_tags([tag_id]))
+                for tag_id in self.tag_ids])
+        for other in self.exclude:
+            if other.everything():
+                return Q(pk__in=[])
+            q &= ~other.q()
+        return q
+
+    def definition(self):
+        """ The band's filter as a string, for its ETag. """
+        return '{0}[{1}|{2}|{3}]'.format(self.key, ' '.join(self.classnames),
+            ','.join(str(tag_id) for tag_id in self.tag_ids),
+            ';'.join(other.definition() for other in self.exclude))
+
+
+def bands(line_type, user=None):
+    """ Return BandFilters for user's Bands of line_type, in order, then
+    one for the "other" band holding what's in none of them.  Users who
+    haven't defined any bands (or a user of None) get the defaults; with no
+    bands at all the other band is the whole line.
+    """
+    defined = Band.objects.filter(line_type=line_type)
+    own = []
+    if user is not None and user.is_authenticated():
+        own = list(defined.filter(user=user.pk))
+    defined = own or list(defined.filter(user__isnull=True))
+    tag_ids = {}
+    if defined:
+        for band_id, tag_id in Band.tags.through.objects.filter(
+                band__in=[band.pk for band in defined]).\
+                values_list('band', 'tag'):
+            tag_ids.setdefault(band_id, []).append(tag_id)
+    filters = [BandFilter(str(band.pk), band.name, band.classnames.split(),
+                          tag_ids.get(band.pk, []))
+               for band in defined]
+    return filters + [BandFilter(OTHER, 'Other', exclude=filters)]
+
+
+def band_data(line_type, band, start=None, end=None, user=None, etag=None):
+    """ Return the columnar feed of band's events in the window.
+
+    Given the band's ETag (from validator()) the feed is cached under it.
+    That only moves when the band's own events do, so editing a concert
+    leaves the cached jobs band in use.
+    """
+    key = etag and 'band:{0}'.format(etag)
+    data = key and cache.get(key)
+    if data is None:
+        data = columnar_data(line_type, start, end, user, band)
+        if key:
+            cache.set(key, data, BAND_TIMEOUT)
+    return data
+
+
+# Bucket sizes for density().
+RESOLUTIONS = ('month', 'year', 'decade')
+
+
+def density(line_type, resolution, start=None, end=None, user=None):
+    """ Return how many events of each class fall in each month, year or
+    decade of the window, for the overview bands, which can't usefully draw
+    every event:
+
+        {"resolution": "year", "classnames": ["Event", "Period", "Person"],
+         "buckets": [["2009-01-01", "2009-12-31", [2, 1, 5]], ...]}
+
+    Counts are in the order of classnames, and empty buckets are left out.
+    Point events are counted by the database, grouped by day; a period
+    counts in every bucket it overlaps, up to today if it's open-ended.
+    """
+    events = window(line_type, start, end, user)
+    counts = {}
+    first = None
+    for classname, day, count in events.exclude(model='Period').\
+            values_list('classname', 'start_date').\
+            annotate(count=Count('id')).order_by():
+        bucket = rollups.bucket_start(resolution, day)
+        counts[bucket, classname] = counts.get((bucket, classname), 0) + count
+        first = min(first or day, day)
+    last = end or datetime.date.today()
+    for classname, period_start, period_end in \
+            events.filter(model='Period').\
+            values_list('classname', 'start_date', 'end_date'):
+        if period_start == intervals.BEGINNING:
+            period_start = first or min(period_end, last)
+        period_start = max(period_start, start or period_start)
+        period_end = min(period_end, last)
+        bucket = rollups.bucket_start(resolution, period_start)
+        while bucket <= period_end:
+            counts[bucket, classname] = counts.get((bucket, classname), 0) + 1
+            bucket = rollups.bucket_end(resolution, bucket) + \
+                datetime.timedelta(days=1)
+    classnames = sorted(set(classname for key, classname in counts))
+    return dict(resolution=resolution, classnames=classnames, buckets=[
+        [str(key), str(rollups.bucket_end(resolution, key)),
+         [counts.get((key, classname), 0) for classname in classnames]]
+        for key in sorted(set(key for key, classname in counts))])
+
+
+def month_window(month):
+    """ Return the (first, last) days of a "YYYY-MM" month.  Raises
+    ValueError for bad months.
+    """
+    first = datetime.datetime.strptime(month, '%Y-%m').date()
+    next_month = (first + datetime.timedelta(days=31)).replace(day=1)
+    return first, next_month - datetime.timedelta(days=1)
+
+
+def validator(line_type, start=None, end=None, variant='', user=None,
+              band=None):
+    """ Return (etag, last_modified) for the window's feed as user sees it,
+    or for just band's share of it.  Different renderings of the same window
+    (variant), different users' views of it, and different bands get
+    different ETags.
+
+    The newest modified time catches edits and additions, the row count
+    catches deletions, which would otherwise leave the time unchanged.
+    """
+    events = window(line_type, start, end, user)
+    if band is not None:
+        events = events.filter(band.q())
+        variant = '{0}:{1}'.format(variant, band.definition())
+    stats = events.aggregate(latest=Max('modified'), count=Count('id'))
+    return _etag(line_type, start, end, variant, user, stats['count'],
+                 stats['latest']), stats['latest']
+
+
+def _etag(line_type, start, end, variant, user, count, latest):
+    return hashlib.md5('{0}:{1}:{2}:{3}:{4}:{5}:{6}'.format(line_type, start,
+        end, variant, partition(user), count, latest)).hexdigest()
+
+
+@SERIALISE_SECONDS.timed(what='columnar data')
+def month_feeds(line_type, months, user=None, known=None):
+    """ Return {month: {"etag": etag, "feed": columnar feed}} for a list
+    of "YYYY-MM" months, as user sees them, leaving out the feed of months
+    whose etag is already known ({month: etag}).  The etags are those
+    validator() gives for the month's columnar feed.  Raises ValueError
+    for bad months.
+
+    The events of all the months are read in one query, and sorted into
+    months here, so the cost doesn't grow with the number of months.
+    """
+    known = known or {}
+    windows = dict((month, month_window(month)) for month in months)
+    if not windows:
+        return {}
+    rows = list(window(line_type, min(first for first, last in
+                                      windows.values()),
+                       max(last for first, last in windows.values()),
+                       user).order_by('pk').
+                values_list('pk', 'modified', 'model', *COLUMNAR_FIELDS))
+    tree = Period in LINE_TYPES[line_type] and intervals.periods() or None
+    data = {}
+    for month, (first, last) in windows.items():
+        # The same test window() makes, run over the rows in hand.
+        periods = tree and set(tree.overlapping(first, last)) or set()
+        inside = [row for row in rows if first <= row[6] <= last or
+                  (row[2] == 'Period' and row[3] in periods)]
+        latest = inside and max(row[1] for row in inside) or None
+        etag = _etag(line_type, first, last, 'columnar', user, len(inside),
+                     latest)
+        data[month] = dict(etag=etag)
+        if etag != known.get(month):
+            data[month]['feed'] = _columnar(row[:1] + row[3:]
+                                            for row in inside)
+    return data
+
+
+@transaction.commit_on_success
+def rebuild(line_type):
+    """ Throw away the stored events for line_type and re-encode them all
+    from the live rows.  Returns the number of events stored.
+    """
+    TimelineEvent.objects.filter(line_type=line_type).delete()
+    count = 0
+    for model_type in LINE_TYPES[line_type]:
+        tag_ids = _tag_ids(model_type)
+        for values in _rows(model_type):
+            _store(line_type, model_type, values, values['modified'],
+                   TimelineEvent(model=model_type.__name__,
+                                 object_id=values['id']),
+                   tag_ids.get(values['id'], []))
+            count += 1
+    return count
+
+
+def check(line_type):
+    """ Compare the stored events for line_type against the live rows.
+
+    Returns a list of problem descriptions; an empty list means the store
+    is consistent.
+    """
+    problems = []
+    for model_type in LINE_TYPES[line_type]:
+        model = model_type.__name__
+        stored = dict((event.object_id, event) for event in
+                      TimelineEvent.objects.filter(model=model))
+        tag_ids = _tag_ids(model_type)
+        for values in _rows(model_type):
+            pk = values['id']
+            event = stored.pop(pk, None)
+            if event is None:
+                problems.append('{0} {1}: missing'.format(model, pk))
+                continue
+            start, end = model_type.timeline_span(values)
+            event_dict = model_type.timeline_dict(values)
+            if (event.line_type != line_type or
+                str(event.start_date) != str(start) or
+                str(event.end_date) != str(end) or
+                event.fragment != json.dumps(event_dict) or
+                event.title != event_dict['title'] or
+                event.extra != _extra(event_dict) or
+                (event.user_id, event.private) !=
+                    _audience(model_type, values) or
+                event.tags != _encode_tags(tag_ids.get(pk, []))):
+                problems.append('{0} {1}: stale'.format(model, pk))
+        for pk in sorted(stored):
+            problems.append('{0} {1}: orphaned'.format(model, pk))
+    return problems
+
+
+def _saved(sender, instance, raw=False, **kwargs):
+    # Fixture loads save subclasses without their parent fields; rebuild
+    # the store afterwards instead.
+    if not raw:
+        store_event(instance)
+
+
+def _deleted(sender, instance, **kwargs):
+    remove_event(instance)
+
+
+def _retag(model_class, pks):
+    """ Some objects' tags changed; bump their modified times, so their
+    bands' ETags move, and store them again.
+    """
+    pks = list(pks)
+    if pks:
+        model_class.objects.filter(pk__in=pks).update(
+            modified=datetime.datetime.now())
+        store_events(model_class, pks)
+
+
+def _tags_changed(sender, instance, action, reverse, model, pk_set,
+                  **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            _retag(instance.__class__, [instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        _retag(model, pk_set)
+    elif action == 'pre_clear':
+        # Clearing a tag's events only says which tag afterwards.
+        instance._timeline_untagged = list(model.objects.filter(
+            tags=instance.pk).values_list('pk', flat=True))
+    elif action == 'post_clear':
+        _retag(model, getattr(instance, '_timeline_untagged', ()))
+
+
+def _tag_deleting(sender, instance, **kwargs):
+    instance._timeline_untagged = [
+        (model_type, list(model_type.objects.filter(tags=instance.pk).
+                          values_list('pk', flat=True)))
+        for model_type in (Event, Period)]
+
+
+def _tag_deleted(sender, instance, **kwargs):
+    for model_type, pks in getattr(instance, '_timeline_untagged', ()):
+        _retag(model_type, pks)
+
+
+for _sender in (Event, Period, Person, Activity, BikeRide, SocialEvent,
+                DiningOut, Entry, MedicalObservation):
+    signals.post_save.connect(_saved, sender=_sender,
+        dispatch_uid='timeline-save-{0}'.format(_sender.__name__))
+    signals.post_delete.connect(_deleted, sender=_sender,
+        dispatch_uid='timeline-delete-{0}'.format(_sender.__name__))
+for _owner in (Event, Period):
+    signals.m2m_changed.connect(_tags_changed, sender=_owner.tags.through,
+        dispatch_uid='timeline-tags-{0}'.format(_owner.__name__))
+signals.pre_delete.connect(_tag_deleting, sender=Tag,
+                           dispatch_uid='timeline-deleting-Tag')
+signals.post_delete.connect(_tag_deleted, sender=Tag,
+                            dispatch_uid='timeline-delete-Tag')
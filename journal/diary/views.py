@@ -16,46 +16,436 @@
 
 import json
 import datetime
+import hashlib
 
-from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import render_to_response
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 
 from journal.diary.models import *
 from journal.diary import models as diary_models
+from journal.diary import timeline as timeline_store
+from journal.diary import bubblecache
+from journal.diary import details
+from journal.diary import compression
+from journal.diary import search
+from journal.diary import rollups
+from journal.diary import backup
+from journal.diary import instrument
 
 
 def timeline(request, line_type):
     params = dict(line_type=line_type,
                   today=datetime.datetime.now().strftime('%Y-%m-%d'))
+    bands = timeline_store.bands(_line_type(line_type), request.user)
+    if len(bands) > 1:
+        # Bands have been set up, so the page gets one for each.
+        params['bands'] = bands
     return render_to_response('timeline.html', params)
 
 
+def _parse_window(request, band=None):
+    """ Pull the optional start & end dates (YYYY-MM-DD) of the visible
+    window out of the query string; a band's own start.<band> & end.<band>
+    win if given.  Raises ValueError for bad dates.
+    """
+    window = []
+    for param in ('start', 'end'):
+        value = request.GET.get(param)
+        if band is not None:
+            value = request.GET.get('{0}.{1}'.format(param, band), value)
+        if value:
+            value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        window.append(value or None)
+    return window
+
+
+def _line_type(line_type):
+    return line_type == 'life' and 'life' or 'diary'
+
+
+def _timeline_validator(request, line_type):
+    """ Return (etag, last_modified) for the requested feed window, or
+    (None, None) if the window is bad.  Memoised on the request, since
+    condition() asks for each half separately.
+    """
+    if not hasattr(request, '_timeline_validator'):
+        try:
+            start, end = _parse_window(request)
+        except ValueError:
+            request._timeline_validator = (None, None)
+        else:
+            request._timeline_validator = timeline_store.validator(
+                _line_type(line_type), start, end,
+                request.GET.get('format', ''), request.user)
+    return request._timeline_validator
+
+
+def _timeline_etag(request, line_type):
+    return compression.variant_etag(
+        request, _timeline_validator(request, line_type)[0])
+
+
+def _timeline_last_modified(request, line_type):
+    return _timeline_validator(request, line_type)[1]
+
+
+@condition(etag_func=_timeline_etag,
+           last_modified_func=_timeline_last_modified)
 def timeline_json(request, line_type):
-    data = {
-            'wiki-url':"",
-            'wiki-section':"",
-            'dateTimeFormat': 'iso8601',
-            'events': [],
-            }
-    if line_type == 'life':
-        model_types = (Event, Period, Person)
-    else: # line_type == 'diary'
-        model_types = (Activity, Entry, MedicalObservation)
-    # TODO Need to honor the "private" flag on Entry (and other models?)
-    for model_type in model_types:
-        data['events'].extend([obj.as_timeline_dict() for obj in model_type.objects.all()])
-    return HttpResponse(json.dumps(data), mimetype='application/json')
+    """ Feed events to the timeline.
 
+    If start and/or end dates are given only events overlapping that window
+    are sent, so the page can load the bands incrementally as they scroll.
+    The events come pre-encoded from the timeline store.  Clients holding an
+    up to date copy get a 304 from condition() before we get here.
 
-def model_details(request, model_type, pk):
-    """ Render the template to fill in a bubble on the timeline. """
+    With format=columnar the events are sent in the compact columnar format
+    (see diary.timeline.columnar) instead of Simile's.
+    """
+    try:
+        start, end = _parse_window(request)
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be formatted YYYY-MM-DD")
+    # Only what this user may see; the ETag covers just that too, so a
+    # cached compressed copy is per user.
+    if request.GET.get('format') == 'columnar':
+        content = timeline_store.columnar(_line_type(line_type), start, end,
+                                          request.user)
+    else:
+        # Stream the feed (compressed as it goes, if it's compressed), so
+        # memory use doesn't grow with the history.
+        content = timeline_store.iter_feed(_line_type(line_type), start, end,
+                                           request.user)
+    response = compression.compressed_response(
+        request, _timeline_validator(request, line_type)[0], content,
+        'application/json')
+    # Make the browser check back with us, rather than guess at freshness,
+    # and keep shared caches from handing one user's feed to another.
+    patch_cache_control(response, max_age=0, must_revalidate=True,
+                        private=True)
+    return response
+
+
+def _density_validator(request, line_type):
+    """ Like _timeline_validator, for timeline_density. """
+    if not hasattr(request, '_density_validator'):
+        try:
+            start, end = _parse_window(request)
+        except ValueError:
+            request._density_validator = (None, None)
+        else:
+            request._density_validator = timeline_store.validator(
+                _line_type(line_type), start, end,
+                'density:{0}'.format(request.GET.get('resolution')),
+                request.user)
+    return request._density_validator
+
+
+def _density_etag(request, line_type):
+    return compression.variant_etag(
+        request, _density_validator(request, line_type)[0])
+
+
+def _density_last_modified(request, line_type):
+    return _density_validator(request, line_type)[1]
+
+
+@condition(etag_func=_density_etag,
+           last_modified_func=_density_last_modified)
+def timeline_density(request, line_type):
+    """ Counts of events per month, year or decade (resolution), by class,
+    for the overview bands; see diary.timeline.density.  Takes optional
+    start & end dates like timeline_json.
+    """
+    resolution = request.GET.get('resolution')
+    if resolution not in timeline_store.RESOLUTIONS:
+        return HttpResponseBadRequest("resolution must be one of {0}".format(
+            ', '.join(timeline_store.RESOLUTIONS)))
+    try:
+        start, end = _parse_window(request)
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be formatted YYYY-MM-DD")
+
+    def content():
+        # Only run when the compressed copy isn't cached already.
+        data = timeline_store.density(_line_type(line_type), resolution,
+                                      start, end, request.user)
+        with instrument.SERIALISE_SECONDS.timer(what='density json'):
+            yield json.dumps(data, separators=(',', ':'))
+    response = compression.compressed_response(
+        request, _density_validator(request, line_type)[0], content(),
+        'application/json', whole=True)
+    patch_cache_control(response, max_age=0, must_revalidate=True,
+                        private=True)
+    return response
+
+
+# The most months timeline_months will answer for at once.
+MAX_MONTHS = 60
+
+
+def timeline_months(request, line_type):
+    """ Feed events to the timeline a month at a time, for clients that
+    keep months they've already seen.
+
+    The months parameter is a comma separated list of "YYYY-MM", each
+    optionally followed by ":<etag>" when the client already has that month.
+    The response maps each month to its current etag, plus its events (in
+    the columnar format) if the client's copy is missing or out of date.
+    """
+    line_type = _line_type(line_type)
+    months = [m for m in request.GET.get('months', '').split(',') if m]
+    if len(months) > MAX_MONTHS:
+        return HttpResponseBadRequest("Too many months")
+    known = dict(month.partition(':')[::2] for month in months)
+    try:
+        data = timeline_store.month_feeds(line_type, list(known),
+                                          request.user, known)
+    except ValueError:
+        return HttpResponseBadRequest("Months must be formatted YYYY-MM")
+    with instrument.SERIALISE_SECONDS.timer(what='months json'):
+        content = json.dumps(data, separators=(',', ':'))
+    response = HttpResponse(content, mimetype='application/json')
+    patch_cache_control(response, no_cache=True, private=True)
+    return response
+
+
+def timeline_bands(request, line_type):
+    """ Feed the events of each of the user's bands (see
+    diary.timeline.bands) in one request, sorted out by the database rather
+    than by the client.
+
+    start & end give the window as for timeline_json, and start.<id> &
+    end.<id> a band's own window.  The have parameter is a comma separated
+    list of "<id>:<etag>" for bands the client already holds.  The response
+    lists the bands in order, each with its id, name and current etag, plus
+    its events (in the columnar format) if the client's copy is missing or
+    out of date.  Each band is cached separately, under its own etag.
+    """
+    line_type = _line_type(line_type)
+    have = dict(item.partition(':')[::2]
+                for item in request.GET.get('have', '').split(',') if item)
+    data = []
+    for band in timeline_store.bands(line_type, request.user):
+        try:
+            start, end = _parse_window(request, band.key)
+        except ValueError:
+            return HttpResponseBadRequest("Dates must be formatted YYYY-MM-DD")
+        etag = timeline_store.validator(line_type, start, end, 'columnar',
+                                        request.user, band)[0]
+        answer = dict(id=band.key, name=band.name, etag=etag)
+        if etag != have.get(band.key):
+            answer['feed'] = timeline_store.band_data(line_type, band, start,
+                                                      end, request.user, etag)
+        data.append(answer)
+    with instrument.SERIALISE_SECONDS.timer(what='bands json'):
+        content = json.dumps(dict(bands=data), separators=(',', ':'))
+    response = HttpResponse(content, mimetype='application/json')
+    patch_cache_control(response, no_cache=True, private=True)
+    return response
+
+
+def _detail_model(model_type):
+    """ Return the model class named model_type if it's a type we're
+    prepared to render, otherwise None.
+    """
     try:
-        # Make sure it's a type we're prepared to render.
         model_class = getattr(diary_models, model_type)
         getattr(model_class, 'as_timeline_dict')
     except AttributeError:
+        return None
+    return model_class
+
+
+def _details_validator(request, model_type, pk):
+    """ Return (etag, last_modified) for a bubble, or (None, None) if there's
+    no such object or request.user may not see it.  Memoised on the request
+    like _timeline_validator.
+    """
+    if not hasattr(request, '_details_validator'):
+        request._details_validator = (None, None)
+        model_class = _detail_model(model_type)
+        if model_class is not None and pk.isdigit() and \
+                timeline_store.visible_pks(model_class, [int(pk)],
+                                           request.user):
+            modified = model_class.objects.filter(id=pk).\
+                values_list('modified', flat=True)
+            if modified:
+                etag = hashlib.md5('{0}:{1}:{2}'.format(model_type, pk,
+                                                        modified[0]))
+                request._details_validator = (etag.hexdigest(), modified[0])
+    return request._details_validator
+
+
+def _details_etag(request, model_type, pk):
+    return _details_validator(request, model_type, pk)[0]
+
+
+def _details_last_modified(request, model_type, pk):
+    return _details_validator(request, model_type, pk)[1]
+
+
+@condition(etag_func=_details_etag,
+           last_modified_func=_details_last_modified)
+def model_details(request, model_type, pk):
+    """ Render the template to fill in a bubble on the timeline.
+
+    The object's modified time validates the bubble, so re-opening one the
+    browser already has costs a single indexed lookup and a 304.  The same
+    lookup finds the rendered bubble in the cache for other browsers.
+    Objects the user may not see (see diary.timeline.visible) are 404s, so
+    the cached bubbles, which are the same for everyone, are only handed
+    to users who may see them.
+    """
+    model_class = _detail_model(model_type)
+    if model_class is None:
         return HttpResponseBadRequest("Can't render type '{0}'".format(model_type))
 
-    obj = get_object_or_404(model_class, id=pk)
-    return render_to_response('details/{0}.html'.format(model_type),
-                              dict(obj=obj))
+    modified = _details_last_modified(request, model_type, pk)
+    if modified is None:
+        raise Http404
+    html = bubblecache.lookup(model_type, pk, modified)
+    if not html:
+        html = details.render(model_class, [int(pk)]).get(int(pk))
+        if html is None:
+            raise Http404
+        bubblecache.store(model_type, pk, modified, html)
+    response = HttpResponse(html)
+    patch_cache_control(response, max_age=0, must_revalidate=True,
+                        private=True)
+    return response
+
+
+# The most bubbles details_batch will render at once.
+MAX_DETAILS = 100
+
+
+def details_batch(request):
+    """ Render many bubbles in one request, for pages prefetching the
+    bubbles of the events on screen.
+
+    The objects parameter is a comma separated list of "<type>:<pk>".  The
+    response maps each of those that exists, and that the user may see, to
+    its bubble.  The objects are grouped by type and each type is rendered with its DetailPlan (see
+    bubblecache.render_many), so the queries don't grow with the batch.
+    """
+    items = [item for item in request.GET.get('objects', '').split(',')
+             if item]
+    if len(items) > MAX_DETAILS:
+        return HttpResponseBadRequest("Too many objects")
+    wanted = {}
+    for item in items:
+        model_type, _, pk = item.partition(':')
+        model_class = _detail_model(model_type)
+        if model_class is None or not pk.isdigit():
+            return HttpResponseBadRequest("Can't render '{0}'".format(item))
+        wanted.setdefault(model_class, set()).add(int(pk))
+    data = {}
+    for model_class, pks in wanted.items():
+        pks = timeline_store.visible_pks(model_class, pks, request.user)
+        for pk, html in bubblecache.render_many(model_class, pks).items():
+            data['{0}:{1}'.format(model_class.__name__, pk)] = html
+    with instrument.SERIALISE_SECONDS.timer(what='details json'):
+        content = json.dumps(data, separators=(',', ':'))
+    response = HttpResponse(content, mimetype='application/json')
+    patch_cache_control(response, no_cache=True, private=True)
+    return response
+
+
+def on_this_day(request):
+    """ What was going on on a day (today unless date is given), as a feed:
+    the periods spanning it and everything else dated that day.
+    """
+    try:
+        day = datetime.datetime.strptime(request.GET.get('date') or
+            datetime.date.today().strftime('%Y-%m-%d'), '%Y-%m-%d').date()
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be formatted YYYY-MM-DD")
+    return HttpResponse(timeline_store.day_feed(day, request.user),
+                        mimetype='application/json')
+
+
+# The most hits search_json will return.
+MAX_HITS = 200
+
+
+def search_json(request):
+    """ Search everything, returning the hits as timeline events, best
+    first.  Takes q (the words to look for, all of which must match),
+    optional start & end dates, and limit.
+    """
+    try:
+        start, end = _parse_window(request)
+        limit = min(int(request.GET.get('limit', 50)), MAX_HITS)
+    except ValueError:
+        return HttpResponseBadRequest("Bad dates or limit")
+    data = dict(timeline_store.FEED_ENVELOPE,
+                events=search.search_events(request.GET.get('q', ''),
+                                            start, end, limit, request.user))
+    with instrument.SERIALISE_SECONDS.timer(what='search json'):
+        content = json.dumps(data)
+    return HttpResponse(content, mimetype='application/json')
+
+
+def stats_json(request, series, period):
+    """ A statistics series for charting: one [start, count, total, mean]
+    per day, week, month or year, optionally limited by start & end dates.
+    """
+    if series not in rollups.SERIES or period not in rollups.PERIODS:
+        return HttpResponseBadRequest("Unknown series or period")
+    try:
+        start, end = _parse_window(request)
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be formatted YYYY-MM-DD")
+    data = dict(series=series, period=period,
+                buckets=[[bucket.strftime('%Y-%m-%d'), count, total,
+                          total / count]
+                         for bucket, count, total in
+                         rollups.buckets(series, period, start, end)])
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
+def stats_index(request):
+    """ The statistics series and periods stats_json knows about. """
+    data = dict(series=sorted(rollups.SERIES), periods=rollups.PERIODS)
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
+@staff_member_required
+def export(request):
+    """ Stream a backup of the whole journal as newline-delimited JSON, or
+    with format=gzip as a gzipped file.  Takes an optional since
+    (YYYY-MM-DD HH:MM:SS) for an incremental backup.
+    """
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = datetime.datetime.strptime(since, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return HttpResponseBadRequest(
+                "since must be formatted YYYY-MM-DD HH:MM:SS")
+    name = 'journal-{0}.ndjson'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    content = backup.iter_lines(since)
+    if request.GET.get('format') == 'gzip':
+        content = backup.iter_gzip(content)
+        name += '.gz'
+        mimetype = 'application/x-gzip'
+    else:
+        mimetype = 'application/x-ndjson'
+    response = HttpResponse(content, mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename={0}'.format(name)
+    patch_cache_control(response, no_cache=True, private=True)
+    return response
+
+
+@staff_member_required
+def metrics(request):
+    """ Counters for monitoring, in Prometheus text format, with the
+    instrumentation's histograms when it's on.
+    """
+    return HttpResponse(bubblecache.metrics() + instrument.metrics(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,195 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Query budget
+
+QueryBudgetMiddleware counts the queries each request makes, and the time
+spent in them, whatever DEBUG says.  A request that goes over
+settings.QUERY_BUDGET_QUERIES queries or QUERY_BUDGET_SECONDS of database
+time is written to the error log (wsgi.errors, Apache's error log under
+mod_wsgi) with its counts, so that an N+1 shows up the first time it runs.
+With QUERY_BUDGET_ACTION = 'reject' the query that goes over raises
+QueryBudgetExceeded instead, and the request gets a 503.
+
+A streamed response (one built from an iterator, like the timeline feeds)
+makes its queries after the view has returned, so its budget runs until the
+last piece has been sent.  Going over it then can't turn into a 503, since
+the headers are already gone: the error is logged and the body cut short.
+
+It should come first in MIDDLEWARE_CLASSES, so that it sees the queries
+made by the other middleware.
+"""
+
+import sys
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Tally(object):
+    """ Queries made through one connection, by one thread: in this request,
+    and in total.
+    """
+
+    def __init__(self):
+        self.total_queries = 0
+        self.total_seconds = 0.0
+        self.reset()
+
+    def reset(self, max_queries=None, max_seconds=None):
+        self.queries = 0
+        self.seconds = 0.0
+        # Limits to enforce, or None.
+        self.max_queries = max_queries
+        self.max_seconds = max_seconds
+
+    def check(self):
+        if self.max_queries is not None and \
+                self.queries >= self.max_queries:
+            raise QueryBudgetExceeded("More than {0} queries".format(
+                self.max_queries))
+        if self.max_seconds is not None and \
+                self.seconds > self.max_seconds:
+            raise QueryBudgetExceeded("More than {0}s in the database".format(
+                self.max_seconds))
+
+
+class CountingCursor(object):
+    """ Wraps a cursor, adding its queries to a Tally. """
+
+    def __init__(self, cursor, tally):
+        self.cursor = cursor
+        self.tally = tally
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def _timed(self, method, *args):
+        self.tally.check()
+        started = time.time()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.time() - started
+            self.tally.queries += 1
+            self.tally.seconds += elapsed
+            self.tally.total_queries += 1
+            self.tally.total_seconds += elapsed
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def tally(connection):
+    """ Return this thread's Tally for a connection, wrapping its cursors
+    the first time.  Database wrappers are thread-local, so the wrapping is
+    per thread too.
+    """
+    current = getattr(connection, 'query_tally', None)
+    if current is None:
+        current = connection.query_tally = Tally()
+        cursor = connection.cursor
+        connection.cursor = lambda: CountingCursor(cursor(), current)
+    return current
+
+
+class QueryBudgetMiddleware(object):
+
+    def __init__(self):
+        self.max_queries = int(getattr(settings, 'QUERY_BUDGET_QUERIES', 100))
+        self.max_seconds = float(getattr(settings, 'QUERY_BUDGET_SECONDS', 2))
+        self.reject = getattr(settings, 'QUERY_BUDGET_ACTION', 'log') == \
+            'reject'
+
+    def process_request(self, request):
+        for connection in connections.all():
+            if self.reject:
+                tally(connection).reset(self.max_queries, self.max_seconds)
+            else:
+                tally(connection).reset()
+        request.query_budget = True
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, QueryBudgetExceeded):
+            self.log(request, 'rejected')
+            self.finish(request)
+            return HttpResponse(
+                "This page needs more of the database than it's allowed.",
+                status=503, mimetype='text/plain')
+
+    def process_response(self, request, response):
+        if not getattr(request, 'query_budget', False):
+            # Some earlier middleware answered without us.
+            return response
+        if not getattr(response, '_is_string', True):
+            # Streamed; the body's queries haven't been made yet.
+            response._container = self.streamed(request, response._container)
+            return response
+        self.check(request)
+        self.finish(request)
+        return response
+
+    def streamed(self, request, chunks):
+        """ Yield the chunks of a streamed body, then check the budget. """
+        try:
+            try:
+                for chunk in chunks:
+                    yield chunk
+            except QueryBudgetExceeded:
+                self.log(request, 'rejected')
+            else:
+                self.check(request)
+        finally:
+            # Even if the client went away before the end.
+            self.finish(request)
+
+    def check(self, request):
+        queries, seconds = self.totals()
+        if queries > self.max_queries or seconds > self.max_seconds:
+            self.log(request, 'over budget')
+
+    def finish(self, request):
+        for connection in connections.all():
+            # Queries made outside a request aren't limited.
+            tally(connection).reset()
+        request.query_budget = False
+
+    def totals(self):
+        """ (queries, seconds) so far, over all the databases. """
+        tallies = [tally(connection) for connection in connections.all()]
+        return (sum(t.queries for t in tallies),
+                sum(t.seconds for t in tallies))
+
+    def log(self, request, what):
+        queries, seconds = self.totals()
+        errors = request.META.get('wsgi.errors', sys.stderr)
+        errors.write("Query budget: {0} {1} {2}: {3} queries (budget {4}), "
+                     "{5:.3f}s in the database (budget {6}s)\n".format(
+                         what, request.method, request.get_full_path(),
+                         queries, self.max_queries, seconds,
+                         self.max_seconds))
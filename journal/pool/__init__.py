@@ -0,0 +1,150 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Database connection pool
+
+Django opens a connection to the database the first time a request needs
+one and closes it when the request finishes, so every request pays for a
+MySQL handshake.  A Pool keeps the connections between requests instead:
+the pooled backend (journal.pool.mysql) takes one from here when a request
+first needs it and hands it back when Django would have closed it.
+
+A Pool holds at most max_size connections, idle & in use.  An idle
+connection is pinged before it's handed out, and closed once it has been
+idle for more than idle_timeout seconds.  When all max_size are in use a
+caller waits up to wait seconds for one to come back, then gets
+PoolExhausted.
+"""
+
+import time
+import threading
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class Pool(object):
+    """ Open connections to one database, shared by the threads of a
+    process.
+    """
+
+    def __init__(self, check, max_size=5, idle_timeout=300, wait=10):
+        # check(connection) raises if the connection is no good.
+        self.check = check
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait = wait
+        # [(time returned, connection)], most recently returned last.
+        self._idle = []
+        # Connections idle or in use, counting those being opened.
+        self._open = 0
+        self._lock = threading.Condition()
+        self.stats = {'reused': 0, 'opened': 0, 'discarded': 0, 'waits': 0}
+
+    def acquire(self):
+        """ Return an idle connection that passed its check, or None once
+        there's room for the caller to open a new connection, which must be
+        given back to release() even if opening it fails.
+        """
+        deadline = time.time() + self.wait
+        while True:
+            with self._lock:
+                self._expire()
+                if self._idle:
+                    connection = self._idle.pop()[1]
+                elif self._open < self.max_size:
+                    self._open += 1
+                    self.stats['opened'] += 1
+                    return None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhausted(
+                            "All {0} database connections are in use".
+                            format(self.max_size))
+                    self.stats['waits'] += 1
+                    self._lock.wait(remaining)
+                    continue
+            # Check outside the lock; a dead server can take a while to say
+            # so.
+            try:
+                self.check(connection)
+            except Exception:
+                self._discard(connection)
+                continue
+            with self._lock:
+                self.stats['reused'] += 1
+            return connection
+
+    def release(self, connection):
+        """ Give a connection back, or None to give up the room for one that
+        couldn't be opened or has been closed.
+        """
+        with self._lock:
+            if connection is None:
+                self._open -= 1
+            else:
+                self._idle.append((time.time(), connection))
+            self._lock.notify()
+
+    def discard(self, connection):
+        """ Close a connection that shouldn't be reused, and make room for
+        another.
+        """
+        self._discard(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._open -= 1
+            self.stats['discarded'] += 1
+            self._lock.notify()
+
+    def _expire(self):
+        """ Close the connections idle for too long.  Called with the lock
+        held; the oldest are at the front.
+        """
+        cutoff = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][0] < cutoff:
+            connection = self._idle.pop(0)[1]
+            try:
+                connection.close()
+            except Exception:
+                pass
+            self._open -= 1
+            self.stats['discarded'] += 1
+
+    def close_all(self):
+        """ Close the idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for returned, connection in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def __len__(self):
+        """ The number of connections open, idle or in use. """
+        return self._open
+
+    def idle(self):
+        return len(self._idle)
@@ -0,0 +1,109 @@
+# Journal
+# Copyright (C) 2010, Dirk Bergstrom, dirk@otisbean.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+MySQL backend with pooled connections
+
+    DATABASE_ENGINE = 'journal.pool.mysql'
+
+Everything but opening & closing connections is Django's MySQL backend.
+The pool is sized by settings.DATABASE_POOL_SIZE, DATABASE_POOL_IDLE_TIMEOUT
+and DATABASE_POOL_WAIT; see journal.pool.
+
+A connection going back to the pool is rolled back first, so that it
+doesn't carry an open transaction (or a stale InnoDB snapshot) into the
+next request.  There's a pool per database, user & host: the test runner
+"closes" the connection and switches to the test database, and mustn't be
+handed back a connection to the real one.
+"""
+
+import atexit
+import threading
+
+from django.conf import settings
+from django.db.backends.mysql.base import *
+from django.db.backends.mysql.base import DatabaseWrapper as MySQLWrapper
+
+from journal.pool import Pool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(settings_dict):
+    """ Return the Pool for a database's settings, making it if need be. """
+    key = tuple(settings_dict.get(name) for name in
+                ('HOST', 'PORT', 'NAME', 'USER'))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = Pool(
+                lambda connection: connection.ping(),
+                int(getattr(settings, 'DATABASE_POOL_SIZE', 5)),
+                float(getattr(settings, 'DATABASE_POOL_IDLE_TIMEOUT', 300)),
+                float(getattr(settings, 'DATABASE_POOL_WAIT', 10)))
+        return pool
+
+
+def pools():
+    """ The pools made so far. """
+    with _pools_lock:
+        return _pools.values()
+
+
+class DatabaseWrapper(MySQLWrapper):
+
+    # Whether this thread's connection (or the room for it) came from the
+    # pool.
+    pooled = False
+
+    def _cursor(self):
+        if self.connection is None and not self.pooled:
+            pool = get_pool(self.settings_dict)
+            self.connection = pool.acquire()
+            self.pooled = True
+            try:
+                return super(DatabaseWrapper, self)._cursor()
+            except:
+                if self.connection is None:
+                    self.pooled = False
+                    pool.release(None)
+                raise
+        return super(DatabaseWrapper, self)._cursor()
+
+    def close(self):
+        """ Give the connection back to the pool rather than closing it. """
+        if not self.pooled:
+            return super(DatabaseWrapper, self).close()
+        pool = get_pool(self.settings_dict)
+        connection, self.connection = self.connection, None
+        self.pooled = False
+        if connection is None:
+            # The backend closed it after a failed ping.
+            pool.release(None)
+            return
+        try:
+            connection.rollback()
+        except Database.Error:
+            pool.discard(connection)
+        else:
+            pool.release(connection)
+
+
+def _close_pools():
+    for pool in pools():
+        pool.close_all()
+
+atexit.register(_close_pools)
@@ -14,13 +14,21 @@ ADMINS = (
 
 MANAGERS = ADMINS
 
-DATABASE_ENGINE = 'mysql'           # 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
+DATABASE_ENGINE = 'journal.pool.mysql' # 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
 DATABASE_NAME = ''             # Or path to database file if using sqlite3.
 DATABASE_USER = ''             # Not used with sqlite3.
 DATABASE_PASSWORD = ''         # Not used with sqlite3.
 DATABASE_HOST = ''             # Set to empty string for localhost. Not used with sqlite3.
 DATABASE_PORT = ''             # Set to empty string for default. Not used with sqlite3.
 
+# Connections kept open between requests by the journal.pool.mysql backend:
+# at most DATABASE_POOL_SIZE per process, each closed after sitting idle for
+# DATABASE_POOL_IDLE_TIMEOUT seconds.  A request finding them all in use
+# waits up to DATABASE_POOL_WAIT seconds for one.
+DATABASE_POOL_SIZE = 5
+DATABASE_POOL_IDLE_TIMEOUT = 300
+DATABASE_POOL_WAIT = 10
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -63,9 +71,11 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'journal.middleware.QueryBudgetMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'journal.diary.instrument.InstrumentationMiddleware',
 )
 if not DEVELOPMENT:
     # REMOTE_USER auth doesn't work with the dev server
@@ -74,8 +84,28 @@ if not DEVELOPMENT:
         'django.contrib.auth.backends.RemoteUserBackend',
     )
 
+# Requests making more queries, or spending more seconds in the database,
+# than this are logged by QueryBudgetMiddleware ('log'), or failed with a 503
+# when they go over ('reject').
+QUERY_BUDGET_QUERIES = 100
+QUERY_BUDGET_SECONDS = 2
+QUERY_BUDGET_ACTION = 'log'
+
+# Time views, templates & serialisation, and let staff profile requests;
+# see journal.diary.instrument.  Costs next to nothing while off.
+INSTRUMENTATION = False
+
 ROOT_URLCONF = 'journal.urls'
 
+# Where compressed feeds and bands are cached.  Local memory is per process;
+# when serving from several processes, sharing one between them (e.g.
+# 'memcached://127.0.0.1:11211/') saves each compressing its own copies.
+CACHE_BACKEND = 'locmem://'
+
+# Where rendered info bubbles are cached: "lru://<max entries>" for local
+# memory, "file://<directory>", or empty to turn caching off.
+BUBBLE_CACHE_BACKEND = 'lru://500'
+
 TEMPLATE_DIRS = (
     # Put strings here, like "/home/html/django_templates" or "C:/www/django/templates".
     # Always use forward slashes, even on Windows.
@@ -16,6 +16,434 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
  */
 
+/*
+Format a Date as YYYY-MM-DD for the timeline_json start & end parameters.
+ */
+function isoDate(date) {
+  function pad(n) {
+    return (n < 10 ? '0' : '') + n;
+  }
+  return date.getUTCFullYear() + '-' + pad(date.getUTCMonth() + 1) + '-' +
+      pad(date.getUTCDate());
+}
+
+/*
+Turn a feed in the columnar format (see diary/timeline.py) back into the
+usual Simile JSON.
+ */
+function decodeColumnar(json) {
+  var epoch = Date.UTC(1970, 0, 1);
+  var day = 24 * 60 * 60 * 1000;
+  var events = [];
+  for (var i = 0; i < json.id.length; i++) {
+    var evt = {
+      id: String(json.id[i]),
+      classname: json.classnames[json.classname[i]],
+      title: json.title[i],
+      start: isoDate(new Date(epoch + json.start[i] * day)),
+      // Only durations have an end; Simile draws anything else as an
+      // instant.
+      durationEvent: json.end[i] != null
+    };
+    if (json.end[i] != null) {
+      evt.end = isoDate(new Date(epoch + json.end[i] * day));
+    }
+    $.extend(evt, json.extra[i]);
+    events.push(evt);
+  }
+  return {
+    'wiki-url': json['wiki-url'],
+    'wiki-section': json['wiki-section'],
+    dateTimeFormat: json.dateTimeFormat,
+    events: events
+  };
+}
+
+/*
+Months we've already fetched, kept in localStorage (when the browser has
+it) under "journal:<line type>:<YYYY-MM>" as {etag: ..., feed: ...}.
+ */
+var monthStore = {
+  enabled: (function() {
+    try {
+      return !!window.localStorage;
+    } catch (e) {
+      return false;
+    }
+  })(),
+
+  key: function(lineType, month) {
+    return 'journal:' + lineType + ':' + month;
+  },
+
+  get: function(lineType, month) {
+    if (!this.enabled) {
+      return null;
+    }
+    var stored = window.localStorage.getItem(this.key(lineType, month));
+    return stored ? $.parseJSON(stored) : null;
+  },
+
+  put: function(lineType, month, etag, feed) {
+    if (!this.enabled) {
+      return;
+    }
+    try {
+      window.localStorage.setItem(this.key(lineType, month),
+          JSON.stringify({etag: etag, feed: feed}));
+    } catch (e) {
+      // Out of space; we'll just fetch it again next time.
+    }
+  }
+};
+
+/*
+Return the "YYYY-MM" months from start to end, inclusive.
+ */
+function monthsBetween(start, end) {
+  var months = [];
+  var year = start.getUTCFullYear();
+  var month = start.getUTCMonth();
+  while (year < end.getUTCFullYear() ||
+      (year == end.getUTCFullYear() && month <= end.getUTCMonth())) {
+    months.push(isoDate(new Date(Date.UTC(year, month, 1))).substring(0, 7));
+    month++;
+    if (month == 12) {
+      month = 0;
+      year++;
+    }
+  }
+  return months;
+}
+
+// Must match diary.views.MAX_MONTHS.
+var MAX_MONTHS = 60;
+
+/*
+Load events into eventSource as the band scrolls.  We want the visible
+window plus a screen's worth of margin on either side, a month at a time.
+Each month is requested at most once per page, and months we've seen on a
+previous visit are only sent again if they've changed.
+ */
+function loadEventsForBand(band, eventSource, url, lineType) {
+  var requested = {};
+  // Periods overlapping several months come back for each; only load them
+  // once.
+  var seen = {};
+  var scrollTimerID = null;
+
+  function load(feed) {
+    var json = decodeColumnar(feed);
+    var fresh = [];
+    $.each(json.events, function(i, evt) {
+      var key = evt.classname + ':' + evt.id;
+      if (!seen[key]) {
+        seen[key] = true;
+        fresh.push(evt);
+      }
+    });
+    json.events = fresh;
+    eventSource.loadJSON(json, url);
+  }
+
+  function fetch(months) {
+    var stored = {};
+    var params = $.map(months, function(month) {
+      stored[month] = monthStore.get(lineType, month);
+      return stored[month] ? month + ':' + stored[month].etag : month;
+    });
+    $.ajax( {
+      url: url,
+      data: {months: params.join(',')},
+      dataType: 'json',
+      success: function(json) {
+        $.each(json, function(month, answer) {
+          if (answer.feed) {
+            monthStore.put(lineType, month, answer.etag, answer.feed);
+            load(answer.feed);
+          } else {
+            load(stored[month].feed);
+          }
+        });
+      },
+      error: function() {
+        // Let the next scroll try again.
+        $.each(months, function(i, month) {
+          delete requested[month];
+        });
+      }
+    })
+  }
+
+  function update() {
+    var minVisible = band.getMinVisibleDate();
+    var maxVisible = band.getMaxVisibleDate();
+    var margin = maxVisible.getTime() - minVisible.getTime();
+    var wanted = monthsBetween(new Date(minVisible.getTime() - margin),
+        new Date(maxVisible.getTime() + margin));
+    var missing = $.grep(wanted, function(month) {
+      return !requested[month];
+    });
+    if (missing.length) {
+      $.each(missing, function(i, month) {
+        requested[month] = true;
+      });
+      // The server answers for at most MAX_MONTHS at a time.
+      for (var i = 0; i < missing.length; i += MAX_MONTHS) {
+        fetch(missing.slice(i, i + MAX_MONTHS));
+      }
+    }
+  }
+
+  band.addOnScrollListener(function() {
+    if (scrollTimerID == null) {
+      scrollTimerID = window.setTimeout(function() {
+        scrollTimerID = null;
+        update();
+      }, 250);
+    }
+  });
+  update();
+}
+
+/*
+Colours for the density tapes in the overview bands, by classname.
+ */
+var densityColors = {
+  Person: [0x33, 0x66, 0xaa],
+  Event: [0xaa, 0x55, 0x22],
+  Period: [0x22, 0x88, 0x55]
+};
+
+/*
+Mix a class's colour with white; fraction 1 is the full colour.
+ */
+function densityColor(classname, fraction) {
+  var rgb = densityColors[classname] || [0x66, 0x66, 0x66];
+  var light = 0.15 + 0.85 * fraction;
+  return '#' + $.map(rgb, function(c) {
+    var mixed = Math.round(255 - (255 - c) * light);
+    return (mixed < 16 ? '0' : '') + mixed.toString(16);
+  }).join('');
+}
+
+/*
+Fill an overview band with how much is going on rather than every event:
+one tape per class per month, year or decade (resolution), shaded by how
+many events fall in it (see timeline_density).  Like loadEventsForBand, it
+fetches the visible window plus a screen's worth either side, and again
+only when the band scrolls outside what it already has.
+ */
+function loadDensityForBand(band, eventSource, url, resolution) {
+  var loadedFrom = null;
+  var loadedTo = null;
+  var seen = {};
+  var scrollTimerID = null;
+
+  function load(json) {
+    var most = 1;
+    $.each(json.buckets, function(i, bucket) {
+      most = Math.max.apply(Math, [most].concat(bucket[2]));
+    });
+    var events = [];
+    $.each(json.buckets, function(i, bucket) {
+      $.each(json.classnames, function(j, classname) {
+        var count = bucket[2][j];
+        var key = classname + ':' + bucket[0];
+        if (!count || seen[key]) {
+          return;
+        }
+        seen[key] = true;
+        events.push({
+          id: 'density:' + resolution + ':' + key,
+          start: bucket[0],
+          end: bucket[1],
+          durationEvent: true,
+          title: count + ' ' + classname,
+          classname: 'density',
+          color: densityColor(classname, count / most)
+        });
+      });
+    });
+    eventSource.loadJSON({dateTimeFormat: 'iso8601', events: events}, url);
+  }
+
+  function update() {
+    var minVisible = band.getMinVisibleDate().getTime();
+    var maxVisible = band.getMaxVisibleDate().getTime();
+    if (loadedFrom != null && minVisible >= loadedFrom &&
+        maxVisible <= loadedTo) {
+      return;
+    }
+    var margin = maxVisible - minVisible;
+    var from = minVisible - margin;
+    var to = maxVisible + margin;
+    $.ajax( {
+      url: url,
+      data: {resolution: resolution, start: isoDate(new Date(from)),
+             end: isoDate(new Date(to))},
+      dataType: 'json',
+      success: function(json) {
+        loadedFrom = loadedFrom == null ? from : Math.min(loadedFrom, from);
+        loadedTo = loadedTo == null ? to : Math.max(loadedTo, to);
+        load(json);
+      }
+    });
+  }
+
+  band.addOnScrollListener(function() {
+    if (scrollTimerID == null) {
+      scrollTimerID = window.setTimeout(function() {
+        scrollTimerID = null;
+        update();
+      }, 250);
+    }
+  });
+  update();
+}
+
+/*
+Load each user-defined band's events (see timeline_bands) into its own
+event source, from eventSources keyed by band id, as band scrolls.  Like
+loadDensityForBand, it fetches the visible window plus a screen's worth
+either side, and again only when the band scrolls outside what it has.
+ */
+function loadEventsForBands(band, eventSources, url) {
+  var loadedFrom = null;
+  var loadedTo = null;
+  var seen = {};
+  var scrollTimerID = null;
+
+  function load(id, feed) {
+    var json = decodeColumnar(feed);
+    json.events = $.grep(json.events, function(evt) {
+      var key = id + ':' + evt.classname + ':' + evt.id;
+      if (seen[key]) {
+        return false;
+      }
+      seen[key] = true;
+      return true;
+    });
+    eventSources[id].loadJSON(json, url);
+  }
+
+  function update() {
+    var minVisible = band.getMinVisibleDate().getTime();
+    var maxVisible = band.getMaxVisibleDate().getTime();
+    if (loadedFrom != null && minVisible >= loadedFrom &&
+        maxVisible <= loadedTo) {
+      return;
+    }
+    var margin = maxVisible - minVisible;
+    var from = minVisible - margin;
+    var to = maxVisible + margin;
+    $.ajax( {
+      url: url,
+      data: {start: isoDate(new Date(from)), end: isoDate(new Date(to))},
+      dataType: 'json',
+      success: function(json) {
+        loadedFrom = loadedFrom == null ? from : Math.min(loadedFrom, from);
+        loadedTo = loadedTo == null ? to : Math.max(loadedTo, to);
+        $.each(json.bands, function(i, answer) {
+          if (answer.feed && eventSources[answer.id]) {
+            load(answer.id, answer.feed);
+          }
+        });
+      }
+    });
+  }
+
+  band.addOnScrollListener(function() {
+    if (scrollTimerID == null) {
+      scrollTimerID = window.setTimeout(function() {
+        scrollTimerID = null;
+        update();
+      }, 250);
+    }
+  });
+  update();
+}
+
+/*
+Bubbles fetched ahead of time by prefetchDetails, by "<class>:<id>".
+ */
+var bubbles = {};
+
+/*
+Fetch the bubbles of the events visible in bands (an array of Simile
+bands) while the page is idle, a batch at a time from details_batch, so
+that clicking an event opens its bubble at once.  Runs again whenever a
+band scrolls or gets more events.
+ */
+function prefetchDetails(bands, url) {
+  var batchSize = 50;
+  var requested = {};
+  var timerID = null;
+
+  function wanted() {
+    var keys = [];
+    $.each(bands, function(i, band) {
+      var iterator = band.getEventSource().getEventIterator(
+          band.getMinVisibleDate(), band.getMaxVisibleDate());
+      while (iterator.hasNext()) {
+        var evt = iterator.next();
+        var key = evt.getClassName() + ':' + evt.getID();
+        if (evt.getClassName() != 'density' && !requested[key]) {
+          requested[key] = true;
+          keys.push(key);
+        }
+      }
+    });
+    return keys;
+  }
+
+  function fetch() {
+    timerID = null;
+    var keys = wanted();
+    for (var i = 0; i < keys.length; i += batchSize) {
+      (function(batch) {
+        $.ajax( {
+          url: url,
+          data: {objects: batch.join(',')},
+          dataType: 'json',
+          success: function(json) {
+            $.extend(bubbles, json);
+          },
+          error: function() {
+            // Leave them to be fetched on click, or on the next pass.
+            $.each(batch, function(j, key) {
+              delete requested[key];
+            });
+          }
+        });
+      })(keys.slice(i, i + batchSize));
+    }
+  }
+
+  // Wait for the page to settle, then use idle time if the browser says
+  // when that is.
+  function schedule() {
+    if (timerID == null) {
+      timerID = window.setTimeout(function() {
+        if (window.requestIdleCallback) {
+          window.requestIdleCallback(fetch);
+        } else {
+          fetch();
+        }
+      }, 500);
+    }
+  }
+
+  $.each(bands, function(i, band) {
+    band.addOnScrollListener(schedule);
+    band.getEventSource().addListener({
+      onAddMany: schedule,
+      onClear: function() {}
+    });
+  });
+  schedule();
+}
+
 $(document).ready(function() {
   // var original_showBubble = Timeline.OriginalEventPainter.prototype._showBubble;
   // Timeline.OriginalEventPainter.prototype._showBubble = function(x, y, evt)
@@ -26,6 +454,17 @@ $(document).ready(function() {
 
   Timeline.DefaultEventSource.Event.prototype.fillInfoBubble = function(
       element, theme, labeller) {
+    if (this.getClassName() == 'density') {
+      // A density tape stands for many events, and has no details of its
+      // own; its title says what it counts.
+      $(element).text(this.getText());
+      return;
+    }
+    var prefetched = bubbles[this.getClassName() + ':' + this.getID()];
+    if (prefetched) {
+      $(element).html(prefetched);
+      return;
+    }
     var url = base_url + 'details/' + this.getClassName() + '/' + this.getID() + '/'
     $.ajax( {
       url: url,
@@ -29,9 +29,30 @@ urlpatterns = patterns('',
     url(r'^timeline/(?P<line_type>[^/]+)/', views.timeline, name='timeline'),
     url(r'^timeline_json/(?P<line_type>[^/]+)/', views.timeline_json,
      name='timeline_json'),
+    url(r'^timeline_months/(?P<line_type>[^/]+)/', views.timeline_months,
+     name='timeline_months'),
+    url(r'^timeline_density/(?P<line_type>[^/]+)/', views.timeline_density,
+     name='timeline_density'),
+    url(r'^timeline_bands/(?P<line_type>[^/]+)/', views.timeline_bands,
+     name='timeline_bands'),
 
     # Render details for an info bubble
     url(r'^details/(?P<model_type>[^/]+)/(?P<pk>[0-9]+)/', views.model_details),
+    url(r'^details_batch/$', views.details_batch, name='details_batch'),
+
+    url(r'^search_json/$', views.search_json, name='search_json'),
+    url(r'^on_this_day/$', views.on_this_day, name='on_this_day'),
+
+    # Statistics for charting
+    url(r'^stats/$', views.stats_index, name='stats_index'),
+    url(r'^stats/(?P<series>[^/]+)/(?P<period>[^/]+)/$', views.stats_json,
+     name='stats_json'),
+
+    # Backups, for staff only
+    url(r'^export/$', views.export, name='export'),
+
+    # Counters for monitoring, for staff only
+    url(r'^metrics/$', views.metrics, name='metrics'),
 
     url(r'^admin/', include(admin.site.urls)),
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
@@ -43,7 +64,7 @@ urlpatterns = patterns('',
 
 if settings.DEVELOPMENT:
     urlpatterns += patterns('',
-        url(r'^static/(?P<path>.*)$', 'django.views.static.serve',
+        url(r'^static/(?P<path>.*)$', 'journal.diary.compression.serve_static',
          {'document_root': settings.MEDIA_ROOT, 'show_indexes': True}),
     )
 